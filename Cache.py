@@ -2,10 +2,11 @@
 TODO:
 - Reimplement NODIR
 - Option to merge path elements into one directory while file count
-  is below treshold.
+  is below treshold. For now caches.Sharded limits directory sizes.
 """
-import time, os, sys
+import hashlib, mmap, time, os, sys
 import re
+from bisect import bisect_right
 
 import Params
 import Runtime
@@ -24,6 +25,16 @@ def load_backend_type(tp):
 	return getattr( mod, name )
 
 
+def file_digest(path):
+	"Return the SHA1 hex digest of the file at path. "
+	digest = hashlib.sha1()
+	fp = open( path, 'rb' )
+	for chunk in iter( lambda: fp.read( 64 * 1024 ), '' ):
+		digest.update( chunk )
+	fp.close()
+	return digest.hexdigest()
+
+
 def suffix_ext(path, suffix):
 	x = re.match('.*\.([a-zA-Z0-9]+)$', path)
 	if x:
@@ -34,6 +45,146 @@ def suffix_ext(path, suffix):
 	return path
 
 
+class SharedMap(object):
+
+	"""
+	Read-only file and mmap of a complete cache file, shared by all File
+	instances that have it open. It stays open in the OPEN_FILES LRU after
+	the last one closes, until it is evicted or invalidated.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.fp = open( path, 'rb' )
+		stat = os.fstat( self.fp.fileno() )
+		self.ino, self.size = stat.st_ino, stat.st_size
+		self.buf = None
+		if self.size:
+			self.buf = mmap.mmap( self.fp.fileno(), 0, access=mmap.ACCESS_READ )
+		self.refs = 0
+		self.dropped = False
+
+	@classmethod
+	def get(klass, path):
+		"""
+		Return the open file at path, opening it if needed. A file that was
+		replaced or removed by other means than File.finalize or remove_full
+		is dropped, so that it is not served stale and its space is freed.
+		"""
+		shared = OPEN_FILES.get( path )
+		if shared:
+			try:
+				stat = os.stat( path )
+			except OSError:
+				invalidate( path )
+				raise
+			if shared.ino != stat.st_ino or shared.size != stat.st_size:
+				invalidate( path )
+				shared = None
+		if not shared:
+			shared = klass( path )
+			OPEN_FILES[ path ] = shared
+		shared.refs += 1
+		return shared
+
+	def read(self, pos, size):
+		if self.buf:
+			return self.buf[ pos:pos + size ]
+		return ''
+
+	def release(self):
+		self.refs -= 1
+		if self.dropped and not self.refs:
+			self.close()
+
+	def drop(self):
+		"Close the file once it is no longer in use. "
+		self.dropped = True
+		if not self.refs:
+			self.close()
+
+	def close(self):
+		if self.buf:
+			self.buf.close()
+		self.fp.close()
+
+OPEN_FILES = LRU( Params.OPEN_FILES, SharedMap.drop )
+
+def invalidate(path):
+	"Drop the open file at path, after it was replaced or removed. "
+	shared = OPEN_FILES.pop( path, None )
+	if shared:
+		shared.drop()
+
+
+class RangeMap(object):
+
+	"""
+	Ordered map of the byte ranges present in a segmented partial file.
+	Ranges are [start, end) pairs, kept merged. The string form is a comma
+	separated list of 'start-end' pairs, which is stored with the descriptor.
+	"""
+
+	def __init__(self, ranges=[]):
+		self.ranges = []
+		for start, end in ranges:
+			self.add( start, end )
+
+	@classmethod
+	def parse(klass, spec):
+		ranges = []
+		for part in spec.split(','):
+			if part.strip():
+				start, end = part.split('-')
+				ranges.append(( int( start ), int( end ) ))
+		return klass( ranges )
+
+	def add(self, start, end):
+		"Mark bytes start up to end present. "
+		if end <= start:
+			return
+		ranges = self.ranges
+		i = bisect_right( ranges, [ start, sys.maxint ] )
+		if i and ranges[ i-1 ][ 1 ] >= start:
+			i -= 1
+			start = ranges[ i ][ 0 ]
+		j = i
+		while j < len( ranges ) and ranges[ j ][ 0 ] <= end:
+			end = max( end, ranges[ j ][ 1 ] )
+			j += 1
+		ranges[ i:j ] = [ [ start, end ] ]
+
+	def contiguous(self, offset):
+		"Return the end of the bytes present from offset on. "
+		ranges = self.ranges
+		i = bisect_right( ranges, [ offset, sys.maxint ] )
+		if i and ranges[ i-1 ][ 0 ] <= offset < ranges[ i-1 ][ 1 ]:
+			return ranges[ i-1 ][ 1 ]
+		return offset
+
+	def covers(self, start, end):
+		return self.contiguous( start ) >= end
+
+	def missing(self, start, end):
+		"Return list of (start, end) holes between start and end. "
+		holes = []
+		pos = start
+		for s, e in self.ranges:
+			if e <= pos:
+				continue
+			if s >= end:
+				break
+			if s > pos:
+				holes.append(( pos, s ))
+			pos = e
+		if pos < end:
+			holes.append(( pos, end ))
+		return holes
+
+	def __str__(self):
+		return ','.join([ '%i-%i' % tuple( r ) for r in self.ranges ])
+
+
 class File(object):
 
 	"""
@@ -42,6 +193,12 @@ class File(object):
 
 	Parameters ARCHIVE and ENCODE_PATHSEP also affect the storage location.
 	ARCHIVE is applied after ENCODE_PATHSEP.
+
+	With SEGMENTED, partial files are written at the offset of each received
+	range and `ranges` maps which bytes are present.
+
+	New content is hashed while it is written, see digest(). Complete files
+	are read through a SharedMap, which stays open for later hits.
 	"""
 
 	def __init__(self, path=None):
@@ -54,6 +211,14 @@ class File(object):
 		self.partial = None
 		self.full = None
 		self.fp = None
+		self.ranges = None
+		self.offset = 0
+		self.hash = None
+		self.hashed = 0
+		self.map = None
+		self.length = None
+		self.moved = False
+		"true once a read moved the position away from the end of the file"
 		if path:
 			self.init(path)
 
@@ -94,6 +259,23 @@ class File(object):
 
 		self.stat()
 
+	def init_path(self, path):
+		"Set the location that init gave before for the same URL. "
+		self.path = path
+		self.fp = None
+		self.stat()
+
+	def set_variant(self, key):
+		"""
+		Give the entity a path apart from other variants stored for the same
+		URL, derived from the variant key.
+		"""
+		assert not self.fp
+		self.path = suffix_ext( self.path,
+				'.' + hashlib.md5( key ).hexdigest()[ :8 ] )
+		self.partial, self.full = None, None
+		self.stat()
+
 	def full_path(self):
 		assert Runtime.ROOT
 		assert not self.path.startswith(Runtime.ROOT)
@@ -157,20 +339,91 @@ class File(object):
 		except Exception, e:
 			mainlog.note('%s: Failed to open file: %s',self, e)
 			self.fp = os.tmpfile()
+		self.hash, self.hashed = hashlib.sha1(), 0
+		self.length = 0
 
 	def open_partial(self, offset=-1):
 		assert not self.fp
 		self.fp = open( self.abspath(), 'a+' )
+		self.length = None
 		if offset >= 0:
 			assert offset <= self.tell(), 'range does not match file in cache'
 			self.fp.seek( offset )
 			self.fp.truncate()
+		self.fp.seek( 0, 2 )
+		self.length = self.fp.tell()
 		mainlog.info('%s: Resuming partial file in cache at byte %s',self, self.tell())
 
+	def open_segment(self, offset):
+		"""
+		Open partial file to write at offset, keeping the data present.
+		"""
+		assert not self.fp
+		assert self.ranges != None
+		partial = self.partial_path()
+		tdir = os.path.dirname( partial )
+		if not os.path.exists( tdir ):
+			os.makedirs( tdir )
+		if os.path.exists( partial ):
+			self.fp = open( partial, 'r+' )
+		else:
+			self.fp = open( partial, 'w+' )
+		if not self.ranges.ranges:
+			self.hash, self.hashed = hashlib.sha1(), 0
+		self.offset = offset
+		mainlog.info('%s: Opened segmented file in cache at byte %s (%s)',
+				self, offset, self.ranges)
+
+	def open_replacement(self):
+		"""
+		Open a new partial file, to be renamed over the complete file when
+		finished.
+		"""
+		assert not self.fp
+		self.fp = open( self.partial_path(), 'w+' )
+		self.full = False
+		self.partial = os.fstat( self.fp.fileno() )
+		self.hash, self.hashed = hashlib.sha1(), 0
+		self.length = 0
+
+	def digest(self):
+		"""
+		Return the SHA1 hex digest of the partial file. This is the digest
+		kept while writing, unless data was written out of order or the
+		download was resumed, then the file is read again.
+		"""
+		partial = self.partial_path()
+		if self.fp:
+			self.fp.flush()
+		size = os.path.getsize( partial )
+		if not self.hash or self.hashed != size:
+			self.hash, self.hashed = hashlib.sha1(), 0
+			fp = open( partial, 'rb' )
+			for chunk in iter( lambda: fp.read( 64 * 1024 ), '' ):
+				self.hash.update( chunk )
+				self.hashed += len( chunk )
+			fp.close()
+		return self.hash.hexdigest()
+
+	def finalize(self, mtime):
+		"""
+		Move the completed partial file to its final location, and return
+		the path for the descriptor.
+		"""
+		abspath = self.full_path()
+		partial = self.partial_path()
+		assert os.path.exists( partial ), partial
+		os.rename( partial, abspath )
+		invalidate( abspath )
+		os.utime( abspath, ( mtime, mtime ) )
+		self.stat()
+		return self.path
+
 	def open_full(self):
 		assert not self.fp
-		self.fp = open( self.abspath(), 'r' )
-#		self.size = self.tell()
+		self.map = SharedMap.get( self.abspath() )
+		self.fp = self.map.fp
+		self.length = self.map.size
 
 	def open(self):
 		if self.full:
@@ -181,7 +434,9 @@ class File(object):
 			self.open_new()
 
 	def remove_full(self):
-		os.remove( self.abspath() )
+		abspath = self.abspath()
+		os.remove( abspath )
+		invalidate( abspath )
 		mainlog.note('%s: Removed complete file from cache', self)
 
 	def remove_partial(self):
@@ -189,21 +444,63 @@ class File(object):
 		os.remove( self.abspath() + Runtime.PARTIAL )
 
 	def read(self, pos, size):
+		if self.map:
+			return self.map.read( pos, size )
 		self.fp.seek( pos )
+		self.moved = True
 		return self.fp.read( size )
 
 	def write(self, chunk):
-		self.fp.seek( 0, 2 )
+		if self.ranges != None:
+			self.write_at( self.offset, chunk )
+			self.offset += len( chunk )
+			return
+		if self.length == None:
+			# Opened by a backend that does not track the length
+			self.fp.seek( 0, 2 )
+		elif self.moved:
+			# The opened file is at its end, unless it was read since
+			self.fp.seek( self.length )
+			self.moved = False
+		if self.hash:
+			self.hash.update( chunk )
+			self.hashed += len( chunk )
+		if self.length != None:
+			self.length += len( chunk )
 		return self.fp.write( chunk )
 
+	def write_at(self, offset, chunk):
+		"Write chunk at offset into segmented file, and record its range. "
+		assert self.ranges != None
+		if self.hash:
+			if offset == self.hashed:
+				self.hash.update( chunk )
+				self.hashed += len( chunk )
+			else:
+				# out of order, see digest
+				self.hash = None
+		self.fp.seek( offset )
+		self.fp.write( chunk )
+		self.ranges.add( offset, offset + len( chunk ) )
+
 	def tell(self):
+		if self.ranges != None:
+			return self.ranges.contiguous( self.offset )
+		if self.length != None:
+			return self.length
 		self.fp.seek( 0, 2 )
 		return self.fp.tell()
 
 	def close(self):
 		assert self.fp
-		self.fp.close()
+		if self.map:
+			self.map.release()
+			self.map = None
+		else:
+			self.fp.close()
 		self.fp = None
+		self.length = None
+		self.moved = False
 		self.partial, self.full = None, None
 		mainlog.debug("%s: Closed %s",self, self.path)
 
@@ -230,6 +230,27 @@ class CLIParams:
 					metavar="TYPE",
 					default=Params.CACHE,
 			)),
+			(("--shard-levels",),
+				"Number of directory levels for caches.Sharded, default"
+				" %default. ", dict(
+					metavar="N",
+					type=int,
+					default=Params.SHARD_LEVELS
+			)),
+			(("--shard-width",),
+				"Number of hex digits per directory name for caches.Sharded,"
+				" default %default. ", dict(
+					metavar="N",
+					type=int,
+					default=Params.SHARD_WIDTH
+			)),
+			(("--pack-max-size",),
+				"Largest entity that caches.Packed appends to a segment"
+				" file, default %default. ", dict(
+					metavar="BYTES",
+					type=int,
+					default=Params.PACK_MAX_SIZE
+			)),
 			(("--nodir",), "", dict(
 				action="store_true"
 			)),
@@ -237,6 +258,102 @@ class CLIParams:
 				dest="partial",
 				default=Params.PARTIAL
 			)),
+			(("--segmented",),
+				"Write partial downloads at the offset of each received range,"
+				" and keep a map of the ranges present. Range requests then"
+				" fill in the same partial file. ", dict(
+					action="store_true",
+					default=Params.SEGMENTED
+			)),
+			(("--parallel-fetch",),
+				"Fetch new downloads larger than --parallel-min-size in N"
+				" concurrent range requests, if the server accepts ranges."
+				" Requires --segmented. Default: %default. ", dict(
+					metavar="N",
+					type=int,
+					default=Params.PARALLEL_FETCH
+			)),
+			(("--parallel-min-size",),
+				"Smallest entity size to fetch in parallel, default %default. ", dict(
+					metavar="BYTES",
+					type=int,
+					default=Params.PARALLEL_MIN_SIZE
+			)),
+			(("--stale-while-revalidate",),
+				"Serve entities up to SEC seconds after they expired while"
+				" revalidating them in the background, unless the server"
+				" specifies otherwise. Default: %default. ", dict(
+					metavar="SEC",
+					type=int,
+					default=Params.STALE_WHILE_REVALIDATE
+			)),
+			(("--stale-if-error",),
+				"Serve entities up to SEC seconds after they expired if the"
+				" server cannot be reached or fails, unless the server"
+				" specifies otherwise. Default: %default. ", dict(
+					metavar="SEC",
+					type=int,
+					default=Params.STALE_IF_ERROR
+			)),
+			(("--prefetch",),
+				"Revalidate popular entities in the background before they"
+				" expire, at most N at once. Default: %default (off). ", dict(
+					metavar="N",
+					type=int,
+					default=Params.PREFETCH
+			)),
+			(("--prefetch-limit",),
+				"Limit the download rate of all background requests to RATE"
+				" K/s. Default: %default (unlimited). ", dict(
+					metavar="RATE",
+					type=int,
+					default=Params.PREFETCH_LIMIT
+			)),
+			(("--max-cache-size",),
+				"Evict the least recently served entities in the background"
+				" while the cache holds more than BYTES. Default: %default"
+				" (unlimited). ", dict(
+					metavar="BYTES",
+					type=int,
+					default=Params.MAX_CACHE_SIZE
+			)),
+			(("--max-cache-files",),
+				"Evict entities while the cache holds more than N. Default:"
+				" %default (unlimited). ", dict(
+					metavar="N",
+					type=int,
+					default=Params.MAX_CACHE_FILES
+			)),
+			(("--eviction",),
+				"Evict the least recently served ('lru') or least served"
+				" ('lfu') entities first. Default: %default. ", dict(
+					metavar="POLICY",
+					type="choice",
+					choices=( 'lru', 'lfu' ),
+					default=Params.EVICTION
+			)),
+			(("--admit-hits",),
+				"Store new entities only once their URL was requested N"
+				" times recently, as estimated by a count-min sketch. Others"
+				" are passed to the client without caching. Default:"
+				" %default (store all). ", dict(
+					metavar="N",
+					type=int,
+					default=Params.ADMIT_HITS
+			)),
+			(("--admit-max-size",),
+				"Do not store new entities larger than BYTES. Default:"
+				" %default (unlimited). ", dict(
+					metavar="BYTES",
+					type=int,
+					default=Params.ADMIT_MAX_SIZE
+			)),
+			(("--admit-exclude",),
+				"Do not store new entities of these comma separated"
+				" mediatypes, or mediatype prefixes such as 'video/'. ", dict(
+					metavar="MEDIATYPES",
+					default=Params.ADMIT_EXCLUDE
+			)),
 #
 #	if _arg in ( '-H', '--hash' ):
 #		try:
@@ -268,6 +385,14 @@ class CLIParams:
 				" elsewhere on downloading joining. ",
 					_rulefile("join")
 			),
+			(("--rules-poll",),
+				"Check the rule files for changes every SECONDS and parse"
+				" changed files again, without restarting the proxy. 0"
+				" disables. Default: %default. ", dict(
+					metavar="SECONDS",
+					type=int,
+					default=Params.RULES_POLL
+			)),
 			(("--join-rule",),
 				"XXX: append manual rule", dict()
 			),
@@ -352,11 +477,12 @@ class CLIParams:
 				dict_update(_cmd)
 			),
 			(("--find-records", ),
-				"XXX: Query for one or more records by regular expression.", 
-				dict_update(_cmd, metavar="KEY[.KEY]:PATTERN", type=str)
+				"Print records where the URL or descriptor attribute KEY"
+				" matches the regular expression PATTERN. ",
+				dict_update(_cmd, metavar="KEY:PATTERN", type=str)
 			),
 			(("--print-records", ),
-				"",
+				"Print resources and their descriptors. ",
 				dict_update(_cmd)
 			),
 			(("--print-record", ),
@@ -367,16 +493,71 @@ class CLIParams:
 				"",
 				dict_update(_cmd, metavar="URL", type=str)
 			),
+			(("--mediatype",),
+				"Restrict query commands to this mediatype, or to a major"
+				" type such as 'image'. ", dict(
+					metavar="TYPE",
+					default=None
+			)),
+			(("--min-size",),
+				"Restrict query commands to entities of at least BYTES. ", dict(
+					metavar="BYTES",
+					type=int,
+					default=None
+			)),
+			(("--max-size",),
+				"Restrict query commands to entities of at most BYTES. ", dict(
+					metavar="BYTES",
+					type=int,
+					default=None
+			)),
+			(("--host",),
+				"Restrict query commands to resources of this host[:port]. ",
+				dict(
+					metavar="HOST",
+					default=None
+			)),
+			(("--since",),
+				"Restrict query commands to entities modified at or after"
+				" TIME, in seconds since the epoch or as YYYY-MM-DD. ", dict(
+					metavar="TIME",
+					default=None
+			)),
+			(("--until",),
+				"Restrict query commands to entities modified before TIME. ",
+				dict(
+					metavar="TIME",
+					default=None
+			)),
+			(("--json",),
+				"Print query results as one JSON object per line. ", dict(
+					action="store_true",
+					default=False
+			)),
 		)),
 		( "Maintenance", 
 """See the documentation in ReadMe regarding configuration of the proxy. The
 options in this group performan maintenance tasks, and the last following group
 gives access to the stored data. """, (
 			(("--check-cache",),
-				"", dict_update(_cmd)
+				"Check size, mtime and SHA1 digest of the files of all"
+				" descriptors, in parallel. Files unchanged since the last"
+				" check are not hashed again. ", dict_update(_cmd)
 			),
 			(("--check-files",),
-				"", dict_update(_cmd)
+				"List files in the cache without descriptor, scanning"
+				" directories in parallel. ", dict_update(_cmd)
+			),
+			(("--prune",),
+				"Remove descriptors failing --check-cache, and unknown files"
+				" smaller than %s bytes found by --check-files. "
+				% Runtime.MAX_SIZE_PRUNE, dict(
+					action="store_true",
+					default=False
+			)),
+			(("--validate-cache",),
+				"Check that the files of all descriptors exist with the"
+				" recorded size and SHA1 digest. ", dict_update(_cmd)
 			),
 # XXX:
 #			(("--check-refs",),
@@ -390,8 +571,22 @@ gives access to the stored data. """, (
 				"expired. Also drops records for missing files. ", dict_update(_cmd)
 			),
 			(("--link-dupes",),
-				"TODO: Symlink duplicate content, check by size and hash."
-				" Requires up to date hash index.", dict_update(_cmd)
+				"Hard link files with duplicate content, compared by size"
+				" and SHA1 digest. ", dict_update(_cmd)
+			),
+			(("--migrate-cache",),
+				"Move the files of all descriptors to their location for"
+				" cache backend TYPE, ie. after changing --cache. ",
+				dict_update(_cmd, metavar="TYPE", type=str)
+			),
+			(("--compact-packs",),
+				"Copy the entities left in mostly unused segment files of"
+				" caches.Packed to the last segment, and remove the old"
+				" segments. ", dict_update(_cmd)
+			),
+			(("--prune-blobs",),
+				"Remove content of the caches.ContentAddressed backend that"
+				" is no longer referenced by any descriptor. ", dict_update(_cmd)
 			),
 #	 TODO --print-mode line|tree
 #	 TODO --print-url
@@ -557,8 +752,11 @@ cmdfunc = {
 #		'check-refs': 
 #		'prune-gone': 
 #		'prune-stale': 
-#		'link-dupes': 
-#		'validate-cache': Resource.validate_cache,
+		'link-dupes': Resource.link_dupes,
+		'prune-blobs': Resource.prune_blobs,
+		'migrate-cache': Resource.migrate_cache,
+		'compact-packs': Resource.compact_packs,
+		'validate-cache': Resource.validate_cache,
 		'check-cache': Resource.check_cache,
 		'check-files': Resource.check_files,
 #		'check-refs': Resource.check_files,
@@ -0,0 +1,65 @@
+"""
+Background fiber that keeps the cache below MAX_CACHE_SIZE bytes and
+MAX_CACHE_FILES entities, evicting the least recently (or frequently) served
+entities first. Victims come from an index on the descriptors, so choosing
+them never scans the cache. The usage is kept as running totals, and only
+counted again every EVICT_RECOUNT seconds for changes by other processes.
+"""
+import time
+
+import Params, Runtime, Resource
+import fiber
+import log
+
+
+mainlog = log.get_log('main')
+
+
+def over_limit(size, count):
+	return ( Runtime.MAX_CACHE_SIZE and size > Runtime.MAX_CACHE_SIZE ) \
+		or ( Runtime.MAX_CACHE_FILES and count > Runtime.MAX_CACHE_FILES )
+
+def evict(recount=False):
+	"""
+	Remove entities until the cache is within its limits, and return how
+	many were removed. Entities being downloaded are skipped.
+	"""
+	size, count = Resource.Descriptor.usage( recount )
+	# Blind and proxy protocols have no URL
+	downloading = set([ getattr( protocol, 'url', None ) for protocol in
+		getattr( Runtime, 'DOWNLOADS', {} ).values() ])
+	removed = 0
+	while over_limit( size, count ):
+		victims = [ descriptor for descriptor in
+				Resource.Descriptor.find_victims( Params.EVICT_BATCH + len( downloading ) )
+				if not descriptor.resource
+					or descriptor.resource.url not in downloading ]
+		if not victims:
+			break
+		for descriptor in victims:
+			if not over_limit( size, count ):
+				break
+			mainlog.info('Evicting %s, %s bytes, %s hits', descriptor.path,
+					descriptor.size, descriptor.hits)
+			descriptor.remove()
+			removed += 1
+			# Shared blobs are only freed with their last descriptor
+			size, count = Resource.Descriptor.usage()
+	if removed:
+		mainlog.note('Evicted %i entities, cache at %i bytes in %i entities',
+				removed, size, count)
+	return removed
+
+
+def schedule():
+	"Fiber that evicts entities every EVICT_INTERVAL seconds. "
+	counted = 0
+	while True:
+		try:
+			recount = time.time() - counted > Params.EVICT_RECOUNT
+			evict( recount )
+			if recount:
+				counted = time.time()
+		except Exception, e:
+			mainlog.err('Error: eviction failed: %s', e)
+		yield fiber.WAIT( Params.EVICT_INTERVAL )
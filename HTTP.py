@@ -1,3 +1,10 @@
+import calendar, time, zlib
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
 from HTTP_Status import *
 
 
@@ -143,3 +150,264 @@ def parse_content_range(content_range_spec):
 		assert instance_length == '*'
 	return bytes_range_response_spec, instance_length
 
+DATE_FORMATS = (
+	'%a, %d %b %Y %H:%M:%S GMT', # RFC 1123
+	'%A, %d-%b-%y %H:%M:%S GMT', # RFC 850
+	'%a %b %d %H:%M:%S %Y', # asctime
+)
+
+HEURISTIC_FRACTION = 0.1
+"Part of the time since Last-Modified a response is presumed fresh. "
+
+def parse_date(value):
+	"""
+	Return the HTTP-date as seconds since the epoch, or None if it is not in
+	any of the formats of RFC 2616 3.3.1.
+	"""
+	for fmt in DATE_FORMATS:
+		try:
+			return calendar.timegm( time.strptime( value.strip(), fmt ) )
+		except ValueError:
+			pass
+
+def parse_delta(value):
+	"""
+	Return delta-seconds as integer, or None if value is missing or invalid.
+	"""
+	if value and value.strip().isdigit():
+		return int( value )
+
+def parse_cache_control(value):
+	"""
+	Return the directives of a Cache-Control header as dict. Directives
+	without argument map to None.
+	"""
+	directives = {}
+	for directive in value.split( ',' ):
+		directive = directive.strip()
+		if not directive:
+			continue
+		if '=' in directive:
+			name, argument = directive.split( '=', 1 )
+			directives[ name.strip().lower() ] = argument.strip().strip( '"' )
+		else:
+			directives[ directive.lower() ] = None
+	return directives
+
+def parse_vary(value):
+	"""
+	Return the field names of a Vary header, lowercased and sorted.
+	"""
+	return sorted(set([ name.strip().lower()
+		for name in value.split( ',' ) if name.strip() ]))
+
+def variant_key(vary, headers):
+	"""
+	Return a key for the values of the request headers named by the Vary
+	field names, to select between stored variants [RFC 7234 4.1]. Values are
+	normalized by collapsing whitespace.
+	"""
+	headers = dict([ ( key.lower(), value ) for key, value in headers.items() ])
+	return '\n'.join([ '%s: %s' % ( name, ' '.join( headers.get( name, '' ).split() ) )
+		for name in vary ])
+
+CODINGS = [ 'gzip', 'deflate' ] + ( brotli and [ 'br' ] or [] )
+"Content-codings htcache can decode, and asks servers for. "
+
+def accepts_encoding(accept, coding):
+	"""
+	Return true if the Accept-Encoding header value allows the content-coding
+	[RFC 7231 5.3.4].
+	"""
+	qvalues = {}
+	for item in accept.split( ',' ):
+		params = item.split( ';' )
+		name = params.pop( 0 ).strip().lower()
+		if not name:
+			continue
+		qvalues[ name ] = 1.0
+		for param in params:
+			key, value = ( param.split( '=', 1 ) + [ '' ] )[ :2 ]
+			if key.strip().lower() == 'q':
+				try:
+					qvalues[ name ] = float( value )
+				except ValueError:
+					qvalues[ name ] = 0
+	coding = coding.lower()
+	if coding in qvalues:
+		return qvalues[ coding ] > 0
+	elif coding == 'gzip' and 'x-gzip' in qvalues:
+		return qvalues[ 'x-gzip' ] > 0
+	return qvalues.get( '*', 0 ) > 0
+
+def accepted_codings(accept):
+	"Return the content-codings htcache can decode that accept allows. "
+	return [ coding for coding in CODINGS if accepts_encoding( accept, coding ) ]
+
+
+class BrotliDecoder(object):
+
+	"Give brotli.Decompressor the interface of zlib decompression objects. "
+
+	def __init__(self):
+		self.__decompressor = brotli.Decompressor()
+
+	def decompress(self, data):
+		return self.__decompressor.process( data )
+
+	def flush(self):
+		return ''
+
+
+def decoder(coding):
+	"""
+	Return an object with decompress and flush methods to decode the
+	content-coding, or None if it is not supported.
+	"""
+	coding = coding.lower()
+	if coding in ( 'gzip', 'x-gzip' ):
+		return zlib.decompressobj( 16 + zlib.MAX_WBITS )
+	elif coding == 'deflate':
+		return zlib.decompressobj()
+	elif coding == 'br' and brotli:
+		return BrotliDecoder()
+
+def private(headers, authorized=False):
+	"""
+	Return true if a shared cache may not serve the response with headers
+	without revalidation: it is private, or it answers a request with
+	Authorization and does not allow that with public, s-maxage or
+	must-revalidate [RFC 7234 3, 3.2].
+	"""
+	directives = parse_cache_control( headers.get( 'Cache-Control', '' ) )
+	if 'private' in directives:
+		return True
+	return authorized and not ( 'public' in directives
+		or 's-maxage' in directives or 'must-revalidate' in directives )
+
+def freshness(headers, now=None, max_heuristic=None, authorized=False):
+	"""
+	Return the time the response with headers was generated, corrected for
+	its age, and the time until which it is fresh [RFC 7234 4.2]. Without
+	explicit expiration the lifetime is a fraction of the time since
+	Last-Modified, limited to max_heuristic seconds. A response that must be
+	revalidated, or that is private (see private), expires at its date.
+	"""
+	if now is None:
+		now = time.time()
+	directives = parse_cache_control( headers.get( 'Cache-Control', '' ) )
+	date = parse_date( headers.get( 'Date', '' ) ) or now
+	age = max( now - date, parse_delta( headers.get( 'Age' ) ) or 0, 0 )
+	date = now - age
+
+	if private( headers, authorized ):
+		lifetime = 0
+	elif 'no-cache' in directives or 'no-store' in directives or (
+			not directives and 'no-cache' in headers.get( 'Pragma', '' ) ):
+		lifetime = 0
+	elif 's-maxage' in directives:
+		lifetime = parse_delta( directives[ 's-maxage' ] ) or 0
+	elif 'max-age' in directives:
+		lifetime = parse_delta( directives[ 'max-age' ] ) or 0
+	elif 'Expires' in headers:
+		# invalid dates (ie. "0") mean already expired
+		expires = parse_date( headers[ 'Expires' ] )
+		lifetime = expires and expires - ( parse_date(
+			headers.get( 'Date', '' ) ) or now ) or 0
+	elif 'Last-Modified' in headers:
+		mtime = parse_date( headers[ 'Last-Modified' ] ) or date
+		lifetime = max( date - mtime, 0 ) * HEURISTIC_FRACTION
+		if max_heuristic is not None:
+			lifetime = min( lifetime, max_heuristic )
+	else:
+		lifetime = 0
+
+	return int( date ), int( date + max( lifetime, 0 ) )
+
+
+
+class ChunkedDecoder(object):
+
+	"""
+	Incremental decoder for the chunked transfer-coding (RFC 2616 3.6.1).
+
+	Received data is fed as-is. The chunk-size, chunk-end and trailer lines
+	are collected in a bytearray, chunk payloads are passed to `write` as
+	buffers on the received data, without copying or re-scanning. Chunk
+	extensions are ignored, trailer headers are kept in `trailers`.
+	"""
+
+	SIZE, DATA, DATA_END, TRAILER, DONE = range(5)
+	MAX_LINE = 4096
+
+	def __init__(self, write):
+		self.write = write
+		self.state = ChunkedDecoder.SIZE
+		self.remaining = 0
+		self.size = 0
+		self.trailers = {}
+		self.__line = bytearray()
+
+	@property
+	def done(self):
+		return self.state == ChunkedDecoder.DONE
+
+	def feed(self, data):
+		"""
+		Decode the next part of the message body, return the offset in data
+		where the message ended (or the length of data).
+		"""
+		pos, end = 0, len(data)
+		while pos < end and self.state != ChunkedDecoder.DONE:
+			if self.state == ChunkedDecoder.DATA:
+				bytecnt = min( self.remaining, end - pos )
+				self.write( buffer( data, pos, bytecnt ) )
+				pos += bytecnt
+				self.remaining -= bytecnt
+				self.size += bytecnt
+				if not self.remaining:
+					self.state = ChunkedDecoder.DATA_END
+				continue
+			eol = data.find( '\n', pos )
+			if eol == -1:
+				self.__line.extend( buffer( data, pos ) )
+				assert len( self.__line ) < self.MAX_LINE, \
+						'chunked data error: line exceeds %i bytes' % self.MAX_LINE
+				return end
+			self.__line.extend( buffer( data, pos, eol + 1 - pos ) )
+			pos = eol + 1
+			line = str( self.__line ).strip()
+			del self.__line[:]
+			self.__parse_line( line )
+		return pos
+
+	def __parse_line(self, line):
+		if self.state == ChunkedDecoder.SIZE:
+			# chunk-size [ chunk-extension ]
+			chunksize = int( line.split( ';', 1 )[ 0 ].strip(), 16 )
+			if chunksize:
+				self.remaining = chunksize
+				self.state = ChunkedDecoder.DATA
+			else:
+				self.state = ChunkedDecoder.TRAILER
+		elif self.state == ChunkedDecoder.DATA_END:
+			assert not line, \
+					'chunked data error: chunk does not match announced size'
+			self.state = ChunkedDecoder.SIZE
+		elif self.state == ChunkedDecoder.TRAILER:
+			if not line:
+				self.state = ChunkedDecoder.DONE
+			else:
+				key, value = line.split( ':', 1 )
+				key = Header_Map.get( key.lower(), key.title() )
+				self.trailers[ key ] = value.strip()
+
+
+def encode_chunk(data):
+	"""
+	Return data as a single chunk in chunked transfer-coding, an empty string
+	gives the last-chunk.
+	"""
+	if data:
+		return '%x\r\n%s\r\n' % ( len( data ), data )
+	return '0\r\n\r\n'
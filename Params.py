@@ -46,11 +46,48 @@ REWRITE_FILE = '/etc/htcache/rules.rewrite'
 PROXY_INJECT = False
 
 PARTIAL = '.incomplete'
+SEGMENTED = False
+PARALLEL_FETCH = 0
+PARALLEL_MIN_SIZE = 16*(1024**2)
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+PACK_MAX_SIZE = 16*1024
+MAX_CACHE_SIZE = 0
+MAX_CACHE_FILES = 0
+EVICTION = 'lru'
+ADMIT_HITS = 1
+ADMIT_MAX_SIZE = 0
+ADMIT_EXCLUDE = ''
+STALE_WHILE_REVALIDATE = 0
+STALE_IF_ERROR = 0
+PREFETCH = 0
+PREFETCH_LIMIT = 0
+RULES_POLL = 5
 DEFAULT = 'default'
 
 # XXX non user-configurable
 MAX_PATH_LENGTH = 256
 MAXCHUNK = 1448 # maximum lan packet?
+SEGMENT_POLL = 0.1 # wait for parallel segments
+SEGMENT_RETRIES = 2 # requests for the rest of a failed segment
+MAX_HEURISTIC_AGE = 24*3600 # limit freshness presumed from Last-Modified
+PREFETCH_AHEAD = 60 # revalidate popular entities so many seconds before expiry
+PREFETCH_INTERVAL = 10
+PREFETCH_MIN_HITS = 2
+PACK_SEGMENT_SIZE = 64*(1024**2) # start a new pack segment beyond this size
+PACK_COMPACT_RATIO = 0.5 # compact pack segments using less than this part
+OPEN_FILES = 256 # complete cache files kept open for reading
+EVICT_INTERVAL = 30
+EVICT_BATCH = 100
+EVICT_RECOUNT = 3600 # count the cache usage again, for changes by other processes
+ADMIT_SKETCH_WIDTH = 2**16 # counters per row of the admission sketch
+CHECK_CHECKPOINT = 'check-cache.json' # in DATA_DIR
+CHECK_CHECKPOINT_INTERVAL = 1000
+BLOB_PRUNE_AGE = 600 # keep unreferenced blobs changed so recently
+CACHE_PATHS_MARKER = 'cache-paths.built' # in DATA_DIR, once indexed
+POOL_POLL = 1 # seconds, keeps waits for process pool results interruptible
+QUERY_BATCH = 1000 # rows fetched at once by the query commands
+RULES_MEMO = 4096 # URLs for which rule matches and cache locations are kept
 TIMEFMT = '%a, %d %b %Y %H:%M:%S GMT'
 ALTTIMEFMT = '%a, %d %b %H:%M:%S CEST %Y' # XXX: foksuk.nl
 IMG_TYPE_EXT = 'png','jpg','gif','jpeg','jpe'
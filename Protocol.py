@@ -7,6 +7,7 @@ import calendar, os, time, socket, re
 
 import Params, Runtime, Response, Resource, Rules
 import HTTP
+import fiber
 #from util import *
 import log
 
@@ -47,11 +48,89 @@ def connect(addr):
 	return sock
 
 
+def fetch_segment(protocol, validator, start, end,
+		retries=Params.SEGMENT_RETRIES):
+
+	"""
+	Fiber to fetch bytes start up to end of the entity downloaded by protocol,
+	writing them at their offset into its segmented cache file.
+
+	Upon failure the missing bytes are requested again, up to retries times.
+	After that the main connection is told to continue past its own segment,
+	if it is still reading. Otherwise the entity stays partial.
+	"""
+
+	verb, path, proto = protocol.request.envelope
+	headers = protocol.request_headers.copy()
+	headers[ 'Range' ] = 'bytes=%i-%i' % ( start, end - 1 )
+	headers[ 'If-Range' ] = validator
+	sendbuf = '\r\n'.join( [ 'GET %s HTTP/1.1' % path ] +
+			map( ': '.join, headers.items() ) + [ '', '' ] )
+	sock = None
+	offset = start
+	try:
+		sock = connect( protocol.request.hostinfo )
+		while sendbuf:
+			yield fiber.SEND( sock, Params.TIMEOUT )
+			sendbuf = sendbuf[ sock.send( sendbuf ): ]
+
+		head = ''
+		while '\r\n\r\n' not in head:
+			yield fiber.RECV( sock, Params.TIMEOUT )
+			chunk = sock.recv( Params.MAXCHUNK )
+			assert chunk, 'server closed connection before sending '\
+					'a complete message header'
+			head += chunk
+		head, body = head.split( '\r\n\r\n', 1 )
+		lines = head.split( '\r\n' )
+		status = lines[ 0 ].split()
+		assert len( status ) > 1 and status[ 1 ] == str( HTTP.PARTIAL_CONTENT ), \
+				'expected partial content, not %r' % lines[ 0 ]
+		for line in lines[ 1: ]:
+			key, value = line.split( ':', 1 )
+			if key.strip().lower() == 'content-range':
+				spec, length = HTTP.parse_content_range( value.strip() )
+				assert spec == '%i-%i' % ( start, end - 1 ), \
+						'unexpected range %r' % value
+				break
+		else:
+			assert False, 'no Content-Range in partial content'
+
+		while offset < end:
+			if not body:
+				yield fiber.RECV( sock, Params.TIMEOUT )
+				body = sock.recv( Params.MAXCHUNK )
+				assert body, 'connection closed prematurely'
+			chunk = body[ :end - offset ]
+			protocol.cache.write_at( offset, chunk )
+			offset += len( chunk )
+			body = ''
+		mainlog.info('%s: Fetched segment %i-%i', protocol, start, end)
+
+	except Exception, e:
+		mainlog.err('%s: Segment %i-%i failed at %i: %s', protocol, start, end,
+				offset, e)
+		if retries:
+			protocol.segments += 1
+			fiber.launch( fetch_segment( protocol, validator, offset, end,
+				retries - 1 ) )
+		elif protocol.fetching():
+			protocol.fetch_end = None
+
+	if sock:
+		sock.close()
+	protocol.segments -= 1
+	if protocol.finished and not protocol.segments:
+		protocol.data.finish_response()
+
+
 class BlindProtocol:
 
 	"""
 	Blind protocol is used to aim for gracefull recovery upon unexpected
 	requests.
+
+	Any message body is relayed as it is received from the client.
 	"""
 
 	Response = None
@@ -60,7 +139,8 @@ class BlindProtocol:
 	def __init__(self, request):
 
 		self.__socket = connect( request.hostinfo )
-		self.__sendbuf = request.recvbuf()
+		self.__request = request
+		self.__sendbuf = request.recvbuf() + request.read_body()
 
 	def socket(self):
 
@@ -72,13 +152,15 @@ class BlindProtocol:
 
 	def hasdata(self):
 
-		return True
+		if not self.__sendbuf:
+			self.__sendbuf = self.__request.read_body()
+		return bool( self.__sendbuf ) or not self.__request.has_body()
 
 	def send(self, sock):
 
 		bytecnt = sock.send( self.__sendbuf )
 		self.__sendbuf = self.__sendbuf[ bytecnt: ]
-		if not self.__sendbuf:
+		if not self.__sendbuf and not self.__request.has_body():
 			self.Response = Response.BlindResponse
 
 	def done(self):
@@ -96,9 +178,12 @@ class CachingProtocol(object):
 
 	Response = None
 	"the htcache response class"
-	capture = None
-	"XXX: old indicator to track hashsum of response entity."
 	data = None
+	fetch_end = None
+	"offset where this connection stops writing, if others fetch the rest"
+	segments = 0
+	"number of parallel segment fetches still running"
+	finished = False
 
 	@property
 	def url(self):
@@ -186,13 +271,21 @@ class CachingProtocol(object):
 		return self.cache.read( pos, size )
 
 	def write(self, chunk):
+		if self.fetch_end != None:
+			chunk = chunk[ :max( self.fetch_end - self.cache.offset, 0 ) ]
 		return self.cache.write( chunk )
 
+	def fetching(self):
+		"False once this connection has written its part of a parallel fetch. "
+		return self.fetch_end == None or self.cache.offset < self.fetch_end
+
 	def tell(self):
 		return self.cache.tell()
 
 	def finish(self):
-		self.data.finish_response()
+		self.finished = True
+		if not self.segments:
+			self.data.finish_response()
 
 	def __str__(self):
 		return "[CachingProtocol %s]" % hex(id(self))
@@ -201,6 +294,7 @@ class CachingProtocol(object):
 class HttpProtocol(CachingProtocol):
 
 	rewrite = None
+	__socket = None
 
 	def __init__(self,request):
 		super(HttpProtocol, self).__init__(request)
@@ -217,6 +311,11 @@ class HttpProtocol(CachingProtocol):
 		# Prepare to forward request
 		self.data = Resource.ProxyData(self)
 
+		# Keep the validators of the client, these are not forwarded
+		self.conditions = dict([ ( key, request.headers[ key ] )
+			for key in ( 'If-None-Match', 'If-Modified-Since' )
+			if key in request.headers ])
+
 		# Skip server-round trip in static mode
 		if Runtime.STATIC: # and self.cache.full: # FIXME
 			mainlog.note('Static mode; serving file directly from cache')
@@ -227,6 +326,27 @@ class HttpProtocol(CachingProtocol):
 				self.Response = Response.NotFoundResponse
 			return
 
+		# Skip server round trip for byte ranges already in fresh cache
+		if verb == 'GET' and self.data.prepare_range( request ):
+			mainlog.note('%s: Serving range directly from cache', self)
+			self.__socket = None
+			self.Response = Response.DataResponse
+			return
+
+		# Skip server round trip while the stored entity is fresh
+		if verb == 'GET' and self.data.prepare_fresh( request ):
+			if self.data.stale:
+				import Refresh
+				mainlog.note('%s: Serving stale entity while revalidating', self)
+				headers = request.headers
+				headers.update( self.data.descriptor.validators() )
+				Refresh.start( request.url, headers )
+			else:
+				mainlog.note('%s: Serving fresh entity from cache', self)
+			self.__socket = None
+			self.Response = self.entity_response()
+			return
+
 		proxy_req_headers = self.data.prepare_request( request )
 
 		mainlog.debug("Prepared request headers")
@@ -240,10 +360,12 @@ class HttpProtocol(CachingProtocol):
 		try:
 			self.__socket = connect(request.hostinfo)
 		except Exception, e:
-			self.Response = Response.ExceptionResponse(self, request, e )
+			if not self.prepare_stale_response( e ):
+				self.Response = Response.ExceptionResponse(self, request, e )
 			return
 		self.__sendbuf = '\r\n'.join(
 			[ head ] + map( ': '.join, proxy_req_headers.items() ) + [ '', '' ] )
+		self.request_headers = proxy_req_headers
 		self.__recvbuf = ''
 		# Proxy protocol continues in self.recv after server response haders are
 		# parsed, before the response entity is read from the remote server
@@ -334,6 +456,12 @@ class HttpProtocol(CachingProtocol):
 # XXX: transfer-encoding, chunking.. to client too?
 
 		# Check wether to step back now
+		if '*' in HTTP.parse_vary( self.__args.get( 'Vary', '' ) ):
+			mainlog.note('%s: Not caching response that varies on anything', self)
+			self.Response = Response.BlindResponse
+			self.data.descriptor = None
+			return
+
 		if self.prepare_nocache_response():
 			self.data.descriptor = None
 			return
@@ -342,24 +470,35 @@ class HttpProtocol(CachingProtocol):
 		# 2xx
 		if self.__status in ( HTTP.OK, ):
 
-			mainlog.info("%s: Caching new download. ", self)
-			self.data.finish_request()
+			if self.data.exists():
+				mainlog.info("%s: Replacing changed entity. ", self)
+				self.data.renew_data()
+			elif not self.data.admit():
+				mainlog.note('%s: Not caching, entity not admitted', self)
+				self.Response = Response.BlindResponse
+				self.data.descriptor = None
+				return
+			else:
+				mainlog.info("%s: Caching new download. ", self)
+				self.data.finish_request()
 #			self.recv_entity()
 			self.set_dataresponse();
+			self.prepare_segments()
 
 		elif self.__status in ( HTTP.MULTIPLE_CHOICES, ):
 			assert False, HTTP.MULTIPLE_CHOICES
 
 		elif self.__status == HTTP.PARTIAL_CONTENT \
-				and self.cache.partial:
+				and ( self.cache.partial or self.cache.ranges != None ):
 			mainlog.debug("Updating partial download. ")
-			self.__args = self.data.prepare_response()
-			startpos, endpos = HTTP.parse_content_range(self.__args['Content-Range'])
-			assert endpos == '*' or endpos == self.data.descriptor.size, \
-					"Expected server to continue to end of resource."
-			if self.__args['ETag']:
-				assert self.__args['ETag'].strip('"') == self.data.descriptor.etag, (
-						self.__args['ETag'], self.data.descriptor.etag )
+			if self.data.descriptor.id:
+				self.__args = self.data.prepare_response()
+				startpos, endpos = HTTP.parse_content_range(self.__args['Content-Range'])
+				assert endpos == '*' or endpos == self.data.descriptor.size, \
+						"Expected server to continue to end of resource."
+				if self.__args.get('ETag'):
+					assert self.__args['ETag'].strip('"') == self.data.descriptor.etag, (
+							self.__args['ETag'], self.data.descriptor.etag )
 			self.recv_part()
 			self.set_dataresponse();
 
@@ -381,7 +520,7 @@ class HttpProtocol(CachingProtocol):
 			mainlog.info("Reading complete file from cache at %s" %
 					self.cache.path)
 			self.data.finish_request()
-			self.Response = Response.DataResponse
+			self.Response = self.entity_response()
 
 		# 4xx: client error
 		elif self.__status in ( HTTP.FORBIDDEN, HTTP.METHOD_NOT_ALLOWED ):
@@ -408,10 +547,60 @@ class HttpProtocol(CachingProtocol):
 #				log("Dropped descriptor: %s" % self.url)
 			self.Response = Response.BlindResponse
 
+		# 5xx: server error
+		elif self.__status >= 500 \
+				and self.prepare_stale_response( self.__status ):
+			pass
+
 		else:
 			mainlog.warn("Warning: unhandled: %s, %s", self.__status, self.url)
 			self.Response = Response.BlindResponse
 
+	def prepare_stale_response(self, reason):
+		"""
+		Serve the stored entity instead of an error when the server fails,
+		if it is not stale for longer than allowed. Returns true in that case.
+		"""
+		if not self.data or not self.data.prepare_stale( self.request ):
+			return False
+		mainlog.warn('%s: Serving stale entity, reason: %s', self, reason)
+		if self.__socket:
+			# Drop the connection of the failed response
+			self.__socket.close()
+		self.__socket = None
+		self.Response = Response.DataResponse
+		return True
+
+	def entity_response(self):
+		"Return the response class to serve the stored entity to the client. "
+		if self.data.not_modified( self.conditions ):
+			return Response.NotModifiedResponse
+		return Response.DataResponse
+
+	def prepare_segments(self):
+		"""
+		Split the rest of a large new download over parallel range requests.
+		This connection continues with the first segment only.
+		"""
+		n = Runtime.PARALLEL_FETCH
+		size = self.data.descriptor.size
+		if not n or n < 2 or self.cache.ranges == None or self.chunked \
+				or not size or size < Runtime.PARALLEL_MIN_SIZE:
+			return
+		if 'bytes' not in self.__args.get( 'Accept-Ranges', '' ):
+			return
+		validator = self.__args.get( 'ETag' ) or self.__args.get( 'Last-Modified' )
+		if not validator:
+			# XXX: cannot ensure the segments are from the same entity
+			return
+		seglen = ( size + n - 1 ) / n
+		self.fetch_end = seglen
+		mainlog.note("%s: Fetching %i segments of %i bytes", self, n, seglen)
+		for start in range( seglen, size, seglen ):
+			self.segments += 1
+			fiber.launch( fetch_segment( self, validator,
+				start, min( start + seglen, size ) ) )
+
 #	def recv_entity(self):
 #		"""
 #		Prepare to receive new entity.
@@ -437,6 +626,14 @@ class HttpProtocol(CachingProtocol):
 				'unhandled content-range type: %s' % byterange
 		byterange, size = byterange[ 6: ].split( '/' )
 		beg, end = byterange.split( '-' )
+		if self.cache.ranges != None:
+			# Segmented file, write range at its offset
+			if self.data.descriptor.id:
+				self.data.open_cache( int( beg ) )
+			else:
+				self.data.finish_request( int( beg ) )
+			self.size = int( size )
+			return
 		self.size = int( size )
 		# Sanity check
 		assert self.size == int( end ) + 1, \
@@ -626,6 +823,8 @@ class ProxyProtocol:
 
 	Response = Response.ProxyResponse
 	data = None
+	buffer_body = True
+	"Control requests are answered using the complete message body. "
 
 	def __init__(self,request):
 		method, reqname, proto = request.envelope
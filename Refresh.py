@@ -0,0 +1,143 @@
+"""
+Background fibers that bring stored entities up to date while clients are
+served from the cache, see stale-while-revalidate in RFC 5861.
+
+The scheduler also revalidates popular entities shortly before they expire.
+All background requests share the concurrency and bandwidth budget.
+"""
+import time
+
+import Params, Runtime, Request, Resource, Response
+import fiber
+import log
+
+
+mainlog = log.get_log('main')
+
+RUNNING = set()
+"URLs being revalidated. "
+
+
+class Budget:
+
+	"""
+	Bandwidth shared by background fibers. Each receive is charged at
+	MAXCHUNK bytes, the most it reads.
+	"""
+
+	def __init__(self):
+		self.__next = 0
+
+	def wait(self):
+		"Return the seconds to wait before the next receive. "
+		if not Runtime.PREFETCH_LIMIT:
+			return 0
+		return max( self.__next - time.time(), 0 )
+
+	def spend(self, size):
+		if Runtime.PREFETCH_LIMIT:
+			self.__next = max( self.__next, time.time() ) \
+					+ size / ( Runtime.PREFETCH_LIMIT * 1024.0 )
+
+BUDGET = Budget()
+
+
+class NullClient:
+
+	"""
+	Stands in for the client socket of a background request, and discards
+	the response.
+	"""
+
+	def send(self, data):
+		return len( data )
+
+	def close(self):
+		pass
+
+
+def start(url, headers):
+	"""
+	Launch a fiber to revalidate the entity at url, unless that is already
+	running. Headers are those of the client request if there is one,
+	updated with the validators of the stored entity.
+	"""
+	if url in RUNNING:
+		return
+	RUNNING.add( url )
+	fiber.launch( revalidate( url, headers ) )
+
+
+def schedule():
+	"""
+	Fiber that revalidates the most requested entities before they expire,
+	running at most PREFETCH revalidations at once.
+	"""
+	while True:
+		free = Runtime.PREFETCH - len( RUNNING )
+		if free > 0:
+			now = time.time()
+			for descriptor in Resource.Descriptor.find_expiring(
+					now, now + Params.PREFETCH_AHEAD,
+					Params.PREFETCH_MIN_HITS, free + len( RUNNING ) ):
+				if free and descriptor.resource.url not in RUNNING:
+					mainlog.info('Prefetching %s, %i hits, expires in %is',
+							descriptor.resource.url, descriptor.hits,
+							descriptor.expires - now)
+					headers = descriptor.variant_headers()
+					headers.update( descriptor.validators() )
+					start( descriptor.resource.url, headers )
+					free -= 1
+		yield fiber.WAIT( Params.PREFETCH_INTERVAL )
+
+
+def revalidate(url, headers):
+	"""
+	Fiber to request url with the given headers and max-age=0, so the
+	protocol revalidates or refetches the entity and updates the cache.
+	"""
+	headers = headers.copy()
+	for key in ( 'Range', 'If-Range', 'Pragma', 'Date', 'Via' ):
+		headers.pop( key, None )
+	headers[ 'Cache-Control' ] = 'max-age=0'
+
+	refresh = Request.HttpRequest()
+	refresh.background = True
+	refresh.feed( '\r\n'.join( [ 'GET http:%s HTTP/1.1' % url ]
+		+ map( ': '.join, headers.items() ) + [ '', '' ] ) )
+	client = NullClient()
+	try:
+		protocol = refresh.Protocol( refresh )
+		server = protocol.socket()
+		while not protocol.Response:
+			if protocol.hasdata():
+				yield fiber.SEND( server, Params.TIMEOUT )
+				protocol.send( server )
+			else:
+				yield fiber.RECV( server, Params.TIMEOUT )
+				protocol.recv( server )
+
+		if isinstance( protocol.Response, Response.DirectResponse ):
+			response = protocol.Response
+		else:
+			response = protocol.Response( protocol, refresh )
+			server = protocol.socket()
+		while not response.Done:
+			if response.hasdata():
+				response.send( client )
+			elif response.needwait():
+				yield fiber.WAIT( response.needwait() )
+			elif BUDGET.wait():
+				yield fiber.WAIT( BUDGET.wait() )
+			else:
+				yield fiber.RECV( server, Params.TIMEOUT )
+				response.recv( server )
+				BUDGET.spend( Params.MAXCHUNK )
+		response.finalize( client )
+		mainlog.note('Revalidated %s: %s', url, response)
+
+	except Exception, e:
+		mainlog.err('Error: revalidating %s failed: %s', url, e)
+
+	RUNNING.discard( url )
+
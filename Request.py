@@ -26,14 +26,17 @@ class HttpRequest:
 	a regular MIME message. The parser expects an HTTP-esque request line and
 	request headers.
 
-	Once the entire request including message body has been read and buffered, 
-	HtRequest.recv() wil finish and choose the appropiate Protocol for fiber to 
-	continue with.
-
-	XXX: HtRequest may want to skip buffering large uploads into memory.
+	Once the request header has been read, HtRequest.recv() wil finish and
+	choose the appropiate Protocol for fiber to continue with. The message body
+	is not buffered but streamed: the Protocol relays what has been received
+	through read_body(), and fiber calls recv_body() once that is exhausted.
+	Only a Protocol that sets `buffer_body` (one that needs the complete body)
+	gets it spooled into a temporary file before recv() finishes.
 	"""
 
 	Protocol = None
+	background = False
+	"true for requests htcache makes itself, without client"
 
 	def __init__(self):
 
@@ -41,6 +44,10 @@ class HttpRequest:
 		self.__recvbuflen = 0
 		self.__recvbuf = ''
 		self.__scheme = self.__host = self.__port = self.__reqpath = None
+		self.__protocol = None
+		self.__size = self.__bodypos = 0
+		self.__bodybuf = ''
+		self.__body = None
 
 	def __parse_head(self, chunk):
 
@@ -90,15 +97,16 @@ class HttpRequest:
 			self.__headers[ key ] = value.strip()
 		elif line in ( '\r\n', '\n' ):
 			self.__size = int( self.__headers.get( 'Content-Length', 0 ) )
+			self.__body = None
+			self.__parse = None
+			self.__route()
 			if self.__size:
-				assert self.__verb == 'POST', \
+				assert self.__verb in ( 'POST', 'PUT' ), \
 						'%s request conflicts with message body' % self.__verb
-				mainlog.info('Opening temporary file for POST upload')
-				self.__body = os.tmpfile()
-				self.__parse = self.__parse_body
-			else:
-				self.__body = None
-				self.__parse = None
+				if getattr( self.__protocol, 'buffer_body', False ):
+					mainlog.info('Opening temporary file for %s upload', self.__verb)
+					self.__body = os.tmpfile()
+					self.__parse = self.__parse_body
 		else:
 			mainlog.info('Error: Ignored header line: %r', line)
 
@@ -106,13 +114,14 @@ class HttpRequest:
 
 	def __parse_body(self, chunk):
 		"""
-		Parse request body.
+		Spool request body, for protocols that need it complete.
 		"""
 
 		self.__body.write( chunk )
-		assert self.__body.tell() <= self.__size, \
+		self.__bodypos = self.__body.tell()
+		assert self.__bodypos <= self.__size, \
 				'message body exceeds content-length'
-		if self.__body.tell() == self.__size:
+		if self.__bodypos == self.__size:
 			self.__parse = None
 
 		return len( chunk )
@@ -121,7 +130,9 @@ class HttpRequest:
 
 		"""
 		Receive request from client, parsing header and optional body. 
-		Once parsers have finished, determine Protocol type for htcache/fiber.
+		Once the header is parsed the Protocol type is determined, which
+		becomes available to htcache/fiber as soon as the body no longer needs
+		to be read here.
 
 		The Protocol instance takes over and relays this request to the 
 		target server.
@@ -137,6 +148,15 @@ class HttpRequest:
 				'complete message header at %s, ' \
 				'parser: %r, data: %r' % (
 						self.__recvbuflen, self.__parse, self.__recvbuf)
+		self.feed( chunk )
+
+	def feed(self, chunk):
+
+		"""
+		Parse request data as read from the client by recv, or prepared by
+		htcache itself (see Refresh).
+		"""
+
 		self.__recvbuf += chunk
 		self.__recvbuflen += len(chunk)
 		while self.__parse:
@@ -144,9 +164,24 @@ class HttpRequest:
 			if not bytecnt:
 				return
 			self.__recvbuf = self.__recvbuf[ bytecnt: ]
+
+		if self.__size and not self.__body:
+			# Stream the body, what is left is the first part of it
+			self.__bodybuf, self.__recvbuf = self.__recvbuf, ''
+			self.__bodypos = len( self.__bodybuf )
+			assert self.__bodypos <= self.__size, \
+					'message body exceeds content-length'
 		assert not self.__recvbuf, 'client sends junk data after message header'
 
-		# Headers are parsed, determine target server and resource
+		self.Protocol = self.__protocol
+
+	def __route(self):
+
+		"""
+		Headers are parsed, determine target server and resource and the
+		Protocol type to use.
+		"""
+
 		verb, proxied_url, proto = self.__verb, self.__requri, self.__prototag
 
 		scheme = ''
@@ -157,9 +192,9 @@ class HttpRequest:
 		# Accept http and ftp proxy requests
 		if proxied_url.startswith( 'http://' ):
 			if verb == 'GET':
-				self.Protocol = Protocol.HttpProtocol
+				self.__protocol = Protocol.HttpProtocol
 			else:
-				self.Protocol = Protocol.BlindProtocol
+				self.__protocol = Protocol.BlindProtocol
 			scheme = 'http'
 			host = proxied_url[ 7: ]
 			port = 80
@@ -167,7 +202,7 @@ class HttpRequest:
 		elif proxied_url.startswith( 'ftp://' ):
 			assert verb == 'GET', \
 					'%s request unsupported for ftp' % verb
-			self.Protocol = Protocol.FtpProtocol
+			self.__protocol = Protocol.FtpProtocol
 			scheme = 'ftp'
 			host = proxied_url[ 6: ]
 			port = 21
@@ -177,11 +212,11 @@ class HttpRequest:
 		elif proxied_url.startswith( '/' ):
 			path = proxied_url
 			host = socket.gethostname()
-			self.Protocol = Protocol.ProxyProtocol
+			self.__protocol = Protocol.ProxyProtocol
 
 		else:
 			# XXX self.Protocol = Protocol.BlindProtocol
-			self.Protocol = Protocol.HttpProtocol
+			self.__protocol = Protocol.HttpProtocol
 			scheme = ''
 			host = '' 
 			port = Runtime.PORT
@@ -204,7 +239,7 @@ class HttpRequest:
 			localhosts = ( 'localhost', Runtime.HOSTNAME, '127.0.0.1', '127.0.1.1' )
 			assert host in localhosts, "Cannot service for %s, use from %s" % (host, localhosts)
 			#self.Response = Response.DirectResponse
-			self.Protocol = Protocol.ProxyProtocol
+			self.__protocol = Protocol.ProxyProtocol
 
 		mainlog.debug('scheme=%s, host=%s, port=%s, path=%s', scheme, host, port, path)
 
@@ -255,6 +290,42 @@ class HttpRequest:
 
 		return '\r\n'.join( lines )
 
+	def has_body(self):
+
+		"""
+		Return true while the client has not sent all of a streamed message
+		body.
+		"""
+
+		return self.__bodypos < self.__size
+
+	def recv_body(self, sock):
+
+		"""
+		Receive the next part of the message body from the client. This is
+		only called once the Protocol has relayed what was read before, so
+		the upload proceeds at the pace of the server.
+		"""
+
+		assert self.has_body()
+		chunk = sock.recv( min( Params.MAXCHUNK, self.__size - self.__bodypos ) )
+		assert chunk, \
+				'client closed connection before sending a '\
+				'complete message body at %i of %i bytes' % (
+						self.__bodypos, self.__size)
+		self.__bodybuf += chunk
+		self.__bodypos += len( chunk )
+
+	def read_body(self):
+
+		"""
+		Return and clear the part of a streamed message body that has been
+		received but not yet relayed.
+		"""
+
+		chunk, self.__bodybuf = self.__bodybuf, ''
+		return chunk
+
 # XXX:
 #	def is_conditional(self):
 #		return ( 'If-Modified-Since' in self.__headers
@@ -1,7 +1,7 @@
 """
 Resource storage and descriptor facade.
 """
-import anydbm, os, urlparse
+import anydbm, hashlib, multiprocessing, os, re, signal, urlparse
 import time
 import calendar
 from os.path import join
@@ -14,10 +14,11 @@ except AssertionError:
 
 from sqlalchemy import Column, Integer, String, Boolean, Text, \
 	ForeignKey, Table, Index, DateTime, Float, \
-	create_engine
+	create_engine, event, func, inspect, or_, select
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy.orm import relationship, backref, sessionmaker, \
+	contains_eager, column_property
 
 import Cache
 import Params
@@ -32,6 +33,9 @@ import log
 
 mainlog = log.get_log('main')
 
+ADMISSION = None
+"Request counts of uncached URLs, see ProxyData.admit. "
+
 
 class ProxyData(object):
 
@@ -77,6 +81,8 @@ class ProxyData(object):
 		self.cache = None
 
 		self.mtime = None
+		self.stale = False
+		self.variants = []
 
 		mainlog.debug("%s: empty instance", self)
 
@@ -160,24 +166,73 @@ class ProxyData(object):
 	def init_data(self, url):
 		"""
 		Fetch existing or pre-initialize new Descriptor instance
-		before we have any content data available.
+		before we have any content data available. Of the variants stored
+		for url, the one selected by the request headers is used.
 		XXX: The associated resource should be initalized later.
 		"""
 		assert not self.descriptor or not ( self.descriptor.mtime or self.descriptor.path or self.descriptor.size ), ( self.descriptor.mtime, self.descriptor.path, self.descriptor.size )
 
-		self.descriptor = Descriptor.find_latest(url)
+		self.descriptor = None
+		self.variants = Descriptor.find_variants(url)
+		for descriptor in self.variants:
+			if not descriptor.vary \
+					or descriptor.variant == self.variant_key( descriptor.vary ):
+				self.descriptor = descriptor
+				break
 		if not self.descriptor or not self.descriptor.id:
 			self.descriptor = Descriptor()
 			mainlog.debug('%s: Initialized new descriptor. ', self)
 		else:
 			mainlog.debug('%s: Found existing descriptor for %r ', self, self.descriptor.path)
 
+	def variant_key( self, vary ):
+		"Return the variant key of the request for the stored Vary field list. "
+		return variant_key( HTTP.parse_vary( vary ), self.protocol.request.headers )
+
+	def admit( self ):
+		"""
+		Return true to store the new entity the server sent. It must not be
+		larger than ADMIT_MAX_SIZE or of an ADMIT_EXCLUDE mediatype, and its
+		URL must have been requested ADMIT_HITS times recently. Entities the
+		client needs decoded are always stored.
+		"""
+		global ADMISSION
+		args = self.protocol.args()
+		encoding = args.get( 'Content-Encoding' )
+		if encoding and not HTTP.accepts_encoding(
+				self.protocol.request.headers.get( 'Accept-Encoding', '' ),
+				encoding ):
+			return True
+		size = args.get( 'Content-Length' )
+		if Runtime.ADMIT_MAX_SIZE and size \
+				and int( size ) > Runtime.ADMIT_MAX_SIZE:
+			return False
+		mediatype = args.get( 'Content-Type', '' ).split( ';' )[ 0 ].strip().lower()
+		for prefix in ( Runtime.ADMIT_EXCLUDE or '' ).split( ',' ):
+			if prefix.strip() and mediatype.startswith( prefix.strip().lower() ):
+				return False
+		if Runtime.ADMIT_HITS > 1:
+			if not ADMISSION:
+				ADMISSION = CountMinSketch( Params.ADMIT_SKETCH_WIDTH )
+			return ADMISSION.add( self.protocol.url ) >= Runtime.ADMIT_HITS
+		return True
+
 	def exists( self ):
 		return self.descriptor != None and self.descriptor.id != None
 
 	def is_open( self ):
 		return self.cache and self.cache.fp != None
 
+	def init_ranges( self ):
+		"""
+		Load the map of byte ranges present for segmented partial files.
+		"""
+		if not Runtime.SEGMENTED or self.cache.full:
+			return
+		self.cache.ranges = Cache.RangeMap.parse( self.descriptor.ranges or '' )
+		if self.cache.partial and not self.descriptor.ranges:
+			self.cache.ranges.add( 0, self.cache.size )
+
 	def init_cache( self, netpath=None ):
 		"""
 		The location will be subject to the specific heuristics of the backend
@@ -189,9 +244,12 @@ class ProxyData(object):
 			mainlog.info( '%s: Prepped cache, position: %s',
 					self, self.cache.abspath() )
 
-	def open_cache( self ):
+	def open_cache( self, offset=0 ):
 		assert self.cache.path
-		self.cache.open()
+		if self.cache.ranges != None:
+			self.cache.open_segment( offset )
+		else:
+			self.cache.open()
 		self.cache.stat()
 
 	def move( self ):
@@ -206,6 +264,60 @@ class ProxyData(object):
 		self.descriptor = None
 		mainlog.debug("%s: closed ", self)
 
+	def renew_data(self):
+		"""
+		Server sent a new entity for an existing descriptor. Reset the
+		descriptor from the response headers, and write the entity to a new
+		partial file that replaces the complete file once finished.
+		"""
+		self.descriptor.size = None
+		self.descriptor.etag = None
+		self.descriptor.encoding = None
+		self.descriptor.hash = None
+		self.descriptor.ranges = None
+		self.update_data()
+		self.update_freshness()
+		if self.cache.ranges != None:
+			self.cache.ranges = Cache.RangeMap()
+			self.open_cache()
+		else:
+			self.cache.open_replacement()
+
+	def update_freshness(self):
+		"""
+		Store when the server response was generated, and until when it may be
+		served without revalidation [RFC 7234 4.2].
+		"""
+		resp_headers = self.protocol.args()
+		if 'Last-Modified' not in resp_headers and self.descriptor.mtime:
+			resp_headers[ 'Last-Modified' ] = self.get_last_modified()
+		authorized = 'Authorization' in self.protocol.request.headers
+		self.descriptor.date, self.descriptor.expires = HTTP.freshness(
+				resp_headers, max_heuristic=Params.MAX_HEURISTIC_AGE,
+				authorized=authorized )
+		directives = HTTP.parse_cache_control( resp_headers.get( 'Cache-Control', '' ) )
+		if 'must-revalidate' in directives or 'proxy-revalidate' in directives \
+				or 'no-cache' in directives \
+				or HTTP.private( resp_headers, authorized ):
+			self.descriptor.stale_while_revalidate = 0
+			self.descriptor.stale_if_error = 0
+		else:
+			self.descriptor.stale_while_revalidate = HTTP.parse_delta(
+					directives.get( 'stale-while-revalidate' ) )
+			self.descriptor.stale_if_error = HTTP.parse_delta(
+					directives.get( 'stale-if-error' ) )
+		mainlog.debug( '%s: fresh until %s', self, self.descriptor.expires )
+
+	def get_stale_window(self, name):
+		"""
+		Return the seconds the entity may be served after it expired for the
+		descriptor attribute name, or the default from Runtime.
+		"""
+		window = getattr( self.descriptor, name )
+		if window == None:
+			window = getattr( Runtime, name.upper() ) or 0
+		return window
+
 	def set_data(self, attribute, value):
 		assert not getattr( self.descriptor, attribute ), attribute
 		setattr( self.descriptor, attribute, value )
@@ -215,6 +327,9 @@ class ProxyData(object):
 		if not self.descriptor.resource:
 			self.descriptor.resource = Resource()
 		resp_headers = self.protocol.args()
+		vary = ', '.join( HTTP.parse_vary( resp_headers.get( 'Vary', '' ) ) )
+		self.descriptor.vary = vary or None
+		self.descriptor.variant = vary and self.variant_key( vary ) or None
 		mediatype = resp_headers.get( 'Content-Type', None )
 		if not mediatype:
 			resp_headers['Content-Type'] = 'application/octet-stream'
@@ -238,6 +353,7 @@ class ProxyData(object):
 	header_data_map = {
 #		'allow': (str,'resource.allow'),
 		'content-length': (int, 'size'),
+		'content-encoding': (str, 'encoding'),
 		'content-language': (str, 'language'),
 #		'content-location': (str,'resource.location'),
 # XXX:'content-md5': (str,'content.md5'),
@@ -296,11 +412,152 @@ class ProxyData(object):
 			headerdict.update({
 				'ETag': '"%s"' % self.descriptor.etag,
 			})
+		if self.descriptor.encoding:
+			headerdict.update({
+				'Content-Encoding': self.descriptor.encoding,
+			})
 		return headerdict
 
 
 	## Proxy lifecycle hooks
 
+	def matches_validator( self, validator ):
+		"""
+		Compare entity-tag or HTTP-date validator (ie. from If-Range) with
+		the cached entity.
+		"""
+		validator = validator.strip()
+		if validator.startswith( 'W/' ):
+			# weak tags never match for ranges [RFC 2616 14.27]
+			return False
+		elif validator.startswith( '"' ):
+			return validator.strip( '"' ) == self.descriptor.etag
+		return validator == self.get_last_modified()
+
+	def not_modified( self, conditions ):
+		"""
+		Evaluate the conditional request headers of the client against the
+		stored entity. Return true if the client copy is still current
+		[RFC 7232 3.2, 3.3].
+		"""
+		if 'If-None-Match' in conditions:
+			tags = [ tag.strip() for tag in conditions[ 'If-None-Match' ].split( ',' ) ]
+			if '*' in tags:
+				return True
+			# weak comparison
+			tags = [ tag.replace( 'W/', '', 1 ).strip( '"' ) for tag in tags ]
+			return bool( self.descriptor.etag ) and self.descriptor.etag in tags
+		elif 'If-Modified-Since' in conditions:
+			since = HTTP.parse_date( conditions[ 'If-Modified-Since' ] )
+			return since != None and self.descriptor.mtime <= since
+		return False
+
+	def prepare_range( self, request ):
+		"""
+		Open cache if the byte range requested by the client is present in the
+		complete or partial file, so it can be served without server round
+		trip. Return true in that case. The stored entity must be fresh, see
+		get_staleness.
+		"""
+		req_headers = request.headers
+		htrange = req_headers.get( 'Range', None )
+		if not htrange or htrange[ 6: ].startswith( '-' ):
+			# no range or suffix range
+			return False
+
+		self.init_data( self.protocol.url )
+		stale = self.get_staleness( request )
+		if self.descriptor.id and self.descriptor.path \
+				and stale != None and stale < 0:
+			self.init_cache( )
+			self.cache.path = self.descriptor.path.replace( Runtime.PARTIAL, '' )
+			if self.cache.stat():
+				self.init_ranges()
+				if 'If-Range' not in req_headers \
+						or self.matches_validator( req_headers[ 'If-Range' ] ):
+					pos, end = request.range()
+					size = self.descriptor.size
+					if size != None and ( end == -1 or end > size ):
+						# up to the last byte [RFC 7233 2.1]
+						end = size
+					if self.cache.ranges != None:
+						present = end and self.cache.ranges.covers( pos, end )
+					else:
+						present = end and pos < end <= self.cache.size
+					if present:
+						mainlog.info( '%s: Range %i-%i present in cache',
+								self, pos, end )
+						self.open_cache( pos )
+						return True
+
+		self.close()
+		return False
+
+	def get_staleness( self, request ):
+		"""
+		Return for how many seconds the stored entity has been stale, negative
+		while it is fresh. Returns None if it may not be served to request
+		without the server: the client asked to reload [RFC 7234 5.2.1.4],
+		the entity is older than the client's max-age or has no freshness.
+		"""
+		req_headers = request.headers
+		directives = HTTP.parse_cache_control( req_headers.get( 'Cache-Control', '' ) )
+		if 'no-cache' in directives or ( not directives
+				and 'no-cache' in req_headers.get( 'Pragma', '' ) ):
+			return None
+		if not self.descriptor.expires:
+			return None
+		now = time.time()
+		age = now - ( self.descriptor.date or now )
+		max_age = HTTP.parse_delta( directives.get( 'max-age' ) )
+		if max_age != None and age > max_age:
+			return None
+		return now - self.descriptor.expires
+
+	def prepare_fresh( self, request ):
+		"""
+		Open cache if the complete entity is stored and still fresh, so it can
+		be served without server round trip [RFC 7234 4]. Return true in that
+		case. Within the stale-while-revalidate window [RFC 5861 3] the
+		entity is served too, and `stale` is set.
+		"""
+		self.init_data( self.protocol.url )
+		stale = self.get_staleness( request )
+		if self.descriptor.id and stale != None \
+				and self.descriptor.path \
+				and Runtime.PARTIAL not in self.descriptor.path:
+			if stale < 0 or \
+					stale < self.get_stale_window( 'stale_while_revalidate' ):
+				self.init_cache( )
+				self.cache.path = self.descriptor.path
+				if self.cache.stat() and self.cache.full:
+					mainlog.info( '%s: Fresh for %i more seconds', self, -stale )
+					self.stale = stale >= 0
+					self.open_cache()
+					return True
+
+		self.close()
+		return False
+
+	def prepare_stale( self, request ):
+		"""
+		Open cache if the complete entity may be served while the server
+		fails, within the stale-if-error window [RFC 5861 4]. Return true in
+		that case.
+		"""
+		directives = HTTP.parse_cache_control(
+				request.headers.get( 'Cache-Control', '' ) )
+		if 'no-cache' in directives or 'max-age' in directives:
+			return False
+		if not self.descriptor or not self.descriptor.id or not self.cache \
+				or not self.cache.full or self.is_open():
+			return False
+		stale = time.time() - ( self.descriptor.expires or 0 )
+		if stale > self.get_stale_window( 'stale_if_error' ):
+			return False
+		self.open_cache()
+		return True
+
 	def prepare_request( self, request ):
 		"""
 		Protocol is about to proxy the request, prepare the cache
@@ -318,6 +575,8 @@ class ProxyData(object):
 			abspath = self.cache.abspath()
 			self.set_data( 'path', self.cache.path )
 			self.set_data( 'mtime', time.time() )
+			if Runtime.SEGMENTED:
+				self.cache.ranges = Cache.RangeMap()
 			mainlog.debug( '%s: Prepared descriptor at %r', self, abspath )
 
 		else:
@@ -326,20 +585,30 @@ class ProxyData(object):
 			self.init_cache( )
 			self.cache.path = self.descriptor.path.replace( Runtime.PARTIAL, '' )
 			self.cache.stat()
+			self.init_ranges()
 			mainlog.debug( 'Existing descriptor at %r', self.descriptor.path )
 
-		# XXX: should it do something with encoding?
-		req_headers.pop( 'Accept-Encoding', None )
+		# Store encoded entities, and decode for later clients that need it.
+		# Only ask for codings this client accepts, responses that are not
+		# stored are relayed as is (see Protocol.HttpProtocol.recv).
+		codings = HTTP.accepted_codings( req_headers.get( 'Accept-Encoding', '' ) )
+		if codings:
+			req_headers[ 'Accept-Encoding' ] = ', '.join( codings )
+		else:
+			req_headers.pop( 'Accept-Encoding', None )
 		# TODO: RFC 2616 14.35.2 Range requests and partial content response
 		htrange = req_headers.pop( 'Range', None )
-		# TODO: RFC 2616 14.9.4: Cache revalidation and reload controls
+		if htrange and self.cache.ranges != None and not self.descriptor.exists() \
+				and not htrange[ 6: ].startswith( '-' ):
+			# Segmented storage can start with the range the client wants
+			req_headers[ 'Range' ] = htrange
+		# Client reload controls were handled by prepare_fresh [RFC 7234 5.2.1]
 		cache_control = req_headers.pop( 'Cache-Control', None )
 		# TODO: Store relationship with
 		relationtype = req_headers.pop('X-Relationship', None)
 		# XXX: anonymize, check with [RFC 2616 14.36]
 		referer = req_headers.get('Referer', None)
-		# FIXME: Client may have a cache too that needs to be
-		# validated by the proxy.
+		# Client validators are answered by the proxy, see not_modified
 		req_headers.pop( 'If-None-Match', None )
 		req_headers.pop( 'If-Modified-Since', None )
 
@@ -351,7 +620,21 @@ class ProxyData(object):
 			if ( self.cache.partial or self.cache.full ):
 				mdtime = self.get_last_modified()
 
-			if self.cache.partial:
+			if self.cache.partial and self.cache.ranges != None:
+				# Request the part missing from the range the client wants
+				pos, end = request.range()
+				if end == -1 or end > self.descriptor.size:
+					end = self.descriptor.size
+				holes = self.cache.ranges.missing( pos, end ) or \
+						self.cache.ranges.missing( 0, self.descriptor.size ) or \
+						[ ( 0, self.descriptor.size ) ]
+				mainlog.note('Requesting missing segments of partial file in cache: '
+						'%s, %s', holes, mdtime )
+				req_headers[ 'Range' ] = 'bytes=%i-%i' % (
+						holes[ 0 ][ 0 ], holes[ -1 ][ 1 ] - 1 )
+				req_headers[ 'If-Range' ] = mdtime
+
+			elif self.cache.partial:
 				assert self.cache.size < self.descriptor.size, \
 						( "Illegal state: file should have been completed, missing %s bytes, cache is %r",
 								self.descriptor.size-self.cache.size, self.cache.size )
@@ -362,17 +645,16 @@ class ProxyData(object):
 
 			elif self.cache.full:
 				mainlog.info( 'Checking complete file in cache: %s', mdtime )
-				req_headers[ 'If-Modified-Since' ] = mdtime
-				if self.descriptor.etag:
-					req_headers[ 'If-None-Match' ] = '"%s"' % self.descriptor.etag
+				req_headers.update( self.descriptor.validators() )
 
 
 		return req_headers
 
-	def finish_request( self ):
+	def finish_request( self, offset=0 ):
 		"""
 		Protocol has parsed then response headers and determined the appropiate
-		Response type.
+		Response type. For segmented files, offset is where the received
+		entity (range) starts.
 		"""
 
 		mainlog.info ("%s: Completing request phase", self)
@@ -391,16 +673,24 @@ class ProxyData(object):
 			# set new data
 			self.update_data()
 			#assert self.descriptor.etag
+			if self.descriptor.vary:
+				# Store apart from the other variants of this URL
+				self.cache.set_variant( self.descriptor.variant )
+				self.descriptor.path = self.cache.path
 
 			res = Resource().find( Resource.url == self.protocol.url )
-			if not res:
+			if res:
+				# Another variant of a known resource
+				self.descriptor.resource = res
+			else:
 				if not self.descriptor.resource.url:
 					self.descriptor.resource.url = self.protocol.url
 		else:
 			assert self.cache.path == self.descriptor.path, (
 					self.cache.abspath(), self.descriptor, self.cache.path)
 
-		self.open_cache()
+		self.update_freshness()
+		self.open_cache( offset )
 		mainlog.info("%s: open_cache %s", self, self.cache.partial or
 						self.cache.full)
 
@@ -414,6 +704,8 @@ class ProxyData(object):
 		#		size=self.protocol.size,
 		#		protohdr=args,
 		#	)
+		if self.descriptor.date:
+			args[ 'Age' ] = str( max( int( time.time() ) - self.descriptor.date, 0 ) )
 		via = "%s:%i" % (Runtime.HOSTNAME, Runtime.PORT)
 		if args.setdefault('Via', via) != via:
 			args['Via'] += ', '+ via
@@ -421,25 +713,30 @@ class ProxyData(object):
 		return args
 
 	def finish_response( self ):
-		size = self.cache.tell()
+		if self.cache.ranges != None:
+			# Complete when the present bytes start at zero up to the end
+			size = self.cache.ranges.contiguous( 0 )
+			self.descriptor.ranges = str( self.cache.ranges )
+		else:
+			size = self.cache.tell()
 		mainlog.info("%s: finish_response at cache.tell=%i", self, size)
+		if not self.protocol.request.background:
+			self.descriptor.hits = ( self.descriptor.hits or 0 ) + 1
+			self.descriptor.atime = int( time.time() )
 		if not self.descriptor.size:
 			mainlog.debug("%s Updated descriptor size from cache pointer %s", self, self.cache)
 			self.descriptor.size = size
 		if size == self.descriptor.size:
 			self.cache.stat()
 			if self.cache.partial:
-				abspath = os.path.join( Runtime.ROOT, self.cache.path )
-				assert abspath == self.cache.full_path()
-				partial_path = self.cache.partial_path()
-				assert os.path.exists( partial_path ), partial_path
-				assert partial_path == Cache.suffix_ext( abspath, Runtime.PARTIAL )
-				os.rename( partial_path, abspath )
-				os.utime( abspath, ( self.descriptor.mtime, self.descriptor.mtime ) )
-				mainlog.note("%s: Finalized %r at %i", self, abspath, size )
-				self.descriptor.path = self.cache.path
+				self.descriptor.hash = self.cache.digest()
+				self.descriptor.path = self.cache.finalize( self.descriptor.mtime )
+				mainlog.note("%s: Finalized %r at %i", self, self.descriptor.path, size )
+				self.descriptor.ranges = None
 				assert Runtime.PARTIAL not in self.descriptor.path
 				self.descriptor.commit()
+				CachePath.record( self.descriptor.path, size,
+						self.descriptor.mtime, self.descriptor.id )
 		elif size > self.descriptor.size:
 			mainlog.note("%s: Error: Too much data for %s: %s bytes", self, self.descriptor.path, size )
 			mainlog.crit("%s: Too much data for %s: %s bytes", self, self.descriptor.path, size )
@@ -451,6 +748,8 @@ class ProxyData(object):
 			assert Runtime.PARTIAL in self.descriptor.path
 			assert not self.descriptor.path.startswith(Runtime.ROOT), self.descriptor.path
 			self.descriptor.commit()
+			CachePath.record( self.descriptor.path, size,
+					self.descriptor.mtime, self.descriptor.id )
 
 		#print self, 'finish_response, tell=%i, meta.size=%i, file.size=%i, meta.mtime=%s, file.mtime=%s' % (
 		#				size, self.descriptor.size, self.cache.size,\
@@ -607,15 +906,40 @@ class Descriptor(SqlBase, SessionMixin):
 	resource = relationship( Resource,
 #			primaryjoin=resource_id==Resource.id,
 			backref='descriptors')
-	path = Column(String(255), nullable=True)
+	# Old values are kept for the USAGE totals, see count_usage
+	path = column_property(Column(String(255), nullable=True, index=True),
+			active_history=True)
 	mediatype = Column(String(255), nullable=False)
 	mediatype_auth = Column(Boolean, nullable=False)
 	charset = Column(String(255), nullable=True)
 	language = Column(String(255), nullable=True)
-	size = Column(Integer, nullable=True)
+	size = column_property(Column(Integer, nullable=True),
+			active_history=True)
 	mtime = Column(Integer, nullable=False)
 	quality = Column(Float, nullable=True)
 	etag = Column(String(255), nullable=True)
+	ranges = Column(Text, nullable=True)
+	"Byte ranges present in segmented partial file, see Cache.RangeMap. "
+	date = Column(Integer, nullable=True)
+	"Time the stored response was generated, corrected for its age. "
+	expires = Column(Integer, nullable=True)
+	"Time until which the entity is fresh. "
+	stale_while_revalidate = Column(Integer, nullable=True)
+	"Seconds the entity may be served while revalidating after it expired. "
+	stale_if_error = Column(Integer, nullable=True)
+	"Seconds the entity may be served when the server fails after it expired. "
+	hits = Column(Integer, nullable=True)
+	"Number of times the entity was served to clients. "
+	atime = Column(Integer, nullable=True, index=True)
+	"Last time the entity was served to a client. "
+	encoding = Column(String(255), nullable=True)
+	"Content-coding of the stored entity. "
+	vary = Column(String(255), nullable=True)
+	"Lowercased field names of the Vary response header, see HTTP.parse_vary. "
+	variant = Column(Text, nullable=True)
+	"Key of the request header values that selected this variant. "
+	hash = Column(String(40), nullable=True)
+	"SHA1 hex digest of the complete entity as stored. "
 #	key_names = [id]
 
 	def copyDict(self):
@@ -630,21 +954,133 @@ class Descriptor(SqlBase, SessionMixin):
 			quality=self.quality,
 			mtime=self.mtime,
 			mediatype=self.mediatype,
-			mediatype_auth=self.mediatype_auth
+			mediatype_auth=self.mediatype_auth,
+			ranges=self.ranges,
+			date=self.date,
+			expires=self.expires,
+			stale_while_revalidate=self.stale_while_revalidate,
+			stale_if_error=self.stale_if_error,
+			hits=self.hits,
+			atime=self.atime,
+			encoding=self.encoding,
+			vary=self.vary,
+			variant=self.variant,
+			hash=self.hash
 		)
 
 	def __str__(self):
 		return "Descriptor(%s)" % pformat(self.copyDict())
 
+	def validators(self):
+		"Return request headers to validate the stored entity with the server. "
+		headers = { 'If-Modified-Since': time.strftime(
+			Params.TIMEFMT, time.gmtime( self.mtime ) ) }
+		if self.etag:
+			headers[ 'If-None-Match' ] = '"%s"' % self.etag
+		return headers
+
+	@staticmethod
+	def find_expiring( now, until, hits, limit ):
+		"""
+		Return up to limit complete entities served at least hits times that
+		expire between now and until, most requested first. Entities with a
+		freshness lifetime shorter than until - now are left out.
+		"""
+		return get_backend().query(Descriptor)\
+			.join("resource").filter(
+				Descriptor.expires > now,
+				Descriptor.expires <= until,
+				Descriptor.expires - Descriptor.date >= until - now,
+				Descriptor.hits >= hits,
+				~Descriptor.path.contains( Runtime.PARTIAL )
+			).order_by(
+				Descriptor.hits.desc(), Descriptor.expires
+			).limit( limit ).all()
+
+	def variant_headers(self):
+		"Return the request headers that select this variant. "
+		headers = {}
+		for line in ( self.variant or '' ).split( '\n' ):
+			if ': ' in line:
+				name, value = line.split( ': ', 1 )
+				if value:
+					headers[ HTTP.Header_Map.get( name, name.title() ) ] = value
+		return headers
+
 	@staticmethod
-	def find_latest( url ):
-		descriptor = get_backend().query(Descriptor)\
+	def find_variants( url ):
+		return get_backend().query(Descriptor)\
 			.join("resource").filter(
 				Resource.url == url
 			).order_by(
 				Descriptor.mtime
-			).first()
-		return descriptor
+			).all()
+
+	@staticmethod
+	def usage( recount=False ):
+		"""
+		Return the total size and number of the stored locations. Locations
+		shared by descriptors (ie. blobs) count once. These are counted once,
+		or again with recount, and then kept up to date as descriptors are
+		flushed (see count_usage).
+		"""
+		if recount or not USAGE:
+			session = get_backend()
+			paths = session.query( Descriptor.path,
+					func.max( Descriptor.size ).label( 'size' )
+				).filter( Descriptor.path != None ).group_by(
+					Descriptor.path ).subquery()
+			size, count = session.query( func.sum( paths.c.size ),
+					func.count() ).select_from( paths ).one()
+			USAGE[:] = [ size or 0, count ]
+		return tuple( USAGE )
+
+	@staticmethod
+	def find_victims( limit ):
+		"""
+		Return up to limit stored entities in the order to evict them: least
+		recently served first, or with EVICTION 'lfu' least served first.
+		"""
+		if Runtime.EVICTION == 'lfu':
+			order = Descriptor.hits, Descriptor.atime
+		else:
+			order = Descriptor.atime,
+		return get_backend().query(Descriptor)\
+			.filter( Descriptor.path != None )\
+			.order_by( *order ).limit( limit ).all()
+
+	def remove(self):
+		"""
+		Delete the stored entity and this descriptor, and the resource if it
+		has no other variants. Blobs stay while other descriptors reference
+		them, packed data is left for compact-packs.
+		"""
+		import caches
+		session = get_backend()
+		abspath = os.path.join( Runtime.ROOT, self.path )
+		shared = session.query( Descriptor ).filter(
+				Descriptor.path == self.path ).count() > 1
+		if not shared and not caches.parse_pack_path( self.path ) \
+				and os.path.exists( abspath ):
+			os.remove( abspath )
+			Cache.invalidate( abspath )
+		if not shared:
+			session.query(CachePath).filter( CachePath.path == self.path )\
+				.delete( synchronize_session=False )
+		else:
+			# List the location under one of the other descriptors
+			other, = session.query( Descriptor.id ).filter(
+					Descriptor.path == self.path,
+					Descriptor.id != self.id ).first()
+			session.query(CachePath).filter(
+					CachePath.descriptor_id == self.id ).update(
+					{ 'descriptor_id': other }, synchronize_session=False )
+		if self.resource and len( self.resource.descriptors ) == 1:
+			session.delete( self.resource )
+		session.delete( self )
+		session.commit()
+
+Index( 'descriptors_hits_atime', Descriptor.hits, Descriptor.atime )
 
 
 class Relation(SqlBase, SessionMixin):
@@ -666,6 +1102,48 @@ class Relation(SqlBase, SessionMixin):
 		))
 
 
+class CachePath(SqlBase, SessionMixin):
+	"""
+	Index of the locations in the cache, kept up to date by the proxy when
+	it writes files, so maintenance commands need not walk the cache root.
+	See iter_cache_paths.
+	"""
+	__tablename__ = 'cache_paths'
+	path = Column(String(255), primary_key=True)
+	size = Column(Integer, nullable=True)
+	mtime = Column(Integer, nullable=True)
+	descriptor_id = Column(Integer, ForeignKey(Descriptor.id), nullable=True,
+			index=True)
+	"Descriptor of the location, if any. "
+
+	@staticmethod
+	def record( path, size, mtime, descriptor_id ):
+		"""
+		Update the entry for path, and drop other locations of the
+		descriptor (ie. its partial file). A path shared by descriptors (ie.
+		a blob) stays listed under the descriptor it was first recorded for.
+		"""
+		session = get_backend()
+		if descriptor_id:
+			session.query(CachePath).filter(
+					CachePath.descriptor_id == descriptor_id,
+					CachePath.path != path ).delete( synchronize_session=False )
+		entry = session.query(CachePath).get( path )
+		if entry and entry.descriptor_id:
+			descriptor_id = entry.descriptor_id
+		session.merge( CachePath( path=path, size=size,
+			mtime=mtime and int( mtime ), descriptor_id=descriptor_id ) )
+		session.commit()
+
+	def __str__(self):
+		return "CachePath(%s)" % pformat(dict(
+			path=self.path,
+			size=self.size,
+			mtime=self.mtime,
+			descriptor_id=self.descriptor_id
+		))
+
+
 
 #/FIXME
 
@@ -683,168 +1161,295 @@ def get_backend(name='default', read_only=False):
 		_backends[name] = backend
 	return backend
 
+USAGE = []
+"Running total size and count of the stored entities, see Descriptor.usage"
+
+def count_usage(session, context):
+	"""
+	Update USAGE for the descriptors flushed by session. A location counts
+	while one or more descriptors refer to it.
+	"""
+	if not USAGE:
+		return
+	connection = session.connection()
+	def refs(path):
+		return connection.execute( select([ func.count() ]).where(
+			Descriptor.__table__.c.path == path ) ).scalar()
+	for descriptor in session.new | session.dirty | session.deleted:
+		if not isinstance( descriptor, Descriptor ):
+			continue
+		state = inspect( descriptor )
+		old, new = [], []
+		for name in 'path', 'size':
+			history = state.attrs[ name ].history
+			new.append(( history.added or history.unchanged or [ None ] )[ 0 ])
+			if state.pending:
+				old.append( None )
+			else:
+				old.append(( history.deleted or history.unchanged
+					or [ None ] )[ 0 ])
+		if descriptor in session.deleted:
+			new = None, None
+		( old_path, old_size ), ( new_path, new_size ) = old, new
+		if old_path == new_path:
+			if new_path != None and new_size != old_size \
+					and refs( new_path ) == 1:
+				USAGE[ 0 ] += ( new_size or 0 ) - ( old_size or 0 )
+			continue
+		if old_path != None and not refs( old_path ):
+			USAGE[ 0 ] -= old_size or 0
+			USAGE[ 1 ] -= 1
+		if new_path != None and refs( new_path ) == 1:
+			USAGE[ 0 ] += new_size or 0
+			USAGE[ 1 ] += 1
+
 def get_session(dbref, initialize=False):
 	engine = create_engine(dbref)#, encoding='utf8')
 	#engine.raw_connection().connection.text_factory = unicode
 	if initialize:
+		if CachePath.__tablename__ not in inspect( engine ).get_table_names() \
+				and os.path.exists( cache_paths_marker() ):
+			# New or upgraded database, the index must be built
+			os.remove( cache_paths_marker() )
 		mainlog.debug("Applying SQL DDL to DB %s ", dbref)
 		SqlBase.metadata.create_all(engine) # issue DDL create
+		upgrade_schema(engine)
 		mainlog.info("Updated data schema")
 	session = sessionmaker(bind=engine)()
+	event.listen( session, 'after_flush', count_usage )
 	return session
 
+def upgrade_schema(engine):
+	"""
+	Add the columns and indices missing from tables created by an earlier
+	version, create_all only creates tables that do not exist yet.
+	"""
+	inspector = inspect(engine)
+	for table in SqlBase.metadata.sorted_tables:
+		existing = [ column['name'] for column in
+				inspector.get_columns( table.name ) ]
+		for column in table.columns:
+			if column.name in existing:
+				continue
+			mainlog.note("Adding column %s.%s", table.name, column.name)
+			engine.execute( 'ALTER TABLE %s ADD COLUMN %s %s' % ( table.name,
+				column.name, column.type.compile( engine.dialect ) ) )
+		indices = [ index['name'] for index in
+				inspector.get_indexes( table.name ) ]
+		for index in table.indexes:
+			if index.name not in indices:
+				mainlog.note("Adding index %s", index.name)
+				index.create( engine )
+
 
 ###
 
 
+def variant_key(vary, headers):
+	"""
+	Return the key of the variant that the request headers select, for the
+	Vary field names of a stored entity. Accept-Encoding is left out, it is
+	always forwarded the same (see ProxyData.prepare_request).
+	"""
+	return HTTP.variant_key( vary, dict([ ( key, value )
+		for key, value in headers.items()
+		if key.lower() != 'accept-encoding' ]) )
+
+def download_key(request):
+	"""
+	Return the key for the download of request in DOWNLOADS: the URL and
+	the variant key over the Vary fields stored for it, so that requests
+	selecting different variants do not join the same download.
+	"""
+	vary = set()
+	for descriptor in Descriptor.find_variants( request.url ):
+		vary.update( HTTP.parse_vary( descriptor.vary or '' ) )
+	return request.url, variant_key( sorted( vary ), request.headers )
+
+
 # Query commands
 
+def _timestamp(value):
+	"Parse seconds since the epoch, or a YYYY-MM-DD[THH:MM:SS] UTC date. "
+	if value.isdigit():
+		return int( value )
+	for fmt in '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d':
+		try:
+			return calendar.timegm( time.strptime( value, fmt ) )
+		except ValueError:
+			pass
+	raise ValueError, "Cannot parse time %r" % value
+
+def query_descriptors(*criteria):
+	"""
+	Return a query for descriptors with their resource joined in, restricted
+	by the query options (MEDIATYPE, MIN_SIZE, MAX_SIZE, HOST, SINCE, UNTIL)
+	and the given criteria. Rows are ordered by resource and fetched in
+	batches, so that large result sets are streamed.
+	"""
+	query = get_backend().query( Descriptor ).join( Descriptor.resource )\
+			.options( contains_eager( Descriptor.resource ) )
+	if Runtime.MEDIATYPE:
+		if '/' in Runtime.MEDIATYPE:
+			query = query.filter( Descriptor.mediatype == Runtime.MEDIATYPE )
+		else:
+			query = query.filter( Descriptor.mediatype.like(
+				Runtime.MEDIATYPE + '/%' ) )
+	if Runtime.MIN_SIZE:
+		query = query.filter( Descriptor.size >= Runtime.MIN_SIZE )
+	if Runtime.MAX_SIZE:
+		query = query.filter( Descriptor.size <= Runtime.MAX_SIZE )
+	if Runtime.HOST:
+		query = query.filter( or_(
+			Resource.url.like( '//%s/%%' % Runtime.HOST ),
+			Resource.url.like( '//%s:%%' % Runtime.HOST ) ) )
+	if Runtime.SINCE:
+		query = query.filter( Descriptor.mtime >= _timestamp( Runtime.SINCE ) )
+	if Runtime.UNTIL:
+		query = query.filter( Descriptor.mtime < _timestamp( Runtime.UNTIL ) )
+	if criteria:
+		query = query.filter( *criteria )
+	return query.order_by( Resource.id, Descriptor.id )\
+			.yield_per( Params.QUERY_BATCH )
+
+def print_descriptors(descriptors):
+	"""
+	Print each resource followed by its descriptors, or with JSON set one
+	object per descriptor and line.
+	"""
+	resource_id = None
+	for descriptor in descriptors:
+		if Runtime.JSON:
+			record = descriptor.copyDict()
+			record[ 'url' ] = descriptor.resource.url
+			print json_write( record )
+			continue
+		if descriptor.resource_id != resource_id:
+			resource_id = descriptor.resource_id
+			print descriptor.resource
+		print '\t', str(descriptor).replace('\n', '\n\t')
+
 def print_records():
-	rs = get_backend().query(Resource).all()
-	for res in rs:
-		print res
-		for d in res.descriptors:
-			print '\t', str(d).replace('\n', '\n\t')
+	print_descriptors( query_descriptors() )
 
 def print_record(url):
-	get_backend()
-	res = Resource().fetch(Resource.url == url)
-	print res
-	for d in res.descriptors:
-		print '\t', str(d).replace('\n', '\n\t')
+	print_descriptors( query_descriptors( Resource.url == url ) )
 
 def list_locations():
-	backend = get_backend()
-	for res in backend.query(Resource).all():
-		for d in res.descriptors:
-			print d.path
-	backend.close()
+	if Runtime.MEDIATYPE or Runtime.MIN_SIZE or Runtime.MAX_SIZE \
+			or Runtime.HOST or Runtime.SINCE or Runtime.UNTIL:
+		for descriptor in query_descriptors( Descriptor.path != None ):
+			if Runtime.JSON:
+				print json_write( dict( path=descriptor.path,
+					size=descriptor.size, mtime=descriptor.mtime ) )
+			else:
+				print descriptor.path
+		return
+	for entry in iter_cache_paths():
+		if Runtime.JSON:
+			print json_write( dict( path=entry.path, size=entry.size,
+				mtime=entry.mtime ) )
+		else:
+			print entry.path
 
 def list_urls():
-	backend = get_backend()
-	for url in backend.resources:
-		res = backend.find(url)
-		print res.url
+	resource_id = None
+	for descriptor in query_descriptors():
+		if descriptor.resource_id == resource_id:
+			continue
+		resource_id = descriptor.resource_id
+		if Runtime.JSON:
+			print json_write( dict( id=resource_id,
+				url=descriptor.resource.url ) )
+		else:
+			print descriptor.resource.url
 
 def print_location(url):
-	backend = get_backend()
-	netpath = url[5:]
-	res = Resource().fetch(Resource.url == netpath)
-	for d in res.descriptors:
-		print d.path
-
+	for descriptor in query_descriptors( Resource.url == url[5:] ):
+		print descriptor.path
 
-# TODO: find_records by attribute query
 def find_records(q):
-	import sys
-	backend = get_backend()
-	print 'Searching for', q
-
-	attrpath, valuepattern = q.split(':')
-
-	for path in backend:
-		res = backend[path]
-		urls, mime, qs, n, meta, feats = res
-		for u in urls:
-			if q in u:
-				print path, mime, urls
-#		for k in props:
-#			if k in ('0','srcref'):
-#				if props[k] in res[0]:
-#					print path
-#			elif k in ('1','mediatype'):
-#				if props[k] == res[1]:
-#					print path
-#			elif k in ('2','charset'):
-#				if props[k] == res[2]:
-#					print path
-#			elif k in ('3','language'):
-#				if props[k] in res[3]:
-#					print path
-#			elif k in ('4','feature'):
-#				for k2 in props[k]:
-#					if k2 not in res[4]:
-#						continue
-#					if res[4][k2] == props[k][k2]:
-#						print path
-	backend.close()
-	mainlog.debug("End of findinfo")
-
-
-# TODO: integrate with other print_info
+	"""
+	Print the records where the URL or descriptor attribute KEY matches
+	the regular expression PATTERN. Both the query options and the KEY are
+	applied, the pattern is matched while streaming the rows.
+	"""
+	key, pattern = q.split(':', 1)
+	if key != 'url' and key not in Descriptor.__table__.columns:
+		raise ValueError, "No such descriptor attribute %r" % key
+	regex = re.compile( pattern )
+	def match(descriptor):
+		if key == 'url':
+			value = descriptor.resource.url
+		else:
+			value = getattr( descriptor, key )
+		return value is not None and regex.search( unicode( value ) )
+	print_descriptors( descriptor for descriptor in query_descriptors()
+			if match( descriptor ) )
+
 def print_info(*paths):
-	backend = get_backend()
 	import sys
 	recordcnt = 0
 	for path in paths:
-		if not path.startswith(os.sep):
-			path = Params.ROOT + path
-#		path = path.replace(Params.ROOT, '')
-		if path not in backend:
+		if path.startswith( Runtime.ROOT ):
+			path = path[ len( Runtime.ROOT ): ]
+		descriptors = list( query_descriptors( Descriptor.path == path ) )
+		if not descriptors:
 			mainlog.debug("Unknown cache location: %s", path)
-		else:
-			print path, backend.find(path)
-			recordcnt += 1
+		print_descriptors( descriptors )
+		recordcnt += len( descriptors )
 	if recordcnt > 1:
 		print >>sys.stderr, "Found %i records for %i paths" % (recordcnt,len(paths))
 	elif recordcnt == 1:
 		print >>sys.stderr, "Found one record"
 	else:
 		print >>sys.stderr, "No record found"
-	backend.close()
-
 
 def print_media_list(*media):
 	"document, application, image, audio or video (or combination)"
-	backend = get_backend()
 	for m in media:
-		# TODO: documents
-		if m == 'image':
-			for path in backend:
-				res = backend[path]
-				if 'image' in res[1]:
-					print path
-		if m == 'audio':
-			for path in backend:
-				res = backend[path]
-				if 'audio' in res[1]:
-					print path
-		if m == 'videos':
-			for path in backend:
-				res = backend[path]
-				if 'video' in res[1]:
-					print path
-
-def check_data(cache, uripathnames, mediatype, d1, d2, meta, features):
+		for descriptor in query_descriptors(
+				Descriptor.mediatype.like( m + '/%' ) ):
+			print descriptor.path
+
+def check_data(descriptor):
 	"""
 	References in descriptor cache must exist as file.
 	This checks existence and the size property, if complete.
-
-	All rules should be applied.
 	"""
-	if not Params.LOG_LEVEL:
-		Params.LOG_LEVEL = 1
-	pathname = cache.path
-	if cache.partial:
-		pathname += '.incomplete'
-	if not (cache.partial or cache.full):
-		mainlog.info("Missing %s" % pathname)
+	if not descriptor.path:
+		mainlog.info("No location for %s", descriptor.id)
+		return
+	import caches
+	pack = caches.parse_pack_path( descriptor.path )
+	if pack:
+		segment = caches.get_pack_store().segment_path( pack[ 0 ] )
+		if not os.path.isfile( segment ) \
+				or os.path.getsize( segment ) < pack[ 1 ] + pack[ 2 ]:
+			mainlog.err("Corrupt file: %s, missing packed data", segment)
+			return
+		return True
+	pathname = os.path.join( Runtime.ROOT, descriptor.path )
+	if not os.path.isfile( pathname ):
+		mainlog.info("Missing %s", pathname)
 		return
-	if 'Content-Length' not in meta:
-		mainlog.info("Missing content length of %s" % pathname)
+	if Runtime.PARTIAL in descriptor.path:
+		return True
+	if descriptor.size == None:
+		mainlog.info("Missing content length of %s", pathname)
 		return
-	length = int(meta['Content-Length'])
-	if cache.full() and os.path.getsize(pathname) != length:
-		mainlog.err("Corrupt file: %s, size should be %s" % (pathname, length))
+	if os.path.getsize( pathname ) != descriptor.size:
+		mainlog.err("Corrupt file: %s, size should be %s", pathname,
+				descriptor.size)
 		return
 	return True
 
-def validate_cache(pathname, uripathnames, mediatype, d1, d2, meta, features):
+def validate_cache():
 	"""
 	Descriptor properties must match those of file.
-	This recalculates the files checksum.
+	This is check_cache recalculating every checksum, without the checkpoint.
 	"""
-	return True
+	return not check_cache( resume=False )
 
 def check_tree(pathname, uripathnames, mediatype, d1, d2, meta, features):
 	return True
@@ -860,127 +1465,386 @@ def get_cache(netpath=None, backend_type=None):
 	if netpath:
 		assert netpath[:2] == '//', netpath
 		ref = Rules.Join.rewrite(netpath)
-		cache.init( ref )
+		# Locations in ARCHIVE depend on the time
+		key = ( backend_type, ref )
+		if not Runtime.ARCHIVE and key in Rules.MEMO:
+			cache.init_path( Rules.MEMO[ key ] )
+		else:
+			cache.init( ref )
+			if not Runtime.ARCHIVE:
+				Rules.MEMO[ key ] = cache.path
 	return cache
 
-def check_files():
-	backend = SessionMixin.get_instance(True)
-# XXX old
-	#if Params.PRUNE:
-	#	descriptors = SessionMixin.get_instance()
-	#else:
-	#	descriptors = SessionMixin.get_instance(main=False)
-	pcount, rcount = 0, 0
-	mainlog.info("Iterating paths in cache root location. ")
-
-	for root, dirs, files in os.walk(Params.ROOT):
-
-		# Ignore files in root
-		if not root[len(Params.ROOT):]:
+def link_dupes():
+	"""
+	Hard link complete files in the cache with the same content, comparing
+	size and then SHA1 digest. The digest is taken from the descriptor
+	where known.
+	"""
+	sizes = {}
+	for descriptor in get_backend().query(Descriptor).filter(
+			Descriptor.size > 0 ):
+		if not descriptor.path or Runtime.PARTIAL in descriptor.path:
 			continue
-
-#		rdir = os.path.join(Params.ROOT, root)
-		for f in dirs + files:
-			f = os.path.join(root, f)
-			#if path_ignore(f):
-			#	continue
-			pcount += 1
-			if f not in backend.descriptors:
-				if os.path.isfile(f):
-					mainlog.warn("Missing descriptor for %s" % f)
-					if Runtime.PRUNE:
-						size = os.path.getsize(f)
-						if size < Runtime.MAX_SIZE_PRUNE:
-							os.unlink(f)
-							mainlog.warn("Removed unknown file %s" % f)
-						else:
-							mainlog.note("Keeping %sMB" % (size / (1024 ** 2)))#, f))
-				elif not (os.path.isdir(f) or os.path.islink(f)):
-					mainlog.warn("Unrecognized path %s" % f)
-			elif f in backend.descriptors:
-				rcount += 1
-				descr = backend.descriptors[f]
-				assert isinstance(descr, Record)
-				uriref = descr[0][0]
-				mainlog.info("Found resource %s" % uriref, threshold=1)
-# XXX: hardcoded paths.. replace once Cache/Resource is properly implemented
-				port = 80
-				if len(descr[0]) != 1:
-					mainlog.note("Multiple references %s" % f)
-					continue
-				urlparts = urlparse.urlparse(uriref)
-				hostname = urlparts.netloc
-				pathname = urlparts.path[1:]
-# XXX: cannot reconstruct--, or should always normalize?
-				if urlparts.query:
-					#print urlparts
-					pathname += '?'+urlparts.query
-				netpath = "//%s%s" % ( hostname, pathname )
-				cache = get_cache(netpath)
-				#print 'got cache', cache.getsize(), cache.path
-# end
-	mainlog.note("Finished checking %s cache locations, found %s resources" % (
-		pcount, rcount))
-	backend.close()
-
-def check_cache():
-	#term = Resource.TerminalController()
-	#print term.render('${YELLOW}Warning:${NORMAL}'), 'paper is crinkled'
-	#pb = Resource.ProgressBar(term, 'Iterating descriptors')
-#	if Params.PRUNE:
-#		descriptors = SessionMixin.get_instance()
-#	else:
-#		descriptors = SessionMixin.get_instance(main=False)
-	backend = SessionMixin.get_instance(True)
-
-	refs = backend.descriptors.keys()
-	count = len(refs)
-	log("Iterating %s descriptors" % count)
-	for i, ref in enumerate(refs):
-		mainlog.debug("%i, %s" % (i, ref))
-		descr = backend.descriptors[ref]
-		log("Record data: [%s] %r" %(ref, descr.data,), 2)
-		urirefs, mediatype, d1, d2, meta, features = descr
-		#progress = float(i)/count
-		#pb.update(progress, ref)
-# XXX: hardcoded paths.. replace once Cache/Resource is properly implemented
-		port = 80
-		if len(urirefs) != 1:
-			log("Multiple references %s" % ref)
+		abspath = os.path.join( Runtime.ROOT, descriptor.path )
+		if os.path.isfile( abspath ):
+			sizes.setdefault( descriptor.size, {} )[ abspath ] = descriptor.hash
+	count = 0
+	for size, paths in sizes.items():
+		if len( paths ) < 2:
+			continue
+		digests = {}
+		for abspath in sorted( paths ):
+			digest = paths[ abspath ] or Cache.file_digest( abspath )
+			if digest not in digests:
+				digests[ digest ] = abspath
+			elif not os.path.samefile( digests[ digest ], abspath ):
+				os.link( digests[ digest ], abspath + Runtime.PARTIAL )
+				os.rename( abspath + Runtime.PARTIAL, abspath )
+				mainlog.info("Linked %s to %s", abspath, digests[ digest ])
+				count += 1
+	mainlog.note("Linked %i duplicate files", count)
+
+def migrate_cache(backend_type):
+	"""
+	Move the file of each descriptor to its location for backend_type and
+	update the descriptor path. Blobs of caches.ContentAddressed may be
+	shared and are linked instead, see prune_blobs.
+	"""
+	import caches
+	count = 0
+	for descriptor in get_backend().query(Descriptor).all():
+		if not descriptor.path or not descriptor.resource:
+			continue
+		cache = get_cache( descriptor.resource.url, backend_type )
+		if descriptor.vary:
+			# Keep variants of one URL apart, see ProxyData.finish_request
+			cache.set_variant( descriptor.variant )
+		path = cache.path
+		if Runtime.PARTIAL in descriptor.path:
+			path = Cache.suffix_ext( path, Runtime.PARTIAL )
+		if path == descriptor.path:
+			continue
+		source = os.path.join( Runtime.ROOT, descriptor.path )
+		target = os.path.join( Runtime.ROOT, path )
+		pack = caches.parse_pack_path( descriptor.path )
+		if not pack and not os.path.isfile( source ):
+			mainlog.warn("Missing %s", source)
 			continue
-		urlparts = urlparse.urlparse(urirefs[0])
-		hostname = urlparts.netloc
-		pathname = urlparts.path[1:]
-# XXX: cannot reconstruct--, or should always normalize?
-		if urlparts.query:
-			pathname += '?'+urlparts.query
-		netpath = "//%s%s" % ( hostname, pathname )
-		cache = get_cache(netpath)
-# end
-		act = None
-		if not check_data(cache, *descr):
-			if not Params.PRUNE:
+		if os.path.exists( target ):
+			mainlog.warn("Not replacing %s with %s", target, source)
+			continue
+		tdir = os.path.dirname( target )
+		if not os.path.exists( tdir ):
+			os.makedirs( tdir )
+		if pack:
+			# Packed data stays until compact-packs
+			open( target, 'wb' ).write( caches.get_pack_store().read( *pack ) )
+		elif descriptor.path.startswith( caches.BLOB_DIR + os.sep ):
+			os.link( source, target )
+		else:
+			os.rename( source, target )
+		mainlog.info("Moved %s to %s", descriptor.path, path)
+		descriptor.path = path
+		descriptor.commit()
+		CachePath.record( path, descriptor.size, descriptor.mtime, descriptor.id )
+		count += 1
+	mainlog.note("Moved %i files to %s locations", count, backend_type)
+
+def compact_packs():
+	"""
+	Copy the entities in segments of caches.Packed that are used for less
+	than PACK_COMPACT_RATIO to the last segment, and remove the old
+	segments. The last segment is never compacted.
+	"""
+	import caches
+	store = caches.get_pack_store()
+	packed = {}
+	for descriptor in get_backend().query(Descriptor).filter(
+			Descriptor.path.like( caches.PACK_DIR + os.sep + '%' ) ):
+		pack = caches.parse_pack_path( descriptor.path )
+		if pack:
+			packed.setdefault( pack[ 0 ], [] ).append( ( descriptor, pack ) )
+	count = 0
+	for segment in store.segments()[ :-1 ]:
+		entities = packed.get( segment, [] )
+		used = sum([ pack[ 2 ] for descriptor, pack in entities ])
+		size = os.path.getsize( store.segment_path( segment ) )
+		if used >= size * Params.PACK_COMPACT_RATIO:
+			continue
+		for descriptor, pack in entities:
+			descriptor.path = caches.pack_path(
+					*store.append( store.read( *pack ) ) )
+			descriptor.commit()
+			CachePath.record( descriptor.path, descriptor.size,
+					descriptor.mtime, descriptor.id )
+		store.remove( segment )
+		mainlog.info("Compacted segment %i, %i of %i bytes used", segment,
+				used, size)
+		count += 1
+	mainlog.note("Compacted %i pack segments", count)
+
+def prune_blobs():
+	"""
+	Remove blobs of caches.ContentAddressed that no descriptor references.
+	This marks and sweeps instead of keeping reference counts. The proxy
+	may store or reference a blob while the sweep runs, so blobs changed
+	less than BLOB_PRUNE_AGE seconds before the references were read are
+	kept (caches.ContentAddressed.finalize touches blobs it reuses).
+	"""
+	import caches
+	session = get_backend()
+	since = time.time() - Params.BLOB_PRUNE_AGE
+	referenced = set([ path for path, in session.query( Descriptor.path )
+		.filter( Descriptor.path.like( caches.BLOB_DIR + os.sep + '%' ) ) ])
+	removed = []
+	for root, dirs, files in os.walk( os.path.join( Runtime.ROOT, caches.BLOB_DIR ) ):
+		for name in files:
+			abspath = os.path.join( root, name )
+			path = os.path.relpath( abspath, Runtime.ROOT )
+			if path not in referenced \
+					and os.stat( abspath ).st_ctime < since:
+				os.unlink( abspath )
+				removed.append( path )
+	for path in removed:
+		session.query(CachePath).filter( CachePath.path == path )\
+			.delete( synchronize_session=False )
+	session.commit()
+	mainlog.note("Removed %i unreferenced blobs", len( removed ))
+
+def _init_worker():
+	# Interrupts are handled by the parent, which terminates the pool
+	signal.signal( signal.SIGINT, signal.SIG_IGN )
+
+def get_pool():
+	return multiprocessing.Pool( initializer=_init_worker )
+
+def pool_results(pool, func, tasks, chunksize=1):
+	"""
+	Yield the results of func for tasks from pool as they come. Results are
+	waited for with a timeout, a blocking wait cannot be interrupted with
+	SIGINT in Python 2.
+	"""
+	results = pool.imap_unordered( func, tasks, chunksize )
+	while True:
+		try:
+			yield results.next( Params.POOL_POLL )
+		except multiprocessing.TimeoutError:
+			continue
+		except StopIteration:
+			return
+
+def _scan_tree(path):
+	"Return path, size and mtime of each file below path. "
+	files = []
+	for root, dirs, names in os.walk( path ):
+		for name in names:
+			abspath = os.path.join( root, name )
+			try:
+				stat = os.stat( abspath )
+			except OSError:
 				continue
-			act = True
-			if cache.full() or cache.partial():
-				path = cache.path
-				if cache.partial():
-					path += '.incomplete'
-				if os.path.getsize(path) > Params.MAX_SIZE_PRUNE:
-					if Params.INTERACTIVE:
-						pass
-					log("Keeping %s" % path)
-					continue
-				if os.path.isfile(path):
-					print 'size=', cache.getsize() / 1024**2
-					os.unlink(path)
-					log("Deleted %s" % path)
-				else:
-					log("Unable to remove dir %s" % path)
-			del backend.descriptors[ref]
-			log("Removed %s" % cache.path)
-	log("Finished checking %s cache descriptors" % count)
-	backend.close()
-	#pb.clear()
+			files.append(( abspath, stat.st_size, int( stat.st_mtime ) ))
+	return files
 
+def scan_cache_paths():
+	"""
+	Scan the directories below the cache root in parallel and rebuild the
+	CachePath index, yielding path, size, mtime and descriptor id of each
+	file as it is found. Packed entities are indexed from their descriptors.
+	"""
+	import caches
+	session = get_backend()
+	known = dict( session.query( Descriptor.path, Descriptor.id )
+		.filter( Descriptor.path != None ) )
+	session.query(CachePath).delete( synchronize_session=False )
+	rows = []
+	for descriptor in session.query(Descriptor).filter(
+			Descriptor.path.like( caches.PACK_DIR + os.sep + '%' ) ):
+		rows.append( dict( path=descriptor.path, size=descriptor.size,
+			mtime=int( descriptor.mtime ), descriptor_id=descriptor.id ) )
+	# Ignore files in root
+	tops = [ os.path.join( Runtime.ROOT, name )
+		for name in sorted( os.listdir( Runtime.ROOT ) )
+		if name != caches.PACK_DIR
+			and os.path.isdir( os.path.join( Runtime.ROOT, name ) ) ]
+	mainlog.info("Scanning %i directories in cache root location. ", len( tops ))
+	pool = get_pool()
+	try:
+		for files in pool_results( pool, _scan_tree, tops ):
+			for abspath, size, mtime in files:
+				path = os.path.relpath( abspath, Runtime.ROOT )
+				rows.append( dict( path=path, size=size, mtime=mtime,
+					descriptor_id=known.get( path ) ) )
+				yield path, size, mtime, known.get( path )
+			if len( rows ) >= 1000:
+				session.execute( CachePath.__table__.insert(), rows )
+				rows = []
+		pool.close()
+	except BaseException:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	if rows:
+		session.execute( CachePath.__table__.insert(), rows )
+	session.commit()
+	open( cache_paths_marker(), 'w' ).close()
+
+def cache_paths_marker():
+	"Return the path of the file that marks the CachePath index as built. "
+	return os.path.join( Runtime.DATA_DIR, Params.CACHE_PATHS_MARKER )
+
+def iter_cache_paths():
+	"""
+	Stream the CachePath index, building it with a scan of the cache root
+	if that has not been done for this database yet.
+	"""
+	session = get_backend()
+	if not os.path.exists( cache_paths_marker() ):
+		for entry in scan_cache_paths():
+			pass
+	return session.query(CachePath).order_by( CachePath.path ).yield_per( 1000 )
 
+def check_files():
+	"""
+	Report files in the cache root that no descriptor refers to, while
+	scanning the root in parallel to rebuild the CachePath index. With
+	PRUNE unknown files smaller than MAX_SIZE_PRUNE are removed.
+	"""
+	pcount, unknown, removed = 0, 0, []
+	for path, size, mtime, descriptor_id in scan_cache_paths():
+		pcount += 1
+		if descriptor_id:
+			continue
+		unknown += 1
+		print 'unknown\t%s\t%i' % ( path, size )
+		if Runtime.PRUNE and size < Runtime.MAX_SIZE_PRUNE:
+			os.unlink( os.path.join( Runtime.ROOT, path ) )
+			removed.append( path )
+			mainlog.warn("Removed unknown file %s", path)
+	session = get_backend()
+	for path in removed:
+		session.query(CachePath).filter( CachePath.path == path )\
+			.delete( synchronize_session=False )
+	session.commit()
+	mainlog.note("Finished checking %i files, %i without descriptor",
+		pcount, unknown)
+
+def _check_file(task):
+	"""
+	Check a file against the size, mtime and digest of its descriptor. The
+	digest is not computed again if the file matches the entry of the last
+	check. Returns the descriptor id, the problem or None, a detail message
+	and the new checkpoint entry.
+	"""
+	id, abspath, size, mtime, digest, checked = task
+	try:
+		stat = os.stat( abspath )
+	except OSError:
+		return id, 'missing', '', None
+	if size != None and stat.st_size != size:
+		return id, 'size', '%i, expected %i' % ( stat.st_size, size ), None
+	entry = [ stat.st_size, int( stat.st_mtime ), digest ]
+	if digest and entry != checked and Cache.file_digest( abspath ) != digest:
+		return id, 'checksum', 'expected %s' % digest, None
+	if mtime != None and int( stat.st_mtime ) != mtime:
+		return id, 'mtime', '%i, expected %i' % ( stat.st_mtime, mtime ), entry
+	return id, None, '', entry
+
+def _check_packed(descriptor):
+	"""
+	Check packed data against the descriptor, and its digest if it has one.
+	Returns the problem or None, and a detail message.
+	"""
+	import caches
+	if not check_data( descriptor ):
+		return 'missing', ''
+	if descriptor.hash:
+		data = caches.get_pack_store().read(
+				*caches.parse_pack_path( descriptor.path ) )
+		if hashlib.sha1( data ).hexdigest() != descriptor.hash:
+			return 'checksum', 'expected %s' % descriptor.hash
+	return None, ''
+
+def save_checkpoint(path, checkpoint):
+	tmp = path + Runtime.PARTIAL
+	open( tmp, 'w' ).write( json_write( checkpoint ) )
+	os.rename( tmp, path )
+
+def check_cache(resume=True):
+	"""
+	Check the file of every descriptor for its size, mtime and, for complete
+	entities with a hash, the SHA1 digest. Files are checked in parallel and
+	problems printed as they are found. Files that passed are kept in a
+	checkpoint in DATA_DIR, so an interrupted or later run (with resume)
+	only hashes files that changed since. Without resume every digest is
+	computed again and the checkpoint is left as is. Packed entities are
+	checked in this process. With PRUNE failing descriptors are removed,
+	except for a differing mtime. Returns the number that failed.
+	"""
+	import caches
+	checkpoint_path = os.path.join( Runtime.DATA_DIR, Params.CHECK_CHECKPOINT )
+	checkpoint = {}
+	if resume and os.path.exists( checkpoint_path ):
+		checkpoint = json_read( open( checkpoint_path ).read() )
+	session = get_backend()
+	tasks, packed, problems = [], 0, []
+	for descriptor in session.query(Descriptor).filter(
+			Descriptor.path != None ).yield_per( 1000 ):
+		if caches.parse_pack_path( descriptor.path ):
+			packed += 1
+			problem, detail = _check_packed( descriptor )
+			if problem:
+				problems.append(( descriptor.id, problem, detail ))
+			continue
+		complete = Runtime.PARTIAL not in descriptor.path
+		mtime = int( descriptor.mtime )
+		if descriptor.path.startswith( caches.BLOB_DIR + os.sep ):
+			# Shared by descriptors with other mtimes
+			mtime = None
+		tasks.append(( descriptor.id,
+			os.path.join( Runtime.ROOT, descriptor.path ),
+			complete and descriptor.size or None, mtime,
+			complete and descriptor.hash or None,
+			checkpoint.get( str( descriptor.id ) ) ))
+	failed = [ 0 ]
+	def report(id, problem, detail):
+		failed[ 0 ] += 1
+		descriptor = session.query(Descriptor).get( id )
+		print '%s\t%s\t%s' % ( problem, descriptor.path, detail )
+		if Runtime.PRUNE and problem != 'mtime':
+			descriptor.remove()
+			mainlog.warn("Removed descriptor for %s", descriptor.path)
+	for id, problem, detail in problems:
+		report( id, problem, detail )
+	mainlog.info("Checking %i descriptors", len( tasks ))
+	seen = set()
+	pool = get_pool()
+	try:
+		for id, problem, detail, entry in pool_results( pool,
+				_check_file, tasks, 64 ):
+			seen.add( str( id ) )
+			if entry:
+				checkpoint[ str( id ) ] = entry
+			else:
+				checkpoint.pop( str( id ), None )
+			if problem:
+				report( id, problem, detail )
+			if resume and not len( seen ) % Params.CHECK_CHECKPOINT_INTERVAL:
+				save_checkpoint( checkpoint_path, checkpoint )
+		pool.close()
+	except BaseException:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		if resume:
+			save_checkpoint( checkpoint_path, checkpoint )
+	if resume and len( seen ) == len( tasks ):
+		# Forget removed descriptors
+		save_checkpoint( checkpoint_path, dict([ ( id, entry )
+			for id, entry in checkpoint.items() if id in seen ]) )
+	mainlog.note("Finished checking %i cache descriptors, %i failed",
+		len( tasks ) + packed, failed[ 0 ])
+	return failed[ 0 ]
@@ -1,4 +1,4 @@
-import hashlib, socket, time, traceback, urlparse, urllib
+import socket, time, traceback, urlparse, urllib
 
 import fiber
 import Params, Resource, Rules, HTTP, Runtime, Command
@@ -75,14 +75,33 @@ class DataResponse:
 		assert protocol.data.cache
 		assert protocol.data.descriptor.mediatype
 
-		if self.__end == -1 and protocol.data.descriptor.size:
-			self.__end = protocol.data.descriptor.size
+		# Decode for clients that do not accept the stored encoding, or to
+		# rewrite the content
+		self.__decoder = None
+		encoding = protocol.data.descriptor.encoding
+		if encoding:
+			vary = HTTP.parse_vary( args.get( 'Vary', '' ) )
+			if 'accept-encoding' not in vary:
+				args[ 'Vary' ] = ', '.join( filter( None,
+					[ args.get( 'Vary' ), 'Accept-Encoding' ] ) )
+			if protocol.rewrite or not HTTP.accepts_encoding(
+					request.headers.get( 'Accept-Encoding', '' ), encoding ):
+				self.__decoder = HTTP.decoder( encoding )
+		if self.__decoder:
+			mainlog.info("%s: Decoding %s entity", self, encoding)
+			# Ranges apply to the encoded entity, send it whole
+			self.__pos, self.__end = 0, -1
+			for key in ( 'Content-Encoding', 'Content-Length',
+					'Content-MD5', 'Content-Range' ):
+				args.pop( key, None )
+			if args.get( 'ETag', 'W/' )[ :2 ] != 'W/':
+				args[ 'ETag' ] = 'W/' + args[ 'ETag' ]
+
+		size = protocol.data.descriptor.size
+		if size and ( self.__end == -1 or self.__end > size ):
+			self.__end = size
 		#assert 'Content-Length' in args
 
-		# TODO: on/off:
-		#if protocol.capture:
-		#	self.__hash = hashlib.sha1()
-
 # XXX: this may need to be on js serving..
 #		if self.__protocol.rewrite:
 #			args['Access-Control-Allow-Origin'] = "%s:%i" % request.hostinfo
@@ -90,7 +109,8 @@ class DataResponse:
 		#assert 'Last-Modified' in args
 		#assert 'Content-Type' in args
 
-		if self.__pos == 0 and self.__end in ( -1, self.__protocol.size ):
+		if self.__pos == 0 and self.__end in ( -1, self.__protocol.size ) \
+				or self.__decoder:
 			head = 'HTTP/1.1 200 OK'
 
 		elif self.__end >= 0:
@@ -112,6 +132,14 @@ class DataResponse:
 			assert False, dict( request=( self.__pos, self.__end ), proto=(
 				protocol.tell(), protocol.size ), size=protocol.data.descriptor.size )
 
+		# Let HTTP/1.1 clients tell a complete entity of unknown length from
+		# an aborted one by re-encoding it into chunks
+		self.__chunked = self.__eof = False
+		if 'Content-Length' not in args and head.startswith( 'HTTP/1.1 200' ) \
+				and request.envelope[ 2 ] == 'HTTP/1.1':
+			args[ 'Transfer-Encoding' ] = 'chunked'
+			self.__chunked = True
+
 		mainlog.note('HTCache responds %r', head.strip())
 
 		if Runtime.LOG_LEVEL == log.DEBUG:
@@ -131,6 +159,10 @@ class DataResponse:
 
 		if self.__sendbuf:
 			return True
+		elif self.__chunked and not self.__eof \
+				and self.__pos >= self.__protocol.size >= 0:
+			# last-chunk
+			return True
 		elif self.__pos >= self.__protocol.tell():
 #			mainlog.debug("[%s hasdata (%s >= %s) ]",self, self.__pos, self.__protocol.tell())
 			return False
@@ -145,10 +177,12 @@ class DataResponse:
 	def send(self, sock):
 
 		assert not self.Done
+		if not self.__sendbuf and ( self.__chunked or self.__decoder ):
+			self.__sendbuf = self.__next_chunk()
 		if self.__sendbuf:
 			bytecnt = sock.send( self.__sendbuf )
 			self.__sendbuf = self.__sendbuf[ bytecnt: ]
-		else:
+		elif not self.__chunked and not self.__decoder:
 			bytecnt = Params.MAXCHUNK
 			if 0 <= self.__end < self.__pos + bytecnt:
 				bytecnt = self.__end - self.__pos
@@ -167,29 +201,67 @@ class DataResponse:
 				return
 		self.Done = not self.__sendbuf and (
 				self.__pos >= self.__protocol.size >= 0
-				or self.__pos >= self.__end >= 0 )
+				or self.__pos >= self.__end >= 0 ) \
+			and ( self.__eof or not self.__chunked )
 
-		# TODO: store hash for new recv'd content
-		#if self.__protocol.capture and self.Done:
-		#	print 'hash', self.__hash.hexdigest()
+	def __next_chunk(self):
+		"""
+		Read available data from cache, decode it if needed and encode it as
+		a chunk.
+		"""
+		if self.__pos < self.__protocol.tell():
+			chunk = self.__protocol.read( self.__pos, Params.MAXCHUNK )
+			if self.__decoder:
+				self.__pos += len( chunk )
+				chunk = self.__decoder.decompress( chunk )
+				if self.__pos >= self.__protocol.size >= 0:
+					chunk += self.__decoder.flush()
+				if self.__protocol.rewrite:
+					delta, chunk = Rules.Rewrite.run(chunk)
+			else:
+				if self.__protocol.rewrite:
+					delta, chunk = Rules.Rewrite.run(chunk)
+					self.__protocol.size += delta
+				self.__pos += len( chunk )
+			if chunk and self.__chunked:
+				return HTTP.encode_chunk( chunk )
+			return chunk
+		elif self.__chunked and self.__pos >= self.__protocol.size >= 0:
+			self.__eof = True
+			return HTTP.encode_chunk( '' )
+		return ''
 
 	def needwait(self):
 
+		if not self.__protocol.fetching():
+			# Remaining data comes from parallel segment fetches
+			if not self.__protocol.segments:
+				mainlog.err('%s: Segments failed, entity incomplete', self)
+				self.Done = True
+			return Params.SEGMENT_POLL
 		return Runtime.LIMIT and max( self.__nextrecv - time.time(), 0 )
 
 	def recv(self, sock):
 		"""
-		Read chuck from server response. Hash or rewrite if needed.
+		Read chuck from server response into the cache.
 		"""
 
 		assert not self.Done
 		chunk = sock.recv( Params.MAXCHUNK )
 		if chunk:
 			self.__protocol.write( chunk )
-			#if self.__protocol.capture:
-			#	self.__hash.update( chunk )
 			if Runtime.LIMIT:
 				self.__nextrecv = time.time() + len( chunk ) / Runtime.LIMIT
+			if not self.__protocol.fetching():
+				# Segment fetches write the rest, stop reading the server
+				# instead of leaving the connection to time out. Other
+				# responses joined to the download may still wait on it, so
+				# shut it down and let them read the end of the stream.
+				mainlog.info('%s: Closing server connection at end of segment',
+						self)
+				sock.shutdown( socket.SHUT_RDWR )
+		elif not self.__protocol.fetching():
+			pass
 		else:
 			if self.__protocol.size >= 0:
 				if self.__protocol.size != self.__protocol.tell():
@@ -228,36 +300,29 @@ class DataResponse:
 
 class ChunkedDataResponse( DataResponse ):
 
+	"""
+	Receive an entity in chunked transfer-coding, and store its decoded
+	payload in the cache.
+	"""
+
 	def __init__(self, protocol, request):
 
 		DataResponse.__init__(self, protocol, request )
 		self.__protocol = protocol
-		self.__recvbuf = ''
+		self.__decoder = HTTP.ChunkedDecoder( protocol.write )
 
 	def recv(self, sock):
 
 		assert not self.Done
 		chunk = sock.recv( Params.MAXCHUNK )
 		assert chunk, 'chunked data error: connection closed prematurely'
-		self.__recvbuf += chunk
-		while '\r\n' in self.__recvbuf:
-			head, tail = self.__recvbuf.split( '\r\n', 1 )
-			chunksize = int( head.split( ';' )[ 0 ], 16 )
-			if chunksize == 0:
-				self.__protocol.size = self.__protocol.tell()
-				mainlog.debug('Connection closed at byte %i', self.__protocol.size)
-				self.Done = not self.hasdata()
-				return
-			if len( tail ) < chunksize + 2:
-				mainlog.debug('Waiting for chunk end')
-				return
-			assert tail[ chunksize:chunksize+2 ] == '\r\n', \
-					'chunked data error: chunk does not match announced size'
-			mainlog.debug('Received %i byte chunk', chunksize)
-			self.__protocol.write( tail[ :chunksize ] )
-			self.__recvbuf = tail[ chunksize+2: ]
-		mainlog.debug('Received %i byte in chunks', len(self.__recvbuf))
-		#protocol.data.close()
+		self.__decoder.feed( chunk )
+		if self.__decoder.done:
+			self.__protocol.size = self.__protocol.tell()
+			mainlog.debug('Received %i byte in chunks', self.__decoder.size)
+			if self.__decoder.trailers:
+				mainlog.debug('Ignored chunked trailer: %r', self.__decoder.trailers)
+			self.Done = not self.hasdata()
 
 	def __str__(self):
 		return "[ChunkedDataResponse %s]" % hex(id(self))
@@ -357,6 +422,11 @@ class DirectResponse:
 		self.__sendbuf = 'HTTP/1.1 %s\r\n%s'\
 				'\r\n%s' % ( status, headers, content ) 
 
+	def prepare_head(self, status, headers):
+		"Prepare a response without message body. "
+		self.__sendbuf = '\r\n'.join( [ 'HTTP/1.1 %s' % status ] +
+				[ '%s: %s' % item for item in headers.items() ] + [ '', '' ] )
+
 	def hasdata(self):
 		assert self.__sendbuf, self
 		return bool( self.__sendbuf )
@@ -580,6 +650,30 @@ class NotFoundResponse( DirectResponse ):
 		return "[NotFoundResponse %s]" % hex(id(self))
 
 
+class NotModifiedResponse( DirectResponse ):
+
+	"""
+	Tell the client its copy of the stored entity is still current.
+	"""
+
+	def __init__(self, protocol, request):
+		DirectResponse.__init__(self)
+		self.__protocol = protocol
+		args = protocol.data.prepare_response()
+		for key in ( 'Content-Encoding', 'Content-Length', 'Content-Range',
+				'Content-Type', 'Transfer-Encoding' ):
+			args.pop( key, None )
+		mainlog.note('HTCache responds 304 Not Modified')
+		self.prepare_head( '304 Not Modified', args )
+
+	def finalize(self, client):
+		self.__protocol.finish()
+		client.close()
+
+	def __str__(self):
+		return "[NotModifiedResponse %s]" % hex(id(self))
+
+
 class ExceptionResponse( DirectResponse ):
 
 	def __init__(self, protocol, request, e=None):
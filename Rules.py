@@ -6,15 +6,65 @@ import re
 import Params
 import Runtime
 import log
+from util import LRU
 
 
 mainlog = log.get_log('main')
 
 
+STANDALONE = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[iLmsux]|\(\?\(')
+"Patterns with named groups, backreferences, conditionals or flags are not combined. "
+
+MAX_GROUPS = 99
+"Python regular expressions support at most 100 groups. "
+
+MEMO = LRU(Params.RULES_MEMO)
+"Rule matches and cache locations of recent URLs, see memoize. "
+
+
+def file_mtime(fpath):
+	if os.path.exists(fpath):
+		return os.stat(fpath).st_mtime
+
+def memoize(key, func, *args):
+	"""
+	Return func(*args), remembered under key until the rules are parsed
+	again, so that repeated requests for an URL skip the regex work.
+	"""
+	if key in MEMO:
+		return MEMO[key]
+	value = MEMO[key] = func(*args)
+	return value
+
+
+def uncapture(pattern):
+	"Return pattern with its capturing groups made non-capturing. "
+	out, escaped, charset = [], False, False
+	for i, c in enumerate(pattern):
+		out.append(c)
+		if escaped:
+			escaped = False
+		elif c == '\\':
+			escaped = True
+		elif charset:
+			if c == ']' and pattern[i-1] != '[' and pattern[i-2:i] != '[^':
+				charset = False
+		elif c == '[':
+			charset = True
+		elif c == '(' and pattern[i+1:i+2] != '?':
+			out.append('?:')
+	return ''.join(out)
+
+
 class AbstractRuleset:
 
 	rules = []
 	files = []
+	matchers = []
+	mtimes = {}
+	"Modification time of each parsed file, or None if it did not exist. "
+	combine = False
+	"Compile the rules into matchers for find. "
 
 	main_file = None
 
@@ -32,6 +82,7 @@ class AbstractRuleset:
 		return (
 			pattern, re.compile(pattern),
 		) 
+
 # XXX: could put tab back into JOIN rules file, also parse continuous
 # separators? Multiple spaces are a pain right now. 
 #		JOIN.extend([
@@ -41,23 +92,21 @@ class AbstractRuleset:
 #			])
 
 	@classmethod
-	def parse(klass, fpath=None):
+	def read(klass, fpaths):
 		"""
-		Load new rules from file, or reload configured rules.
+		Parse the rules of each file, and return the rules, the files that
+		exist and the modification time of each file.
 		"""
+		rules, files, mtimes = [], [], {}
+		for fpath in fpaths:
 
-		if not fpath:
-			fpath = klass.main_file
-		if fpath == klass.main_file:
-			klass.rules = []
-			klass.files = []
-		else:
-			if fpath in klass.files:
-				return
+			mtimes[fpath] = file_mtime(fpath)
 
-		if os.path.isfile(fpath):
+			if not os.path.isfile(fpath):
+				mainlog.err("No such file: %s", fpath)
+				continue
 
-			klass.files.append(fpath)
+			files.append(fpath)
 
 			try:
 				lines = klass.parse_lines(fpath)
@@ -67,25 +116,113 @@ class AbstractRuleset:
 
 			for line in lines:
 				try:
-					klass.rules.append( klass.parse_rule(line) )
+					rules.append( klass.parse_rule(line) )
 				except Exception, e:
 					mainlog.err("Error parsing %s line: %r", klass.__name__, line)
 					raise
-			
-		else:
-			mainlog.err("No such file: %s", fpath)
+
+		return rules, files, mtimes
+
+	@classmethod
+	def replace(klass, rules, files, mtimes):
+		"Put new rules in place at once, with their matchers. "
+		matchers = klass.compile(rules) if klass.combine else []
+		klass.rules, klass.files, klass.mtimes, klass.matchers = \
+				rules, files, mtimes, matchers
+		MEMO.clear()
+
+	@classmethod
+	def parse(klass, fpath=None):
+		"""
+		Load new rules from file, or reload configured rules.
+		The new rules and matchers replace the old ones at once, if a file
+		fails to parse the old rules stay in place.
+		"""
+
+		if not fpath:
+			fpath = klass.main_file
+		if fpath == klass.main_file:
+			klass.replace(*klass.read([ fpath ]))
+		elif fpath not in klass.files:
+			rules, files, mtimes = klass.read([ fpath ])
+			mtimes.update(klass.mtimes)
+			klass.replace(klass.rules + rules, klass.files + files, mtimes)
+
+	@classmethod
+	def changed(klass):
+		"Return true if any of the parsed files was changed, added or removed. "
+		for fpath, mtime in klass.mtimes.items():
+			if file_mtime(fpath) != mtime:
+				return True
+
+	@classmethod
+	def reload(klass):
+		"""
+		Parse the main file again, and the other files parsed before. The
+		rules are replaced only if all files parse.
+		"""
+		fpaths = [ klass.main_file ] + [ fpath for fpath in klass.files
+			if fpath != klass.main_file ] + [ fpath for fpath in klass.mtimes
+			if fpath != klass.main_file and fpath not in klass.files ]
+		klass.replace(*klass.read(fpaths))
+
+	@classmethod
+	def compile(klass, rules):
+		"""
+		Combine the rule patterns into alternations, so that a path is
+		matched against many rules in one pass. The groups of each rule are
+		made non-capturing and the rule is wrapped in a group of its own, the
+		index of the matching group identifies the (first) matching rule.
+		Leading '^' are dropped since find matches at the start anyway, which
+		lets the regex engine skip branches on their first literal.
+		Returns a list of (regex, patterns) pairs, with patterns None for
+		rules that are matched on their own.
+		"""
+		matchers = []
+		chunk, patterns = [], []
+		for rule in rules:
+			pattern, compiled = rule[:2]
+			if STANDALONE.search(pattern):
+				if chunk:
+					matchers.append(( re.compile('|'.join(chunk)), patterns ))
+					chunk, patterns = [], []
+				matchers.append(( compiled, None ))
+				continue
+			if len(chunk) == MAX_GROUPS:
+				matchers.append(( re.compile('|'.join(chunk)), patterns ))
+				chunk, patterns = [], []
+			patterns.append(pattern)
+			if pattern.startswith('^'):
+				pattern = pattern[1:]
+			chunk.append('(%s)' % uncapture(pattern))
+		if chunk:
+			matchers.append(( re.compile('|'.join(chunk)), patterns ))
+		return matchers
+
+	@classmethod
+	def find(klass, path):
+		"Return the pattern of the first rule matching path, if any. "
+		return memoize((klass.__name__, path), klass.first_match, path)
+
+	@classmethod
+	def first_match(klass, path):
+		for regex, patterns in klass.matchers:
+			m = regex.match(path)
+			if m:
+				if patterns is None:
+					return regex.pattern
+				return patterns[m.lastindex - 1]
 
 
 class NoCache(AbstractRuleset):
 
 	main_file = Params.NOCACHE_FILE
+	combine = True
 
 	@classmethod
 	def match(klass, url):
-		for pattern, compiled in klass.rules:
-			p = url.find( ':' ) # find len of scheme-id
-			if compiled.match( url[p+3:] ):
-				return pattern
+		p = url.find( ':' ) # find len of scheme-id
+		return klass.find( url[p+3:] )
 
 
 class Join(AbstractRuleset):
@@ -106,6 +243,10 @@ class Join(AbstractRuleset):
 		"""
 		Rewrite a single path using loaded rules.
 		"""
+		return memoize((klass.__name__, pathref), klass.rewrite_path, pathref)
+
+	@classmethod
+	def rewrite_path(klass, pathref):
 		if pathref[:2] == '//':
 			pathref = pathref[2:]
 		if klass.rules:
@@ -151,42 +292,38 @@ class Join(AbstractRuleset):
 	@classmethod
 	def run(klass):
 		"""
-		(Re)run the current rules on current cache; this iterates all
-		descriptors and moves and updates these whenever a (new) rule applies.
+		(Re)run the current rules on current cache; this iterates the cache
+		paths index and moves and updates these whenever a (new) rule applies.
 		"""
+		import Resource
 		if not klass.files:
 			klass.parse()
 		os.chdir(Runtime.ROOT)
-		for root, dirs, files in os.walk(Runtime.ROOT):
-			for d in dirs:
-				if d in ['.git']:
-					dirs.remove(d)
-			for f in files:
-				fpath = os.path.join(root, f).replace(Runtime.ROOT, '')
-				fpath2 = fpath.replace(':80','')
-				fpath3 = klass.rewrite(fpath2)
-				assert fpath3, fpath3
-				if fpath2 != fpath3:
-					mainlog.note('FIXME: Renaming: %s --> %s', fpath2, fpath)
-					continue # XXX
-					print fpath2, fpath3
-					dirname = os.path.dirname(fpath3)
-					if dirname and not os.path.isdir(dirname):
-						print 'creating', dirname
-						os.makedirs(dirname)
-					os.rename(fpath, fpath3)
+		for entry in Resource.iter_cache_paths():
+			fpath = entry.path
+			fpath2 = fpath.replace(':80','')
+			fpath3 = klass.rewrite(fpath2)
+			assert fpath3, fpath3
+			if fpath2 != fpath3:
+				mainlog.note('FIXME: Renaming: %s --> %s', fpath2, fpath)
+				continue # XXX
+				print fpath2, fpath3
+				dirname = os.path.dirname(fpath3)
+				if dirname and not os.path.isdir(dirname):
+					print 'creating', dirname
+					os.makedirs(dirname)
+				os.rename(fpath, fpath3)
 
 
 # FIXME: drop rules
 class Drop(AbstractRuleset):
 
 	main_file = Params.DROP_FILE
+	combine = True
 
 	@classmethod
 	def match(klass, path):
-		for pattern, compiled in klass.rules:
-			if compiled.match(path):
-				return pattern
+		return klass.find(path)
 
 
 class Rewrite(AbstractRuleset):
@@ -234,4 +371,27 @@ def load():
 		x.main_file = getattr(Runtime, x.__name__.upper() + "_FILE")
 		x.parse()
 
+def watch():
+	"""
+	Fiber that parses rule files again when they change, checking their
+	modification times every RULES_POLL seconds. Requests being served keep
+	running, new ones see the new rules.
+	"""
+	import fiber
+	while True:
+		yield fiber.WAIT( Runtime.RULES_POLL )
+		for x in Drop, NoCache, Join, Rewrite:
+			if not x.changed():
+				continue
+			try:
+				x.reload()
+				mainlog.note('Reloaded %s rules from %s', x.__name__,
+						', '.join(x.files) or 'no files')
+			except Exception, e:
+				mainlog.err('Error: reloading %s rules failed, keeping %i'
+						' rules: %s', x.__name__, len(x.rules), e)
+				# try again once the files change
+				x.mtimes = dict([ ( fpath, file_mtime(fpath) )
+					for fpath in x.mtimes ])
+
 
@@ -28,6 +28,23 @@ ENCODE_PATHSEP = None
 FileTreeQ_SORT = True
 FileTreeQ_ENCODE = False
 PARTIAL = None
+SEGMENTED = None
+PARALLEL_FETCH = None
+PARALLEL_MIN_SIZE = None
+SHARD_LEVELS = None
+SHARD_WIDTH = None
+PACK_MAX_SIZE = None
+MAX_CACHE_SIZE = None
+MAX_CACHE_FILES = None
+EVICTION = None
+ADMIT_HITS = None
+ADMIT_MAX_SIZE = None
+ADMIT_EXCLUDE = None
+STALE_WHILE_REVALIDATE = None
+STALE_IF_ERROR = None
+PREFETCH = None
+PREFETCH_LIMIT = None
+RULES_POLL = None
 PROXY_INJECT = None
 
 # misc. program params
@@ -36,6 +53,13 @@ DEBUG = False
 INTERACTIVE = False
 
 PRUNE = None
+MEDIATYPE = None
+MIN_SIZE = None
+MAX_SIZE = None
+HOST = None
+SINCE = None
+UNTIL = None
+JSON = None
 MAX_SIZE_PRUNE = 11*(1024**2)
 
 COMMANDS = []
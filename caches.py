@@ -4,8 +4,8 @@ For better support of some weird URLs the latter is preferable.
 
 See README for description.
 """
-import time, os
-from hashlib import md5
+import fcntl, mmap, os, re, time
+from hashlib import md5, sha1
 import Cache, Params, Runtime
 from util import *
 import log
@@ -13,6 +13,11 @@ import log
 
 mainlog = log.get_log('main')
 
+BLOB_DIR = '.blobs'
+"Directory in Runtime.ROOT for ContentAddressed. "
+PACK_DIR = '.packs'
+"Directory in Runtime.ROOT for the segment files of Packed. "
+
 
 class FileTreeQ(Cache.File):
 	"""
@@ -192,3 +197,300 @@ class RefHash(Cache.File):
 		return os.path.isfile( self.abspath() ) and os.stat( self.abspath() )
 
 
+class Sharded(Cache.File):
+
+	"""
+	Encode the full URI into an MD5 hex-digest like RefHash, but store it
+	below SHARD_LEVELS directories named by the first SHARD_WIDTH digits
+	of the digest each, ie. ab/cd/abcd... This keeps directories small
+	for large sites. The location can not be mapped back to an URL, the
+	descriptor store keeps the path of each entity.
+	"""
+
+	def init(self, path):
+		assert Params.PARTIAL not in path
+		mainlog.debug("%s: init %r", self, path)
+		digest = md5( path ).hexdigest()
+		width = Runtime.SHARD_WIDTH
+		assert Runtime.SHARD_LEVELS * width < len( digest )
+		parts = [ digest[ i * width : ( i + 1 ) * width ]
+				for i in range( Runtime.SHARD_LEVELS ) ]
+		path = os.path.join( *( parts + [ digest ] ) )
+		if Runtime.ARCHIVE:
+			path = time.strftime( Runtime.ARCHIVE, time.gmtime() ) + path
+		self.path = path
+		self.fp = None
+		self.stat()
+
+	def __str__(self):
+		return "[Sharded %s]" % hex(id(self))
+
+
+class ContentAddressed(FileTree):
+
+	"""
+	Store complete entities once per content, by the SHA1 digest of the
+	entity body, below BLOB_DIR. Downloads go to a partial file at the
+	FileTree location and are hashed while they are written. Once complete
+	the partial file becomes the blob, or is dropped if that blob exists
+	already. Descriptors reference blobs by path, so blobs are shared and
+	only removed once no descriptor refers to them (see prune-blobs).
+	"""
+
+	def __detach(self):
+		# Never write into a complete, possibly shared, file
+		self.path = os.path.join( BLOB_DIR, 'new',
+				sha1( '%s %s' % ( self.path, time.time() ) ).hexdigest() )
+		self.partial, self.full = None, None
+		tdir = os.path.dirname( self.partial_path() )
+		if not os.path.exists( tdir ):
+			os.makedirs( tdir )
+
+	def open_replacement(self):
+		self.__detach()
+		super(ContentAddressed, self).open_replacement()
+
+	def open_segment(self, offset):
+		if self.full:
+			self.__detach()
+		super(ContentAddressed, self).open_segment(offset)
+
+	def finalize(self, mtime):
+		"""
+		Move the completed partial file into the blob store, unless the
+		content is stored already.
+		"""
+		partial = self.partial_path()
+		digest = self.digest()
+		path = os.path.join( BLOB_DIR, digest[ :2 ], digest )
+		blob = os.path.join( Runtime.ROOT, path )
+		if os.path.exists( blob ):
+			os.remove( partial )
+			# Touch the change time, see Resource.prune_blobs
+			stat = os.stat( blob )
+			os.utime( blob, ( stat.st_atime, stat.st_mtime ) )
+			mainlog.note('%s: Content already stored at %s', self, path)
+		else:
+			tdir = os.path.dirname( blob )
+			if not os.path.exists( tdir ):
+				os.makedirs( tdir )
+			os.rename( partial, blob )
+			os.utime( blob, ( mtime, mtime ) )
+		self.path = path
+		self.partial, self.full = None, None
+		self.stat()
+		return path
+
+	def remove_full(self):
+		if self.path.startswith( BLOB_DIR + os.sep ):
+			mainlog.note('%s: Keeping shared blob %s, see prune-blobs',
+					self, self.path)
+			return
+		super(ContentAddressed, self).remove_full()
+
+	def __str__(self):
+		return "[ContentAddressed %s]" % hex(id(self))
+
+
+def pack_path(segment, offset, length):
+	"Return the location of a packed entity, as kept by the descriptor. "
+	return os.path.join( PACK_DIR, '%06i:%i+%i' % ( segment, offset, length ) )
+
+def parse_pack_path(path):
+	"Return segment, offset and length for a packed location, or None. "
+	m = re.match( '^%s%s(\d+):(\d+)\+(\d+)$' % ( re.escape( PACK_DIR ),
+		re.escape( os.sep ) ), path or '' )
+	if m:
+		return tuple( map( int, m.groups() ) )
+
+
+class PackStore(object):
+
+	"""
+	Append-only segment files that hold the entities of Packed. Segments
+	are read through an mmap shared by all cache instances, and mapped
+	again when they have grown past the mapped size.
+	"""
+
+	def __init__(self, root):
+		self.root = root
+		self.maps = {}
+
+	def segment_path(self, segment):
+		return os.path.join( self.root, PACK_DIR, '%06i.pack' % segment )
+
+	def segments(self):
+		"Return the numbers of the existing segments, in order. "
+		path = os.path.join( self.root, PACK_DIR )
+		if not os.path.exists( path ):
+			return []
+		return sorted([ int( name[ :-5 ] ) for name in os.listdir( path )
+			if name.endswith( '.pack' ) ])
+
+	def append(self, data):
+		"""
+		Append data to the last segment, or start a new one once that has
+		reached PACK_SEGMENT_SIZE. Returns segment, offset and length.
+		"""
+		segments = self.segments() or [ 1 ]
+		segment = segments[ -1 ]
+		path = self.segment_path( segment )
+		if os.path.exists( path ) \
+				and os.path.getsize( path ) >= Params.PACK_SEGMENT_SIZE:
+			segment += 1
+			path = self.segment_path( segment )
+		if not os.path.exists( os.path.dirname( path ) ):
+			os.makedirs( os.path.dirname( path ) )
+		fp = open( path, 'ab' )
+		try:
+			# Other processes (ie. compact-packs) may append too
+			fcntl.flock( fp.fileno(), fcntl.LOCK_EX )
+			fp.seek( 0, 2 )
+			offset = fp.tell()
+			fp.write( data )
+			fp.flush()
+		finally:
+			fp.close()
+		return segment, offset, len( data )
+
+	def read(self, segment, offset, size):
+		buf = self.maps.get( segment )
+		if not buf or len( buf ) < offset + size:
+			if buf:
+				buf.close()
+			fp = open( self.segment_path( segment ), 'rb' )
+			buf = mmap.mmap( fp.fileno(), 0, access=mmap.ACCESS_READ )
+			fp.close()
+			self.maps[ segment ] = buf
+		return buf[ offset:offset + size ]
+
+	def remove(self, segment):
+		buf = self.maps.pop( segment, None )
+		if buf:
+			buf.close()
+		os.remove( self.segment_path( segment ) )
+
+
+PACK_STORE = None
+
+def get_pack_store():
+	global PACK_STORE
+	if not PACK_STORE or PACK_STORE.root != Runtime.ROOT:
+		PACK_STORE = PackStore( Runtime.ROOT )
+	return PACK_STORE
+
+
+class Packed(FileTree):
+
+	"""
+	Append complete entities of at most PACK_MAX_SIZE bytes to large
+	segment files below PACK_DIR, instead of keeping a file for each.
+	Larger entities are stored as with FileTree. Downloads always go to a
+	partial file, which is packed once complete.
+
+	The location of a packed entity encodes the segment, offset and length
+	(see pack_path), the descriptor store serves as the index. Renewed
+	entities leave their old data in the segment, until compact-packs
+	copies the remaining entities out of mostly unused segments.
+	"""
+
+	pack = None
+	"Segment, offset and length of the packed entity at path. "
+
+	def stat(self):
+		self.pack = parse_pack_path( self.path )
+		if not self.pack:
+			return super(Packed, self).stat()
+		segment = get_pack_store().segment_path( self.pack[ 0 ] )
+		self.partial = False
+		self.full = os.path.isfile( segment ) and os.stat( segment )
+		return self.full
+
+	@property
+	def size(self):
+		if self.pack:
+			return self.pack[ 2 ]
+		return super(Packed, self).size
+
+	def utime(self, mtime):
+		if not self.pack:
+			super(Packed, self).utime( mtime )
+
+	def __detach(self):
+		# Write new data to a file of its own until complete
+		if not self.pack:
+			return
+		self.path = os.path.join( PACK_DIR, 'new',
+				sha1( '%s %s' % ( self.path, time.time() ) ).hexdigest() )
+		self.pack, self.partial, self.full = None, None, None
+		tdir = os.path.dirname( self.partial_path() )
+		if not os.path.exists( tdir ):
+			os.makedirs( tdir )
+
+	def open_new(self):
+		self.__detach()
+		super(Packed, self).open_new()
+
+	def open_partial(self, offset=-1):
+		self.__detach()
+		super(Packed, self).open_partial( offset )
+
+	def open_replacement(self):
+		self.__detach()
+		super(Packed, self).open_replacement()
+
+	def open_segment(self, offset):
+		self.__detach()
+		super(Packed, self).open_segment( offset )
+
+	def open_full(self):
+		if not self.pack:
+			return super(Packed, self).open_full()
+		assert not self.fp
+		self.fp = get_pack_store()
+
+	def finalize(self, mtime):
+		partial = self.partial_path()
+		if self.fp:
+			self.fp.flush()
+		if os.path.getsize( partial ) > Runtime.PACK_MAX_SIZE:
+			return super(Packed, self).finalize( mtime )
+		if self.fp:
+			self.fp.close()
+		data = open( partial, 'rb' ).read()
+		self.path = pack_path( *get_pack_store().append( data ) )
+		os.remove( partial )
+		mainlog.note('%s: Packed %i bytes at %s', self, len( data ), self.path)
+		self.stat()
+		if self.fp:
+			# Remaining reads come from the segment
+			self.fp = get_pack_store()
+		return self.path
+
+	def remove_full(self):
+		if not self.pack:
+			return super(Packed, self).remove_full()
+		mainlog.note('%s: Leaving packed data for compact-packs', self)
+
+	def read(self, pos, size):
+		if not self.pack:
+			return super(Packed, self).read( pos, size )
+		segment, offset, length = self.pack
+		size = max( min( size, length - pos ), 0 )
+		return get_pack_store().read( segment, offset + pos, size )
+
+	def tell(self):
+		if self.pack:
+			return self.pack[ 2 ]
+		return super(Packed, self).tell()
+
+	def close(self):
+		if not self.pack:
+			return super(Packed, self).close()
+		assert self.fp
+		self.fp = None
+		self.partial, self.full = None, None
+
+	def __str__(self):
+		return "[Packed %s]" % hex(id(self))
+
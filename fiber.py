@@ -48,6 +48,19 @@ class WAIT:
 		return 'WAIT(%s)' % ( self.expire and time.strftime( '%H:%M:%S', time.localtime( self.expire ) ) )
 
 
+PENDING = []
+"Generators for new fibers started from within a running fiber. "
+
+def launch( generator ):
+
+	"""
+	Start a fiber for generator from within another fiber. It is picked up by
+	the spawn loop and stepped at its next iteration.
+	"""
+
+	PENDING.append( generator )
+
+
 class Fiber:
 
 	def __init__( self, generator ):
@@ -278,6 +291,9 @@ def spawn( generator, hostname, port, debug, daemon_log, pid_file ):
 			expire = None
 			now = time.time()
 
+			while PENDING:
+				fibers.append( myFiber( PENDING.pop( 0 ) ) )
+
 			i = len( fibers )
 			
 			mainlog.debug('[ STEP ] at %s, %s fibers', time.ctime(), len(fibers))
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import Cache
+import caches
+import Params
+import Runtime
+
+
+class Cache_RangeMap(unittest.TestCase):
+
+	def test_1_merge(self):
+		ranges = Cache.RangeMap()
+		ranges.add( 100, 200 )
+		ranges.add( 0, 50 )
+		ranges.add( 50, 60 )
+		ranges.add( 150, 300 )
+		self.assertEqual( str( ranges ), '0-60,100-300' )
+		ranges.add( 40, 120 )
+		self.assertEqual( str( ranges ), '0-300' )
+
+	def test_2_contiguous(self):
+		ranges = Cache.RangeMap.parse( '0-60,100-300' )
+		self.assertEqual( ranges.contiguous( 0 ), 60 )
+		self.assertEqual( ranges.contiguous( 30 ), 60 )
+		self.assertEqual( ranges.contiguous( 60 ), 60 )
+		self.assertEqual( ranges.contiguous( 150 ), 300 )
+		self.assert_( ranges.covers( 100, 300 ) )
+		self.failIf( ranges.covers( 50, 100 ) )
+
+	def test_3_missing(self):
+		ranges = Cache.RangeMap.parse( '0-60,100-300' )
+		self.assertEqual( ranges.missing( 0, 400 ), [ (60, 100), (300, 400) ] )
+		self.assertEqual( ranges.missing( 70, 90 ), [ (70, 90) ] )
+		self.assertEqual( ranges.missing( 100, 300 ), [] )
+
+
+class Cache_File(unittest.TestCase):
+
+	def test_1_write_at(self):
+		cache = Cache.File()
+		cache.ranges = Cache.RangeMap()
+		cache.fp = os.tmpfile()
+		cache.write_at( 6, 'world' )
+		self.assertEqual( cache.tell(), 0 )
+		cache.write( 'hello ' )
+		self.assertEqual( cache.offset, 6 )
+		self.assertEqual( cache.tell(), 11 )
+		self.assertEqual( cache.read( 0, 11 ), 'hello world' )
+		cache.fp.close()
+		cache.fp = None
+
+	def test_1_write_after_read(self):
+		cache = Cache.File()
+		cache.fp = os.tmpfile()
+		cache.length = 0
+		cache.write( 'hello ' )
+		self.assertEqual( cache.read( 0, 5 ), 'hello' )
+		cache.write( 'world' )
+		self.assertEqual( cache.tell(), 11 )
+		self.assertEqual( cache.read( 0, 11 ), 'hello world' )
+		cache.fp.close()
+		cache.fp = None
+
+	def test_2_shared_map(self):
+		params = Runtime.ROOT, Runtime.PARTIAL
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		Runtime.PARTIAL = Params.PARTIAL
+		open( os.path.join( Runtime.ROOT, 'file' ), 'w' ).write( 'hello world' )
+		files = []
+		for i in range( 2 ):
+			cache = Cache.File()
+			cache.path = 'file'
+			cache.open_full()
+			self.assertEqual( cache.tell(), 11 )
+			self.assertEqual( cache.read( 6, 100 ), 'world' )
+			files.append( cache )
+		shared = files[0].map
+		self.assert_( files[1].map is shared )
+		for cache in files:
+			cache.close()
+		self.failIf( shared.fp.closed )
+		cache.open_full()
+		self.assert_( cache.map is shared )
+		cache.close()
+		Cache.invalidate( cache.abspath() )
+		self.assert_( shared.fp.closed )
+		self.failIf( cache.abspath() in Cache.OPEN_FILES )
+		# Files replaced or removed behind the cache's back are reopened
+		cache.open_full()
+		shared = cache.map
+		cache.close()
+		os.remove( cache.abspath() )
+		open( cache.abspath(), 'w' ).write( 'hello' )
+		cache.open_full()
+		self.failIf( cache.map is shared )
+		self.assert_( shared.fp.closed )
+		self.assertEqual( cache.read( 0, 100 ), 'hello' )
+		cache.close()
+		os.remove( cache.abspath() )
+		self.assertRaises( OSError, cache.open_full )
+		self.failIf( cache.abspath() in Cache.OPEN_FILES )
+		shutil.rmtree( Runtime.ROOT )
+		Runtime.ROOT, Runtime.PARTIAL = params
+
+
+class Caches_ContentAddressed(unittest.TestCase):
+
+	def setUp(self):
+		self.root = Runtime.ROOT
+		self.partial = Runtime.PARTIAL
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		Runtime.PARTIAL = Params.PARTIAL
+
+	def tearDown(self):
+		shutil.rmtree( Runtime.ROOT )
+		Runtime.ROOT = self.root
+		Runtime.PARTIAL = self.partial
+
+	def test_1_finalize(self):
+		paths = []
+		for url in 'example.org/a', 'example.net/b':
+			cache = caches.ContentAddressed( url )
+			cache.open_new()
+			cache.write( 'hello ' )
+			cache.write( 'world' )
+			paths.append( cache.finalize( 0 ) )
+			cache.close()
+			self.failIf( os.path.exists( cache.partial_path() ) )
+		self.assertEqual( paths[0], paths[1] )
+		self.assert_( paths[0].startswith( caches.BLOB_DIR ) )
+		self.assertEqual( Cache.file_digest( os.path.join( Runtime.ROOT,
+			paths[0] ) ), os.path.basename( paths[0] ) )
+
+	def test_2_digest_out_of_order(self):
+		cache = caches.ContentAddressed( 'example.org/c' )
+		cache.ranges = Cache.RangeMap()
+		cache.open_segment( 6 )
+		cache.write( 'world' )
+		cache.write_at( 0, 'hello ' )
+		self.assertEqual( cache.digest(), hashlib.sha1( 'hello world' ).hexdigest() )
+		cache.close()
+
+
+class Caches_Sharded(unittest.TestCase):
+
+	def setUp(self):
+		self.params = Runtime.ROOT, Runtime.PARTIAL, Runtime.SHARD_LEVELS, \
+				Runtime.SHARD_WIDTH
+		Runtime.ROOT = tempfile.gettempdir() + os.sep
+		Runtime.PARTIAL = Params.PARTIAL
+		Runtime.SHARD_LEVELS, Runtime.SHARD_WIDTH = 2, 2
+
+	def tearDown(self):
+		Runtime.ROOT, Runtime.PARTIAL, Runtime.SHARD_LEVELS, \
+				Runtime.SHARD_WIDTH = self.params
+
+	def test_1_init(self):
+		cache = caches.Sharded( 'example.org/a' )
+		digest = hashlib.md5( 'example.org/a' ).hexdigest()
+		self.assertEqual( cache.path,
+				os.path.join( digest[:2], digest[2:4], digest ) )
+		Runtime.SHARD_LEVELS, Runtime.SHARD_WIDTH = 1, 3
+		cache = caches.Sharded( 'example.org/a' )
+		self.assertEqual( cache.path, os.path.join( digest[:3], digest ) )
+
+
+class Caches_Packed(unittest.TestCase):
+
+	def setUp(self):
+		self.params = Runtime.ROOT, Runtime.PARTIAL, Runtime.PACK_MAX_SIZE
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		Runtime.PARTIAL = Params.PARTIAL
+		Runtime.PACK_MAX_SIZE = 8
+
+	def tearDown(self):
+		shutil.rmtree( Runtime.ROOT )
+		Runtime.ROOT, Runtime.PARTIAL, Runtime.PACK_MAX_SIZE = self.params
+
+	def test_1_finalize(self):
+		paths = []
+		for url, data in ( 'example.org/a', 'small' ), \
+				( 'example.org/b', 'tiny' ), ( 'example.org/c', 'not so small' ):
+			cache = caches.Packed( url )
+			cache.open_new()
+			cache.write( data )
+			paths.append( cache.finalize( 0 ) )
+			self.assertEqual( cache.read( 0, 100 ), data )
+			cache.close()
+		self.assertEqual( caches.parse_pack_path( paths[0] ), ( 1, 0, 5 ) )
+		self.assertEqual( caches.parse_pack_path( paths[1] ), ( 1, 5, 4 ) )
+		self.assertEqual( caches.parse_pack_path( paths[2] ), None )
+		cache = caches.Packed()
+		cache.path = paths[1]
+		cache.stat()
+		self.assertEqual( cache.size, 4 )
+		cache.open_full()
+		self.assertEqual( cache.read( 1, 2 ), 'in' )
+		cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import zlib
+
+import HTTP
+
+
+class HTTP_ChunkedDecoder(unittest.TestCase):
+
+	message = '4;ext=1\r\nWiki\r\n5\r\npedia\r\n' \
+			'E\r\n in\r\n\r\nchunks.\r\n0\r\nExpires: never\r\n\r\n'
+
+	def decode(self, parts):
+		data = []
+		decoder = HTTP.ChunkedDecoder( lambda b: data.append( str( b ) ) )
+		for part in parts:
+			decoder.feed( part )
+		return decoder, ''.join( data )
+
+	def test_1_whole(self):
+		decoder, data = self.decode([ self.message ])
+		self.assert_( decoder.done )
+		self.assertEqual( data, 'Wikipedia in\r\n\r\nchunks.' )
+		self.assertEqual( decoder.size, len( data ) )
+		self.assertEqual( decoder.trailers, { 'Expires': 'never' } )
+
+	def test_2_bytewise(self):
+		decoder, data = self.decode( list( self.message ) )
+		self.assert_( decoder.done )
+		self.assertEqual( data, 'Wikipedia in\r\n\r\nchunks.' )
+
+	def test_3_message_end(self):
+		decoder = HTTP.ChunkedDecoder( lambda b: None )
+		self.assertEqual( decoder.feed( '1\r\nx\r\n0\r\n\r\nHTTP' ), 11 )
+		self.assert_( decoder.done )
+
+	def test_4_bad_chunk_end(self):
+		decoder = HTTP.ChunkedDecoder( lambda b: None )
+		self.assertRaises( AssertionError, decoder.feed, '1\r\nxy\r\n' )
+
+	def test_5_encode(self):
+		self.assertEqual( HTTP.encode_chunk( 'Wiki' ), '4\r\nWiki\r\n' )
+		self.assertEqual( HTTP.encode_chunk( '' ), '0\r\n\r\n' )
+
+
+class HTTP_Freshness(unittest.TestCase):
+
+	now = 1000000000
+	date = 'Sun, 09 Sep 2001 01:46:40 GMT'
+
+	def test_1_cache_control(self):
+		self.assertEqual( HTTP.parse_cache_control( 'no-cache, Max-Age="60"' ),
+				{ 'no-cache': None, 'max-age': '60' } )
+
+	def test_2_explicit(self):
+		self.assertEqual( HTTP.parse_date( self.date ), self.now )
+		self.assertEqual( HTTP.freshness( { 'Date': self.date, 'Age': '10',
+			'Cache-Control': 'max-age=60' }, self.now ),
+			( self.now - 10, self.now + 50 ) )
+		self.assertEqual( HTTP.freshness( { 'Date': self.date,
+			'Expires': 'Sun, 09 Sep 2001 01:47:40 GMT' }, self.now ),
+			( self.now, self.now + 60 ) )
+		self.assertEqual( HTTP.freshness( { 'Expires': '0' }, self.now ),
+			( self.now, self.now ) )
+
+	def test_3_heuristic(self):
+		headers = { 'Date': self.date,
+			'Last-Modified': 'Sat, 08 Sep 2001 01:46:40 GMT' }
+		self.assertEqual( HTTP.freshness( headers, self.now ),
+			( self.now, self.now + 8640 ) )
+		self.assertEqual( HTTP.freshness( headers, self.now, 3600 ),
+			( self.now, self.now + 3600 ) )
+		headers[ 'Cache-Control' ] = 'no-cache'
+		self.assertEqual( HTTP.freshness( headers, self.now ),
+			( self.now, self.now ) )
+
+	def test_4_private(self):
+		headers = { 'Date': self.date, 'Cache-Control': 'private, max-age=60' }
+		self.assertEqual( HTTP.freshness( headers, self.now ),
+			( self.now, self.now ) )
+		headers = { 'Date': self.date, 'Cache-Control': 'max-age=60' }
+		self.assertEqual( HTTP.freshness( headers, self.now, authorized=True ),
+			( self.now, self.now ) )
+		headers[ 'Cache-Control' ] = 'public, max-age=60'
+		self.assertEqual( HTTP.freshness( headers, self.now, authorized=True ),
+			( self.now, self.now + 60 ) )
+
+
+class HTTP_Vary(unittest.TestCase):
+
+	def test_1_variant_key(self):
+		vary = HTTP.parse_vary( 'User-Agent, accept-language,Accept-Language' )
+		self.assertEqual( vary, [ 'accept-language', 'user-agent' ] )
+		self.assertEqual( HTTP.variant_key( vary,
+			{ 'Accept-Language': 'en,  nl', 'Host': 'example.net' } ),
+			'accept-language: en, nl\nuser-agent: ' )
+		self.assertEqual( HTTP.variant_key( [], { 'Host': 'example.net' } ), '' )
+
+
+class HTTP_Encoding(unittest.TestCase):
+
+	def test_1_accepts(self):
+		self.assert_( HTTP.accepts_encoding( 'gzip, deflate', 'gzip' ) )
+		self.assert_( HTTP.accepts_encoding( 'x-gzip', 'gzip' ) )
+		self.assert_( HTTP.accepts_encoding( 'br;q=0.5, *', 'deflate' ) )
+		self.failIf( HTTP.accepts_encoding( 'gzip;q=0, *', 'gzip' ) )
+		self.failIf( HTTP.accepts_encoding( '', 'gzip' ) )
+		self.assertEqual( HTTP.accepted_codings( 'gzip;q=0, *' ),
+				HTTP.CODINGS[ 1: ] )
+		self.assertEqual( HTTP.accepted_codings( 'gzip, x-foo' ), [ 'gzip' ] )
+		self.assertEqual( HTTP.accepted_codings( '' ), [] )
+
+	def test_2_decoder(self):
+		compressor = zlib.compressobj( 9, zlib.DEFLATED, 16 + zlib.MAX_WBITS )
+		data = compressor.compress( 'Wikipedia ' * 100 ) + compressor.flush()
+		decoder = HTTP.decoder( 'gzip' )
+		self.assertEqual( decoder.decompress( data[ :10 ] )
+			+ decoder.decompress( data[ 10: ] ) + decoder.flush(), 'Wikipedia ' * 100 )
+		self.assertEqual( HTTP.decoder( 'compress' ), None )
+
+
+if __name__ == '__main__':
+    unittest.main()
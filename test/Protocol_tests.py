@@ -0,0 +1,193 @@
+import select
+import socket
+import threading
+import unittest
+
+import Cache
+import HTTP
+import Protocol
+import Runtime
+import fiber
+from Command import CLIParams
+
+
+class Server(threading.Thread):
+
+	"Answer each connection on a local port with the next of responses. "
+
+	def __init__(self, responses):
+		threading.Thread.__init__(self)
+		self.responses = list(responses)
+		self.requests = []
+		self.listener = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+		self.listener.bind(( '127.0.0.1', 0 ))
+		self.listener.listen( 5 )
+		self.port = self.listener.getsockname()[ 1 ]
+		self.daemon = True
+		self.start()
+
+	def run(self):
+		while self.responses:
+			sock, addr = self.listener.accept()
+			request = ''
+			while '\r\n\r\n' not in request:
+				request += sock.recv( 4096 )
+			self.requests.append( request )
+			sock.sendall( self.responses.pop( 0 ) )
+			sock.close()
+		self.listener.close()
+
+
+class Data:
+
+	finished = False
+
+	def __init__(self):
+		self.cache = Cache.File()
+		self.cache.ranges = Cache.RangeMap()
+		self.cache.offset = 0
+		self.written = {}
+		self.cache.write_at = self.write_at
+
+	def write_at(self, offset, chunk):
+		self.written[ offset ] = chunk
+		self.cache.ranges.add( offset, offset + len( chunk ) )
+
+	def finish_response(self):
+		self.finished = True
+
+
+class Request:
+
+	envelope = 'GET', '/file', 'HTTP/1.1'
+
+
+class SegmentedProtocol(Protocol.CachingProtocol):
+
+	def __init__(self, port):
+		self.request = Request()
+		self.request.hostinfo = '127.0.0.1', port
+		self.request_headers = { 'Host': 'localhost' }
+		self.data = Data()
+		self.cache = self.data.cache
+		self.fetch_end = 4
+		self.segments = 1
+		self.finished = True
+
+
+def partial(start, end, body):
+	return 'HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %i-%i/10'\
+		'\r\nContent-Length: %i\r\n\r\n%s' % ( start, end - 1, end - start,
+				body )
+
+def run(generator):
+	"Step generator until done, waiting for the socket it waits on. "
+	for state in generator:
+		if isinstance( state, fiber.RECV ):
+			select.select( [ state.fileno ], [], [], 5 )
+		elif isinstance( state, fiber.SEND ):
+			select.select( [], [ state.fileno ], [], 5 )
+
+
+class Protocol_FetchSegment(unittest.TestCase):
+
+	def setUp(self):
+		CLIParams.parse([])
+		del fiber.PENDING[ : ]
+
+	def test_1_success(self):
+		server = Server([ partial( 4, 8, 'ABCD' ) ])
+		protocol = SegmentedProtocol( server.port )
+		run( Protocol.fetch_segment( protocol, '"abc"', 4, 8 ) )
+		self.assert_( 'Range: bytes=4-7' in server.requests[ 0 ] )
+		self.assert_( 'If-Range: "abc"' in server.requests[ 0 ] )
+		self.assertEqual( protocol.data.written, { 4: 'ABCD' } )
+		self.assertEqual( protocol.segments, 0 )
+		self.assert_( protocol.data.finished )
+		self.failIf( fiber.PENDING )
+
+	def test_2_retry(self):
+		# The first connection closes halfway, the rest is requested again
+		server = Server([ partial( 4, 8, 'AB' ), partial( 6, 8, 'CD' ) ])
+		protocol = SegmentedProtocol( server.port )
+		run( Protocol.fetch_segment( protocol, '"abc"', 4, 8 ) )
+		self.assertEqual( protocol.segments, 1 )
+		self.failIf( protocol.data.finished )
+		self.assertEqual( len( fiber.PENDING ), 1 )
+		run( fiber.PENDING.pop() )
+		self.assert_( 'Range: bytes=6-7' in server.requests[ 1 ] )
+		self.assertEqual( str( protocol.cache.ranges ), '4-8' )
+		self.assertEqual( protocol.segments, 0 )
+		self.assert_( protocol.data.finished )
+
+	def test_3_failure(self):
+		# Without retries left the main connection continues, if it can
+		server = Server([ 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n' ])
+		protocol = SegmentedProtocol( server.port )
+		run( Protocol.fetch_segment( protocol, '"abc"', 4, 8, 0 ) )
+		self.failIf( fiber.PENDING )
+		self.assertEqual( protocol.fetch_end, None )
+		self.assert_( protocol.fetching() )
+
+	def test_4_failure_after_main(self):
+		# Once the main connection has its segment, the entity stays partial
+		server = Server([ 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n' ])
+		protocol = SegmentedProtocol( server.port )
+		protocol.cache.offset = 4
+		run( Protocol.fetch_segment( protocol, '"abc"', 4, 8, 0 ) )
+		self.assertEqual( protocol.fetch_end, 4 )
+		self.failIf( protocol.fetching() )
+		self.assert_( protocol.data.finished )
+
+
+class Protocol_PrepareSegments(unittest.TestCase):
+
+	def setUp(self):
+		CLIParams.parse([])
+		del fiber.PENDING[ : ]
+		self.parallel = Runtime.PARALLEL_FETCH, Runtime.PARALLEL_MIN_SIZE
+
+	def tearDown(self):
+		Runtime.PARALLEL_FETCH, Runtime.PARALLEL_MIN_SIZE = self.parallel
+		del fiber.PENDING[ : ]
+
+	def protocol(self, args):
+		protocol = Protocol.HttpProtocol.__new__( Protocol.HttpProtocol )
+		protocol._HttpProtocol__args = args
+		protocol.chunked = None
+		protocol.data = Data()
+		protocol.data.descriptor = Protocol.Resource.Descriptor( size=100 )
+		return protocol
+
+	def test_1_split(self):
+		Runtime.PARALLEL_FETCH, Runtime.PARALLEL_MIN_SIZE = 4, 10
+		protocol = self.protocol({ 'Accept-Ranges': 'bytes', 'ETag': '"abc"' })
+		protocol.prepare_segments()
+		self.assertEqual( protocol.fetch_end, 25 )
+		self.assertEqual( protocol.segments, 3 )
+		self.assertEqual( len( fiber.PENDING ), 3 )
+
+	def test_2_no_validator(self):
+		Runtime.PARALLEL_FETCH, Runtime.PARALLEL_MIN_SIZE = 4, 10
+		protocol = self.protocol({ 'Accept-Ranges': 'bytes' })
+		protocol.prepare_segments()
+		self.assertEqual( protocol.fetch_end, None )
+		self.failIf( fiber.PENDING )
+
+
+class Protocol_StaleResponse(unittest.TestCase):
+
+	def test_1_close_socket(self):
+		class StaleData:
+			def prepare_stale(self, request):
+				return True
+		protocol = Protocol.HttpProtocol.__new__( Protocol.HttpProtocol )
+		protocol.data = StaleData()
+		protocol.request = None
+		server, client = socket.socketpair()
+		protocol._HttpProtocol__socket = server
+		self.assert_( protocol.prepare_stale_response( 503 ) )
+		self.assertEqual( protocol.socket(), None )
+		# The connection of the failed response was closed
+		self.assertEqual( client.recv( 1 ), '' )
+		client.close()
@@ -0,0 +1,56 @@
+import unittest
+
+import Params
+import Runtime
+import Protocol
+from Request import HttpRequest
+
+
+class FakeSocket:
+
+	"Feed chunks to HttpRequest.recv and HttpRequest.recv_body. "
+
+	def __init__(self, *chunks):
+		self.chunks = list(chunks)
+
+	def recv(self, size):
+		chunk = self.chunks.pop(0)
+		assert len(chunk) <= size
+		return chunk
+
+
+class Request_Body(unittest.TestCase):
+
+	def setUp(self):
+		if not Runtime.PORT:
+			Runtime.PORT = Params.PORT
+		if not Runtime.HOSTNAME:
+			Runtime.HOSTNAME = Params.HOSTNAME
+
+	def test_1_streamed_body(self):
+		req = HttpRequest()
+		sock = FakeSocket(
+			'POST http://example.net/upload HTTP/1.1\r\n'
+			'Content-Length: 10\r\n\r\n0123',
+			'4567',
+			'89')
+		req.recv(sock)
+		self.assertEqual(req.Protocol, Protocol.BlindProtocol)
+		self.assert_(req.has_body())
+		self.assertEqual(req.read_body(), '0123')
+		self.assertEqual(req.read_body(), '')
+		req.recv_body(sock)
+		req.recv_body(sock)
+		self.failIf(req.has_body())
+		self.assertEqual(req.read_body(), '456789')
+		self.assert_(req.recvbuf().endswith('\r\n\r\n'))
+
+	def test_2_get_without_body(self):
+		req = HttpRequest()
+		req.recv(FakeSocket('GET http://example.net/ HTTP/1.1\r\n\r\n'))
+		self.assertEqual(req.Protocol, Protocol.HttpProtocol)
+		self.failIf(req.has_body())
+
+
+if __name__ == '__main__':
+    unittest.main()
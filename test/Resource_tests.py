@@ -1,9 +1,15 @@
 import unittest
 import os
 import sys
+import hashlib
+import shutil
+import tempfile
+import time
 import anydbm
 
+import Params
 import Runtime
+import Request
 import Resource
 from Command import CLIParams
 
@@ -21,12 +27,145 @@ class Resource_Descriptor(unittest.TestCase):
 		pass # Descriptor(storage).load_from_storage(path)/drop/update/commit/data
 
 
+class Resource_ProxyData(unittest.TestCase):
+
+	settings = 'STALE_WHILE_REVALIDATE', 'STALE_IF_ERROR', 'ADMIT_HITS', \
+			'ADMIT_MAX_SIZE', 'ADMIT_EXCLUDE'
+
+	def setUp(self):
+		self.saved = [ getattr( Runtime, name ) for name in self.settings ]
+
+	def tearDown(self):
+		for name, value in zip( self.settings, self.saved ):
+			setattr( Runtime, name, value )
+
+	def test_1_not_modified(self):
+		data = Resource.ProxyData( None )
+		data.descriptor = Resource.Descriptor( etag='abc', mtime=1000000000 )
+		self.assert_( data.not_modified({ 'If-None-Match': '"x", W/"abc"' }) )
+		self.failIf( data.not_modified({ 'If-None-Match': '"x"',
+			'If-Modified-Since': 'Sun, 09 Sep 2001 01:46:40 GMT' }) )
+		self.assert_( data.not_modified({
+			'If-Modified-Since': 'Sun, 09 Sep 2001 01:46:40 GMT' }) )
+		self.failIf( data.not_modified({
+			'If-Modified-Since': 'Sun, 09 Sep 2001 01:46:39 GMT' }) )
+		self.failIf( data.not_modified({}) )
+
+	def test_2_stale_window(self):
+		data = Resource.ProxyData( None )
+		data.descriptor = Resource.Descriptor( stale_if_error=0 )
+		Runtime.STALE_WHILE_REVALIDATE = 30
+		Runtime.STALE_IF_ERROR = 60
+		self.assertEqual( data.get_stale_window( 'stale_while_revalidate' ), 30 )
+		self.assertEqual( data.get_stale_window( 'stale_if_error' ), 0 )
+
+	def test_3_variant_headers(self):
+		descriptor = Resource.Descriptor(
+				variant='accept-language: en\nuser-agent: ' )
+		self.assertEqual( descriptor.variant_headers(),
+				{ 'Accept-Language': 'en' } )
+
+	def test_3_variant_key(self):
+		headers = { 'Accept-Language': 'en', 'Accept-Encoding': 'gzip' }
+		self.assertEqual( Resource.variant_key(
+				[ 'accept-encoding', 'accept-language' ], headers ),
+			'accept-encoding: \naccept-language: en' )
+
+	def test_4_admit(self):
+		class Protocol:
+			url = '//example.org/admit'
+			request = Request.HttpRequest()
+			headers = { 'Content-Type': 'video/mp4', 'Content-Length': '100' }
+			def args(self):
+				return self.headers
+		data = Resource.ProxyData( Protocol() )
+		Runtime.ADMIT_HITS, Runtime.ADMIT_MAX_SIZE = 1, 0
+		Runtime.ADMIT_EXCLUDE = 'video/'
+		self.failIf( data.admit() )
+		Runtime.ADMIT_EXCLUDE = 'image/png'
+		self.assert_( data.admit() )
+		Runtime.ADMIT_MAX_SIZE = 50
+		self.failIf( data.admit() )
+		Runtime.ADMIT_MAX_SIZE, Runtime.ADMIT_HITS = 0, 2
+		self.failIf( data.admit() )
+		self.assert_( data.admit() )
+
+	def test_5_check_file(self):
+		fd, path = tempfile.mkstemp()
+		os.write( fd, 'hello world' )
+		os.close( fd )
+		os.utime( path, ( 1000, 1000 ) )
+		digest = hashlib.sha1( 'hello world' ).hexdigest()
+		entry = [ 11, 1000, digest ]
+		self.assertEqual( Resource._check_file(( 1, path, 11, 1000, digest, None )),
+				( 1, None, '', entry ) )
+		self.assertEqual( Resource._check_file(( 1, path, 12, 1000, digest, None ))[ 1 ],
+				'size' )
+		self.assertEqual( Resource._check_file(( 1, path, 11, 999, digest, None ))[ 1 ],
+				'mtime' )
+		self.assertEqual( Resource._check_file(( 1, path, 11, 1000, 'x', None ))[ 1 ],
+				'checksum' )
+		# Not hashed again while unchanged since the last check
+		self.assertEqual( Resource._check_file(( 1, path, 11, 1000, 'x',
+			[ 11, 1000, 'x' ] ))[ 1 ], None )
+		os.remove( path )
+		self.assertEqual( Resource._check_file(( 1, path, 11, 1000, digest, None ))[ 1 ],
+				'missing' )
+
+	def test_5_check_packed(self):
+		import caches
+		root, Runtime.ROOT = Runtime.ROOT, tempfile.mkdtemp() + os.sep
+		try:
+			segment, offset, length = caches.get_pack_store().append(
+					'hello world' )
+			descriptor = Resource.Descriptor( size=length,
+					path=caches.pack_path( segment, offset, length ),
+					hash=hashlib.sha1( 'hello world' ).hexdigest() )
+			self.assertEqual( Resource._check_packed( descriptor ), ( None, '' ) )
+			descriptor.hash = 'x'
+			self.assertEqual( Resource._check_packed( descriptor )[ 0 ],
+					'checksum' )
+			descriptor.path = caches.pack_path( segment + 1, 0, length )
+			self.assertEqual( Resource._check_packed( descriptor )[ 0 ],
+					'missing' )
+		finally:
+			shutil.rmtree( Runtime.ROOT )
+			Runtime.ROOT = root
+
+	def test_5_pool_results(self):
+		root = tempfile.mkdtemp()
+		for name in 'a', 'b':
+			os.mkdir( os.path.join( root, name ) )
+			open( os.path.join( root, name, 'file' ), 'w' ).write( name )
+		pool = Resource.get_pool()
+		files = []
+		for result in Resource.pool_results( pool, Resource._scan_tree,
+				[ os.path.join( root, name ) for name in 'a', 'b' ] ):
+			files.extend([ os.path.relpath( abspath, root )
+				for abspath, size, mtime in result ])
+		pool.close()
+		pool.join()
+		self.assertEqual( sorted( files ), [ 'a/file', 'b/file' ] )
+		shutil.rmtree( root )
+
+
 class Resource_backend(unittest.TestCase):
 
 	"""
 	Test wether get/open/close backend works. 
 	"""
 
+	settings = 'ROOT', 'EVICTION'
+
+	def setUp(self):
+		self.saved = [ getattr( Runtime, name ) for name in self.settings ]
+		self.blob_prune_age = Params.BLOB_PRUNE_AGE
+
+	def tearDown(self):
+		for name, value in zip( self.settings, self.saved ):
+			setattr( Runtime, name, value )
+		Params.BLOB_PRUNE_AGE = self.blob_prune_age
+
 	def test_1_init(self):
 		Runtime.DATA_DIR = '/tmp/htcache-unittest-data'
 		if not os.path.exists(Runtime.DATA_DIR):
@@ -43,3 +182,208 @@ class Resource_backend(unittest.TestCase):
 		print Resource
 		#Resource.close_backend()
 
+	def test_3_victims(self):
+		Runtime.DATA_DIR = '/tmp/htcache-unittest-data'
+		CLIParams.parse(['--data-dir', Runtime.DATA_DIR])
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		descriptors = []
+		for atime, hits in ( 2, 1 ), ( 1, 5 ):
+			open( os.path.join( Runtime.ROOT, 'file%i' % atime ), 'w' ).write( 'x' )
+			descriptor = Resource.Descriptor( path='file%i' % atime,
+					mediatype='text/plain', mediatype_auth=True, mtime=0,
+					size=1, atime=atime, hits=hits,
+					resource=Resource.Resource( url='//example.org/%i' % atime ) )
+			descriptor.commit()
+			descriptors.append( descriptor )
+		def victims():
+			return [ descriptor for descriptor in
+				Resource.Descriptor.find_victims( 1000 )
+				if descriptor in descriptors ]
+		self.assertEqual( victims(), descriptors[::-1] )
+		Runtime.EVICTION = 'lfu'
+		self.assertEqual( victims(), descriptors )
+		for descriptor in descriptors:
+			descriptor.remove()
+		self.failIf( os.listdir( Runtime.ROOT ) )
+		shutil.rmtree( Runtime.ROOT )
+
+	def test_4_usage(self):
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		usage = Resource.Descriptor.usage( recount=True )
+		def added():
+			size, count = Resource.Descriptor.usage()
+			self.assertEqual(( size, count ),
+				Resource.Descriptor.usage( recount=True ))
+			return size - usage[ 0 ], count - usage[ 1 ]
+		open( os.path.join( Runtime.ROOT, 'usage' ), 'w' ).write( 'x' )
+		descriptor = Resource.Descriptor( mediatype='text/plain',
+				mediatype_auth=True, mtime=0, size=10,
+				resource=Resource.Resource( url='//example.org/usage' ) )
+		descriptor.commit()
+		self.assertEqual( added(), ( 0, 0 ) )
+		descriptor.path = 'usage'
+		descriptor.commit()
+		self.assertEqual( added(), ( 10, 1 ) )
+		descriptor.size = 1
+		descriptor.commit()
+		self.assertEqual( added(), ( 1, 1 ) )
+		# Locations shared by descriptors count once
+		shared = Resource.Descriptor( path='usage', mediatype='text/plain',
+				mediatype_auth=True, mtime=0, size=1,
+				resource=Resource.Resource( url='//example.org/usage-shared' ) )
+		shared.commit()
+		self.assertEqual( added(), ( 1, 1 ) )
+		shared.remove()
+		self.assertEqual( added(), ( 1, 1 ) )
+		descriptor.remove()
+		self.assertEqual( added(), ( 0, 0 ) )
+		shutil.rmtree( Runtime.ROOT )
+
+	def test_5_prune_blobs(self):
+		import caches
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		path = os.path.join( caches.BLOB_DIR, 'ab', 'abcd' )
+		os.makedirs( os.path.dirname( os.path.join( Runtime.ROOT, path ) ) )
+		open( os.path.join( Runtime.ROOT, path ), 'w' ).write( 'x' )
+		Resource.CachePath.record( path, 1, 0, None )
+		# Blobs that may have just been stored are kept
+		Resource.prune_blobs()
+		self.assert_( os.path.exists( os.path.join( Runtime.ROOT, path ) ) )
+		Params.BLOB_PRUNE_AGE = -60
+		Resource.prune_blobs()
+		self.failIf( os.path.exists( os.path.join( Runtime.ROOT, path ) ) )
+		self.failIf( Resource.get_backend().query( Resource.CachePath )
+				.get( path ) )
+		shutil.rmtree( Runtime.ROOT )
+
+	def test_6_cache_paths(self):
+		Runtime.DATA_DIR = '/tmp/htcache-unittest-data'
+		CLIParams.parse(['--data-dir', Runtime.DATA_DIR])
+		open( Resource.cache_paths_marker(), 'w' ).close()
+		descriptor = Resource.Descriptor( path='host/index',
+				mediatype='text/plain', mediatype_auth=True, mtime=0, size=1,
+				resource=Resource.Resource( url='//example.org/index' ) )
+		descriptor.commit()
+		Resource.CachePath.record( 'host/index.incomplete', 0, 0, descriptor.id )
+		Resource.CachePath.record( 'host/index', 1, 0, descriptor.id )
+		paths = [ entry.path for entry in Resource.iter_cache_paths()
+				if entry.descriptor_id == descriptor.id ]
+		self.assertEqual( paths, [ 'host/index' ] )
+		# Shared paths keep the descriptor they were first recorded for
+		path = 'blobs/%i' % descriptor.id
+		Resource.CachePath.record( path, 1, 0, descriptor.id )
+		Resource.CachePath.record( path, 1, 0, descriptor.id + 1000000 )
+		self.assertEqual( Resource.get_backend().query( Resource.CachePath )
+				.get( path ).descriptor_id, descriptor.id )
+
+	def test_6_scan_cache_paths(self):
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		os.mkdir( os.path.join( Runtime.ROOT, 'host' ) )
+		open( os.path.join( Runtime.ROOT, 'host', 'file' ), 'w' ).write( 'x' )
+		marker = Resource.cache_paths_marker()
+		if os.path.exists( marker ):
+			os.remove( marker )
+		# The index is built with a scan once, even if it has entries
+		Resource.CachePath.record( 'host/recorded', 1, 0, None )
+		paths = [ entry.path for entry in Resource.iter_cache_paths() ]
+		self.assertEqual( paths, [ 'host/file' ] )
+		self.assert_( os.path.exists( marker ) )
+		Resource.CachePath.record( 'host/recorded', 1, 0, None )
+		paths = [ entry.path for entry in Resource.iter_cache_paths() ]
+		self.assertEqual( paths, [ 'host/file', 'host/recorded' ] )
+		shutil.rmtree( Runtime.ROOT )
+
+	def test_7_query(self):
+		Runtime.DATA_DIR = '/tmp/htcache-unittest-data'
+		CLIParams.parse(['--data-dir', Runtime.DATA_DIR,
+			'--host', 'query.example.org', '--mediatype', 'image',
+			'--since', '1970-01-01T00:00:10'])
+		descriptors = []
+		for url, mediatype, mtime in (
+				( '//query.example.org/a', 'image/png', 10 ),
+				( '//query.example.org:81/b', 'image/gif', 20 ),
+				( '//query.example.org/c', 'text/html', 30 ),
+				( '//query.example.org.net/d', 'image/png', 40 ),
+				( '//query.example.org/e', 'image/png', 5 )):
+			descriptor = Resource.Descriptor( path=url[2:],
+					mediatype=mediatype, mediatype_auth=True, mtime=mtime,
+					resource=Resource.Resource( url=url ) )
+			descriptor.commit()
+			descriptors.append( descriptor )
+		self.assertEqual( [ descriptor.resource.url for descriptor in
+			Resource.query_descriptors() if descriptor in descriptors ],
+			[ '//query.example.org/a',
+				'//query.example.org:81/b' ] )
+		CLIParams.parse(['--data-dir', Runtime.DATA_DIR])
+
+	def test_8_upgrade_schema(self):
+		data_dir = tempfile.mkdtemp()
+		dbref = 'sqlite:///' + os.path.join( data_dir, 'resources.sqlite' )
+		engine = Resource.create_engine( dbref )
+		engine.execute( 'CREATE TABLE descriptors (id INTEGER PRIMARY KEY,'
+			' resource_id INTEGER NOT NULL, path VARCHAR(255),'
+			' mediatype VARCHAR(255) NOT NULL, mediatype_auth BOOLEAN NOT NULL,'
+			' size INTEGER, mtime INTEGER NOT NULL)' )
+		session = Resource.get_session( dbref, True )
+		columns = [ column[ 'name' ] for column in
+			Resource.inspect( engine ).get_columns( 'descriptors' ) ]
+		self.assertTrue( 'hash' in columns and 'atime' in columns )
+		self.assertEqual( session.query( Resource.Descriptor ).count(), 0 )
+		session.close()
+		shutil.rmtree( data_dir )
+
+	def test_9_prepare_range(self):
+		Runtime.DATA_DIR = '/tmp/htcache-unittest-data'
+		CLIParams.parse(['--data-dir', Runtime.DATA_DIR])
+		Runtime.ROOT = tempfile.mkdtemp() + os.sep
+		os.mkdir( os.path.join( Runtime.ROOT, 'range' ) )
+		open( os.path.join( Runtime.ROOT, 'range', 'file' ), 'w' ).write(
+				'0123456789' )
+		url = '//range.example.org/file-%s' % os.path.basename(
+				Runtime.ROOT.rstrip( os.sep ) )
+		descriptor = Resource.Descriptor( path='range/file',
+				mediatype='text/plain', mediatype_auth=True, mtime=1000000000,
+				size=10, etag='abc', expires=int( time.time() ) + 3600,
+				resource=Resource.Resource( url=url ) )
+		descriptor.commit()
+		class Protocol:
+			pass
+		Protocol.url = url
+		def prepare(headers):
+			request = Request.HttpRequest()
+			request._HttpRequest__headers = headers
+			data = Resource.ProxyData( Protocol() )
+			return data.prepare_range( request )
+		self.assert_( prepare({ 'Range': 'bytes=2-' }) )
+		self.assert_( prepare({ 'Range': 'bytes=2-5' }) )
+		# Ends beyond the entity are clamped to its last byte
+		self.assert_( prepare({ 'Range': 'bytes=2-100' }) )
+		# Suffix ranges and ranges starting beyond the entity go upstream
+		self.failIf( prepare({ 'Range': 'bytes=-5' }) )
+		self.failIf( prepare({ 'Range': 'bytes=10-20' }) )
+		self.assert_( prepare({ 'Range': 'bytes=2-5', 'If-Range': '"abc"' }) )
+		self.assert_( prepare({ 'Range': 'bytes=2-5',
+			'If-Range': 'Sun, 09 Sep 2001 01:46:40 GMT' }) )
+		self.failIf( prepare({ 'Range': 'bytes=2-5', 'If-Range': '"xyz"' }) )
+		self.failIf( prepare({ 'Range': 'bytes=2-5', 'If-Range': 'W/"abc"' }) )
+		# Reloads and stale entities go upstream
+		self.failIf( prepare({ 'Range': 'bytes=2-5', 'Cache-Control': 'no-cache' }) )
+		self.failIf( prepare({ 'Range': 'bytes=2-5', 'Pragma': 'no-cache' }) )
+		descriptor.expires = int( time.time() ) - 1
+		descriptor.commit()
+		self.failIf( prepare({ 'Range': 'bytes=2-5' }) )
+		shutil.rmtree( Runtime.ROOT )
+
+	def test_9_variant_key(self):
+		class request:
+			url = 'http://example.net/variant-key-%s' % os.getpid()
+			headers = { 'Accept-Language': 'en', 'Accept-Encoding': 'gzip' }
+		self.assertEqual( Resource.download_key( request ),
+				( request.url, '' ) )
+		Resource.Descriptor( mediatype='text/plain', mediatype_auth=True,
+				mtime=1000000000, size=10,
+				vary='Accept-Language', variant='accept-language: nl',
+				resource=Resource.Resource( url=request.url ) ).commit()
+		# Downloads of the same URL are kept apart by the stored Vary fields
+		self.assertEqual( Resource.download_key( request ),
+				( request.url, 'accept-language: en' ) )
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import unittest
 
@@ -35,7 +36,117 @@ class Rules_Join(unittest.TestCase):
 
 
 class Rules_Drop(unittest.TestCase):
-	pass
+
+	state = 'main_file', 'rules', 'files', 'matchers', 'mtimes'
+
+	def setUp(self):
+		self.saved = [ getattr(Rules.Drop, name) for name in self.state ]
+		self.tempfiles = []
+
+	def tearDown(self):
+		for name, value in zip(self.state, self.saved):
+			setattr(Rules.Drop, name, value)
+		Rules.MEMO.clear()
+		for fn in self.tempfiles:
+			if os.path.exists(fn):
+				os.remove(fn)
+
+	def ruleset(self, patterns):
+		"Parse patterns as the Drop rules, and return the file name. "
+		fd, fn = tempfile.mkstemp()
+		os.write(fd, '\n'.join(patterns) + '\n')
+		os.close(fd)
+		self.tempfiles.append(fn)
+		Rules.Drop.main_file = fn
+		Rules.Drop.parse()
+		return fn
+
+	def test_1_match(self):
+		self.ruleset([
+			r'ads\.example\.(com|net)/.*',
+			r'(www\.)?example\.org/(a)\2.*',
+			r'[^/]+/banner[(][0-9]+[)]',
+			r'(?:[a-z]+\.)?example\.org/.*',
+			r'(<)?cond\.example\.net/(?(1)>|x)',
+		] + [ r'host%i/.*' % i for i in range(200) ])
+		self.assertEqual(len(Rules.Drop.matchers), 7)
+		self.assertEqual(Rules.Drop.match('ads.example.net/x'),
+				r'^ads\.example\.(com|net)/.*$')
+		self.assertEqual(Rules.Drop.match('example.org/aa'),
+				r'^(www\.)?example\.org/(a)\2.*$')
+		self.assertEqual(Rules.Drop.match('example.org/ab'),
+				r'^(?:[a-z]+\.)?example\.org/.*$')
+		self.assertEqual(Rules.Drop.match('x/banner(1)'),
+				r'^[^/]+/banner[(][0-9]+[)]$')
+		self.assertEqual(Rules.Drop.match('host150/'), r'^host150/.*$')
+		self.assertEqual(Rules.Drop.match('cond.example.net/x'),
+				r'^(<)?cond\.example\.net/(?(1)>|x)$')
+		self.assertEqual(Rules.Drop.match('ads.example.com'), None)
+
+	def test_2_memo(self):
+		self.ruleset([ r'host[0-9]+/.*' ])
+		self.assertEqual(Rules.Drop.match('host150/'), r'^host[0-9]+/.*$')
+		self.assertEqual(Rules.Drop.match('ads.example.com'), None)
+		self.assertEqual(Rules.MEMO[('Drop', 'host150/')], r'^host[0-9]+/.*$')
+		self.assertTrue(('Drop', 'ads.example.com') in Rules.MEMO)
+		# remembered matches do not need the matchers
+		Rules.Drop.matchers = []
+		self.assertEqual(Rules.Drop.match('host150/'), r'^host[0-9]+/.*$')
+		# parsing rules again forgets them
+		self.ruleset([ r'ads\.example\.com' ])
+		self.assertFalse(Rules.MEMO)
+		self.assertEqual(Rules.Drop.match('host150/'), None)
+		self.assertEqual(Rules.Drop.match('ads.example.com'),
+				r'^ads\.example\.com$')
+
+	def test_3_reload(self):
+		fn = self.ruleset([ r'old\.example\.org/.*' ])
+		os.utime(fn, (1000, 1000))
+		Rules.Drop.parse()
+		self.assertFalse(Rules.Drop.changed())
+		open(fn, 'w').write('new\\.example\\.org/.*\n')
+		self.assertTrue(Rules.Drop.changed())
+		Rules.Drop.reload()
+		self.assertFalse(Rules.Drop.changed())
+		self.assertEqual(Rules.Drop.match('old.example.org/'), None)
+		self.assertEqual(Rules.Drop.match('new.example.org/'),
+				r'^new\.example\.org/.*$')
+		# a broken file leaves the rules in place
+		open(fn, 'w').write('broken(\n')
+		os.utime(fn, (2000, 2000))
+		self.assertRaises(Exception, Rules.Drop.reload)
+		self.assertEqual(Rules.Drop.match('new.example.org/'),
+				r'^new\.example\.org/.*$')
+
+	def test_4_reload_extra(self):
+		fd, extra = tempfile.mkstemp()
+		os.write(fd, 'extra\\.example\\.org/.*\n')
+		os.close(fd)
+		self.tempfiles.append(extra)
+		fn = self.ruleset([ r'main\.example\.org/.*' ])
+		Rules.Drop.parse(extra)
+		self.assertEqual(Rules.Drop.files, [ fn, extra ])
+		self.assertEqual(Rules.Drop.match('extra.example.org/'),
+				r'^extra\.example\.org/.*$')
+		# a broken extra file leaves the rules of both in place
+		open(extra, 'w').write('broken(\n')
+		os.utime(extra, (2000, 2000))
+		self.assertTrue(Rules.Drop.changed())
+		self.assertRaises(Exception, Rules.Drop.reload)
+		self.assertEqual(Rules.Drop.files, [ fn, extra ])
+		self.assertEqual(Rules.Drop.match('main.example.org/'),
+				r'^main\.example\.org/.*$')
+		self.assertEqual(Rules.Drop.match('extra.example.org/'),
+				r'^extra\.example\.org/.*$')
+		# and the extra file stays watched
+		self.assertTrue(Rules.Drop.changed())
+		open(extra, 'w').write('other\\.example\\.org/.*\n')
+		Rules.Drop.reload()
+		self.assertFalse(Rules.Drop.changed())
+		self.assertEqual(Rules.Drop.match('extra.example.org/'), None)
+		self.assertEqual(Rules.Drop.match('other.example.org/'),
+				r'^other\.example\.org/.*$')
+
 
 class Rules_Rewrite(unittest.TestCase):
 	pass
@@ -1,3 +1,8 @@
 from Resource_tests import *
 from Rules_tests import *
+from Protocol_tests import *
 from Response_tests import *
+from Request_tests import *
+from HTTP_tests import *
+from Cache_tests import *
+from util_tests import *
@@ -0,0 +1,34 @@
+import unittest
+
+from util import LRU, CountMinSketch
+
+
+class Util_LRU(unittest.TestCase):
+
+	def test_1_evict(self):
+		evicted = []
+		lru = LRU( 2, evicted.append )
+		lru[ 'a' ] = 1
+		lru[ 'b' ] = 2
+		self.assertEqual( lru[ 'a' ], 1 )
+		lru[ 'c' ] = 3
+		self.assertEqual( evicted, [ 2 ] )
+		self.assertEqual( lru.keys(), [ 'a', 'c' ] )
+		self.assertEqual( lru.get( 'b' ), None )
+
+
+class Util_CountMinSketch(unittest.TestCase):
+
+	def test_1_add(self):
+		sketch = CountMinSketch( 64, period=100 )
+		for i in range( 3 ):
+			sketch.add( 'a' )
+		self.assertEqual( sketch.add( 'a' ), 4 )
+		self.assert_( sketch.estimate( 'b' ) <= 4 )
+		for i in range( 96 ):
+			sketch.add( str( i ) )
+		self.assert_( sketch.estimate( 'a' ) <= 2 )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 import os
 import sys
+from array import array
+from hashlib import md5
 from UserDict import UserDict, IterableUserDict
+from collections import OrderedDict
 import traceback
 
 # XXX: Dont use cjson, its buggy, see comments at
@@ -88,6 +91,82 @@ class HeaderDict(LowercaseDict):
 		LowercaseDict.clear(self)
 
 
+class LRU(OrderedDict):
+
+	"""
+	A map of at most `size` items that drops the least recently used item
+	when full. Dropped values are passed to `evict`, if given.
+	"""
+
+	def __init__(self, size, evict=None):
+		self.size = size
+		self.evict = evict
+		OrderedDict.__init__(self)
+
+	def __getitem__(self, key):
+		value = OrderedDict.__getitem__(self, key)
+		OrderedDict.__delitem__(self, key)
+		OrderedDict.__setitem__(self, key, value)
+		return value
+
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		return default
+
+	def __setitem__(self, key, value):
+		if key in self:
+			OrderedDict.__delitem__(self, key)
+		OrderedDict.__setitem__(self, key, value)
+		while len(self) > self.size:
+			key, value = self.popitem(last=False)
+			if self.evict:
+				self.evict(value)
+
+
+class CountMinSketch(object):
+
+	"""
+	Approximate counts of keys in `depth` rows of `width` counters, see
+	TinyLFU. All counts are halved after `period` additions, so old
+	popularity fades.
+	"""
+
+	def __init__(self, width, depth=4, period=None):
+		assert depth <= 4
+		self.width = width
+		self.depth = depth
+		self.period = period or 10 * width
+		self.additions = 0
+		self.rows = [ array('I', [0]) * width for i in range(depth) ]
+
+	def __indices(self, key):
+		digest = md5(key).hexdigest()
+		return [ int(digest[ i*8:(i+1)*8 ], 16) % self.width
+				for i in range(self.depth) ]
+
+	def add(self, key):
+		"Count key once, and return its estimated count. "
+		counts = []
+		for row, i in zip(self.rows, self.__indices(key)):
+			row[i] += 1
+			counts.append(row[i])
+		self.additions += 1
+		if self.additions >= self.period:
+			self.age()
+		return min(counts)
+
+	def estimate(self, key):
+		return min([ row[i] for row, i in zip(self.rows, self.__indices(key)) ])
+
+	def age(self):
+		"Halve all counts. "
+		for row in self.rows:
+			for i in xrange(self.width):
+				row[i] >>= 1
+		self.additions = 0
+
+
 def cn(obj):
 	return obj.__class__.__name__
 